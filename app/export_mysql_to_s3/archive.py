@@ -0,0 +1,408 @@
+"""
+Seekable single-object backup archives
+
+An archive is one compressed object holding a whole mysqldump, split
+into sections per table (plus the dump header, views, routines and
+events). Every section is written as one or more independently
+compressed frames, so the object is still a plain .sql.gz / .sql.zst
+that gunzip or zstd can restore in full.
+
+After the dump follows an index frame that decompresses to a single SQL
+comment line with the JSON index of section byte ranges, and finally a
+fixed-size metadata frame (see Compressor.metadata_frame) pointing at
+the index. A reader fetches the trailer and the index with two ranged
+GETs and then only the frames of the sections it needs.
+"""
+
+import json
+import re
+import struct
+import sys
+
+from botocore.exceptions import ClientError
+
+from checksums import new_checksum
+from compressors import codec_for_key, get_compressor, read_metadata_frame
+from encryption import EncryptedObjectReader, object_encryption
+from tee import print_mirror_results
+
+MiB = 1024 * 1024
+
+ARCHIVE_VERSION = 1
+
+# Dump bytes kept for parsing binlog coordinates
+HEAD_SIZE = 64 * 1024
+
+# Uncompressed bytes per frame; large tables span several frames
+FRAME_SIZE = 64 * MiB
+
+TRAILER = struct.Struct("<8sQQ")
+TRAILER_MAGIC = b"SQLARC1\x00"
+
+INDEX_PREFIX = b"-- sql-archive-index: "
+
+HEADER_SECTION = "_header"
+
+# Section markers written by mysqldump before each object
+SECTION_MARKERS = (
+    (re.compile(rb"^-- Table structure for table `((?:[^`]|``)+)`"), "table"),
+    (re.compile(rb"^-- Temporary view structure for view `((?:[^`]|``)+)`"), "view"),
+    (re.compile(rb"^-- Final view structure for view `((?:[^`]|``)+)`"), "view"),
+    (re.compile(rb"^-- Dumping (routines|events) for database"), "objects"),
+)
+
+
+def archive_key(s3_prefix: str, db_name: str, extension: str) -> str:
+    """
+    Build the S3 key of a database archive.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        extension: Compressor file extension
+
+    Returns:
+        S3 key
+    """
+    return f"{s3_prefix}/{db_name}.archive.sql{extension}"
+
+
+def section_for_line(line: bytes) -> tuple:
+    """
+    Detect a mysqldump section marker.
+
+    Args:
+        line: One line of dump output
+
+    Returns:
+        Tuple of (kind, name), or None if the line starts no section
+    """
+    if not line.startswith(b"-- "):
+        return None
+    for pattern, kind in SECTION_MARKERS:
+        match = pattern.match(line)
+        if match:
+            name = match.group(1).decode("utf-8", errors="replace").replace("``", "`")
+            return kind, f"_{name}" if kind == "objects" else name
+    return None
+
+
+class ArchiveWriter:
+    def __init__(self, writer, compressor, frame_size: int = FRAME_SIZE, checksum=None):
+        """
+        Initialize archive writer.
+
+        Args:
+            writer: Binary file object receiving the archive (e.g. an
+                S3MultipartWriter)
+            compressor: Compressor used for every frame
+            frame_size: Uncompressed bytes per frame
+            checksum: Streaming checksum fed everything the archive
+                decompresses to, index line included
+        """
+        self.writer = writer
+        self.checksum = checksum
+        # raw_bytes plus the index line
+        self.decoded_bytes = 0
+        self.compressor = compressor
+        self.frame_size = frame_size
+        self.offset = 0
+        self.raw_bytes = 0
+        self.sections = {}
+        self.section = None
+        self.frame = None
+        self.frame_offset = 0
+        self.frame_raw = 0
+
+    def start_section(self, kind: str, name: str):
+        """
+        Close the current frame and direct further writes to a section.
+
+        Args:
+            kind: Section kind ("header", "table", "view" or "objects")
+            name: Section name
+        """
+        self._end_frame()
+        key = (kind, name)
+        if key not in self.sections:
+            self.sections[key] = {
+                "name": name,
+                "kind": kind,
+                "raw_bytes": 0,
+                "bytes": 0,
+                "frames": [],
+            }
+        self.section = self.sections[key]
+
+    def write(self, data: bytes):
+        """
+        Compress data into the current section.
+
+        Args:
+            data: Uncompressed bytes
+        """
+        if self.section is None:
+            self.start_section("header", HEADER_SECTION)
+        if self.frame is None:
+            self.frame = self.compressor.compressobj()
+            self.frame_offset = self.offset
+            self.frame_raw = 0
+
+        if self.checksum:
+            self.checksum.update(data)
+        self._emit(self.frame.compress(data))
+        self.frame_raw += len(data)
+        self.section["raw_bytes"] += len(data)
+        self.raw_bytes += len(data)
+
+        if self.frame_raw >= self.frame_size:
+            self._end_frame()
+
+    def close(self) -> dict:
+        """
+        Finish the last frame and append the index and trailer.
+
+        Returns:
+            Archive index
+        """
+        self._end_frame()
+        index = {
+            "version": ARCHIVE_VERSION,
+            "codec": self.compressor.name,
+            "raw_bytes": self.raw_bytes,
+            "sections": list(self.sections.values()),
+        }
+
+        index_offset = self.offset
+        frame = self.compressor.compressobj()
+        line = INDEX_PREFIX + json.dumps(index, separators=(",", ":")).encode() + b"\n"
+        if self.checksum:
+            self.checksum.update(line)
+        self.decoded_bytes = self.raw_bytes + len(line)
+        self._emit(frame.compress(line) + frame.flush())
+        index_length = self.offset - index_offset
+
+        self._emit(
+            self.compressor.metadata_frame(
+                TRAILER.pack(TRAILER_MAGIC, index_offset, index_length)
+            )
+        )
+        return index
+
+    def _end_frame(self):
+        if self.frame is None:
+            return
+        self._emit(self.frame.flush())
+        length = self.offset - self.frame_offset
+        self.section["frames"].append([self.frame_offset, length, self.frame_raw])
+        self.section["bytes"] += length
+        self.frame = None
+
+    def _emit(self, data: bytes):
+        if data:
+            self.writer.write(data)
+            self.offset += len(data)
+
+
+def upload_archive(backup, reader, s3_key: str, before_complete=None) -> dict:
+    """
+    Split a mysqldump stream into sections and upload it as an archive.
+
+    Args:
+        backup: MySQLBackupToS3 instance providing compression and upload
+        reader: Binary file object with mysqldump output
+        s3_key: Destination S3 key
+        before_complete: Optional callable run after EOF and before the
+            upload is completed; raising from it aborts the upload
+
+    Returns:
+        Dict with key, raw_bytes, bytes, etag, upload_stats, head, index,
+        checksums (None without a checksum algorithm) and mirrors (None
+        without mirrors)
+    """
+    s3_uri = f"s3://{backup.s3_bucket}/{s3_key}"
+    writer = backup.open_writer(s3_key, backup.object_args())
+    raw = new_checksum(backup.checksum_algorithm) if backup.checksum_algorithm else None
+    archive = ArchiveWriter(writer, backup.compressor, checksum=raw)
+
+    head = b""
+    try:
+        with writer:
+            # mysqldump writes one statement per line, so markers are whole lines
+            for line in reader:
+                section = section_for_line(line)
+                if section:
+                    archive.start_section(*section)
+                if len(head) < HEAD_SIZE:
+                    head += line[: HEAD_SIZE - len(head)]
+                archive.write(line)
+            index = archive.close()
+
+            if before_complete:
+                before_complete()
+    except ClientError as e:
+        print(f"Error uploading to S3: {e}", file=sys.stderr)
+        raise
+
+    print(
+        f"Upload completed: {s3_uri} ({writer.bytes_written:,} bytes, "
+        f"{len(index['sections'])} section(s))"
+    )
+    print(f"Upload stats: {writer.stats.summary()}")
+    mirrors = None
+    if backup.mirror_destinations:
+        mirrors = writer.results()
+        print_mirror_results(mirrors)
+    checksums = writer.checksums()
+    if checksums:
+        # The index line is part of the decompressed archive
+        checksums.update(raw=raw.value(), raw_bytes=archive.decoded_bytes)
+    return {
+        "key": s3_key,
+        "raw_bytes": archive.raw_bytes,
+        "bytes": writer.bytes_written,
+        "etag": writer.etag,
+        "upload_stats": writer.stats.as_dict(),
+        "head": head,
+        "index": index,
+        "checksums": checksums,
+        "mirrors": mirrors,
+    }
+
+
+def read_archive_index(s3_client, bucket: str, key: str, encryption=None) -> dict:
+    """
+    Fetch the index of an archive with two ranged GETs.
+
+    Offsets in the index refer to the compressed archive; for encrypted
+    archives they are mapped to the encrypted chunks holding them, at the
+    cost of one more GET for the header.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        key: S3 key of the archive
+        encryption: Encryption holding the key of encrypted archives
+
+    Returns:
+        Archive index
+    """
+    compressor = get_compressor(codec_for_key(key))
+    trailer_size = len(compressor.metadata_frame(bytes(TRAILER.size)))
+
+    encryption = object_encryption(key, encryption)
+    if encryption:
+        reader = EncryptedObjectReader(s3_client, bucket, key, encryption)
+        read = reader.read
+        trailer = read(reader.size - trailer_size, reader.size)
+    else:
+
+        def read(start: int, end: int) -> bytes:
+            response = s3_client.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}"
+            )
+            return response["Body"].read()
+
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{trailer_size}")
+        trailer = response["Body"].read()
+    try:
+        magic, index_offset, index_length = TRAILER.unpack(read_metadata_frame(trailer))
+    except (ValueError, struct.error):
+        magic = None
+    if magic != TRAILER_MAGIC:
+        raise ValueError(f"s3://{bucket}/{key} is not a seekable archive")
+
+    data = read(index_offset, index_offset + index_length)
+    line = compressor.decompressobj().decompress(data)
+    return json.loads(line.removeprefix(INDEX_PREFIX))
+
+
+def select_sections(index: dict, names: list) -> list:
+    """
+    Pick the sections needed to restore some tables or views.
+
+    The dump header (session settings) is always included first.
+
+    Args:
+        index: Archive index
+        names: Table, view or object section names
+
+    Returns:
+        Index sections in restore order
+    """
+    by_name = {}
+    for section in index["sections"]:
+        by_name.setdefault(section["name"], []).append(section)
+
+    missing = [name for name in names if name not in by_name]
+    if missing:
+        raise ValueError(f"Not in archive: {', '.join(missing)}")
+
+    selected = list(by_name.get(HEADER_SECTION, []))
+    for name in names:
+        selected.extend(by_name[name])
+    return selected
+
+
+def byte_ranges(sections: list) -> list:
+    """
+    Merge the frames of sections into contiguous byte ranges.
+
+    Args:
+        sections: Index sections
+
+    Returns:
+        List of (offset, length) tuples in archive order
+    """
+    frames = sorted(frame[:2] for section in sections for frame in section["frames"])
+    ranges = []
+    for offset, length in frames:
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
+
+
+def extract_sections(
+    s3_client,
+    bucket: str,
+    key: str,
+    sections: list,
+    writer,
+    chunk_size: int = MiB,
+    encryption=None,
+) -> int:
+    """
+    Download and decompress only the frames of some sections.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        key: S3 key of the archive
+        sections: Sections returned by select_sections()
+        writer: Binary file object receiving the SQL
+        chunk_size: Download chunk size in bytes
+        encryption: Encryption holding the key of encrypted archives
+
+    Returns:
+        Number of SQL bytes written
+    """
+    compressor = get_compressor(codec_for_key(key))
+    encryption = object_encryption(key, encryption)
+    reader = EncryptedObjectReader(s3_client, bucket, key, encryption) if encryption else None
+    written = 0
+    for offset, length in byte_ranges(sections):
+        if reader:
+            chunks = reader.iter_range(offset, offset + length)
+        else:
+            response = s3_client.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + length - 1}"
+            )
+            chunks = response["Body"].iter_chunks(chunk_size)
+        decompressor = compressor.decompressobj()
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            writer.write(data)
+            written += len(data)
+    return written
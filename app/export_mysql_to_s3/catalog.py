@@ -0,0 +1,663 @@
+"""
+Backup catalog
+
+A small SQLite index of every backup of a database, mirrored to S3 at
+`{s3_prefix}/{db_name}/catalog.sqlite` and updated at the end of each
+run. It records when each backup was taken, its mode, size, codec,
+objects with their ETags, the tables it contains and its place in an
+incremental chain, so listing, retention and restore planning do not
+have to page through list_objects_v2. A backup whose object a later run
+overwrote stays in the catalog, marked as superseded by that run.
+
+Updates are read-modify-write with conditional PUTs (If-Match on the
+ETag read, If-None-Match for a new catalog), so concurrent runs retry
+instead of overwriting each other. `rebuild()` recreates the catalog
+from an S3 listing for buckets that predate it.
+"""
+
+import json
+import sqlite3
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+from archive import archive_key
+from compressors import codec_for_key
+from dedup import read_recipe, recipe_key
+from incremental import base_prefix, chain_prefix
+from manifest import RUN_ID_FORMAT, list_run_ids, read_manifest, run_prefix, run_time
+from parquet_export import list_parquet_run_ids, parquet_run_prefix
+
+CATALOG_NAME = "catalog.sqlite"
+
+SCHEMA_VERSION = 3
+
+# Returned by conditional PUTs when another writer got there first
+CONFLICT_ERRORS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+# Modes whose backup is one object overwritten by every run
+SINGLE_OBJECT_MODES = ("file", "stream", "archive")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    uri TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    raw_bytes INTEGER,
+    bytes INTEGER,
+    codec TEXT,
+    compress_level INTEGER,
+    seconds REAL,
+    parent_run_id TEXT,
+    binlog_file TEXT,
+    binlog_position INTEGER,
+    superseded_by TEXT,
+    UNIQUE (run_id, mode)
+);
+CREATE TABLE IF NOT EXISTS objects (
+    backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    name TEXT,
+    kind TEXT,
+    raw_bytes INTEGER,
+    bytes INTEGER,
+    etag TEXT,
+    reused_from TEXT,
+    checksums TEXT
+);
+CREATE TABLE IF NOT EXISTS backup_tables (
+    backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    PRIMARY KEY (backup_id, name)
+);
+CREATE INDEX IF NOT EXISTS backups_created_at ON backups (created_at);
+CREATE INDEX IF NOT EXISTS objects_backup ON objects (backup_id);
+CREATE INDEX IF NOT EXISTS objects_key ON objects (key);
+CREATE INDEX IF NOT EXISTS backup_tables_name ON backup_tables (name);
+"""
+
+# Statements upgrading a catalog from the previous schema version
+MIGRATIONS = {
+    2: "ALTER TABLE objects ADD COLUMN checksums TEXT",
+    3: "ALTER TABLE backups ADD COLUMN superseded_by TEXT",
+}
+
+
+def catalog_key(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key of a database's catalog.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        S3 key
+    """
+    return f"{s3_prefix}/{db_name}/{CATALOG_NAME}"
+
+
+def entry_from_manifest(manifest: dict, uri: str) -> dict:
+    """
+    Build a catalog entry from a tables or parquet mode manifest.
+
+    Args:
+        manifest: Manifest dictionary
+        uri: S3 URI of the manifest
+
+    Returns:
+        Catalog entry
+    """
+    objects = manifest["objects"]
+    dumped = [obj for obj in objects if "reused_from" not in obj]
+    return {
+        "run_id": manifest["run_id"],
+        "mode": manifest["mode"],
+        "kind": "full",
+        "uri": uri,
+        "created_at": manifest["created_at"],
+        "raw_bytes": sum(obj.get("raw_bytes", 0) for obj in dumped),
+        "bytes": sum(obj["bytes"] for obj in dumped),
+        "codec": manifest.get("codec") or manifest.get("compression"),
+        "compress_level": manifest.get("compress_level"),
+        "binlog": manifest.get("binlog"),
+        "objects": objects,
+        "tables": sorted(
+            {obj["name"] for obj in objects if obj["kind"] in ("table", "parquet")}
+        ),
+    }
+
+
+def entry_from_upload(
+    mode: str, run_id: str, result: dict, uri: str, codec: str, compress_level: int = None
+) -> dict:
+    """
+    Build a catalog entry from the result of a single-object upload.
+
+    Args:
+        mode: Pipeline mode ("file", "stream", "archive" or "dedup")
+        run_id: Backup run identifier
+        result: Upload result with key, bytes and optionally raw_bytes,
+            etag, index (archive) or recipe (dedup)
+        uri: S3 URI of the backup
+        codec: Compression codec name
+        compress_level: Compression level
+
+    Returns:
+        Catalog entry
+    """
+    entry = {
+        "run_id": run_id,
+        "mode": mode,
+        "kind": "full",
+        "uri": uri,
+        "created_at": run_time(run_id).isoformat(timespec="seconds"),
+        "raw_bytes": result.get("raw_bytes"),
+        "bytes": result["bytes"],
+        "codec": codec,
+        "compress_level": compress_level,
+        "objects": [
+            {
+                "key": result["key"],
+                "kind": mode,
+                "raw_bytes": result.get("raw_bytes"),
+                "bytes": result["bytes"],
+                "etag": result.get("etag"),
+                "checksums": result.get("checksums"),
+            }
+        ],
+    }
+    if "index" in result:
+        entry["tables"] = sorted(
+            section["name"]
+            for section in result["index"]["sections"]
+            if section["kind"] in ("table", "view")
+        )
+    return entry
+
+
+def entry_from_chain_link(chain: dict, link: dict, uri: str) -> dict:
+    """
+    Build a catalog entry for one incremental link of a chain.
+
+    Args:
+        chain: Chain dictionary
+        link: Entry of chain["incrementals"]
+        uri: S3 URI of the chain manifest
+
+    Returns:
+        Catalog entry
+    """
+    objects = [dict(obj, name=obj["binlog"], kind="binlog") for obj in link["objects"]]
+    return {
+        "run_id": link["run_id"],
+        "mode": "incremental",
+        "kind": "incremental",
+        "uri": uri,
+        "created_at": run_time(link["run_id"]).isoformat(timespec="seconds"),
+        "raw_bytes": sum(obj["raw_bytes"] for obj in objects),
+        "bytes": sum(obj["bytes"] for obj in objects),
+        "parent_run_id": chain["base"]["run_id"],
+        "binlog": link["end"],
+        "objects": objects,
+    }
+
+
+class BackupCatalog:
+    def __init__(
+        self, s3_client, bucket: str, s3_prefix: str, db_name: str, local_dir: Path
+    ):
+        """
+        Initialize catalog.
+
+        Args:
+            s3_client: boto3 S3 client
+            bucket: S3 bucket name
+            s3_prefix: S3 prefix/folder for backups
+            db_name: Database name
+            local_dir: Directory for the local copy of the catalog
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.s3_prefix = s3_prefix
+        self.db_name = db_name
+        self.key = catalog_key(s3_prefix, db_name)
+        self.path = Path(local_dir) / f"{db_name}.{CATALOG_NAME}"
+        self.etag = None
+        self.loaded = False
+
+    def load(self):
+        """
+        Download the catalog, or start an empty one if none exists.
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            self.path.unlink(missing_ok=True)
+            self.etag = None
+        else:
+            self.path.write_bytes(response["Body"].read())
+            self.etag = response["ETag"]
+        self.loaded = True
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open the local copy, creating the schema if needed.
+
+        Returns:
+            sqlite3 connection with dict-like rows
+        """
+        if not self.loaded:
+            self.load()
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys = ON")
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            if version:
+                for number in range(version + 1, SCHEMA_VERSION + 1):
+                    connection.execute(MIGRATIONS[number])
+            else:
+                connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        return connection
+
+    def save(self):
+        """
+        Upload the local copy unless the catalog changed on S3 meanwhile.
+
+        Raises:
+            ClientError: PreconditionFailed if another run updated it
+        """
+        condition = {"IfMatch": self.etag} if self.etag else {"IfNoneMatch": "*"}
+        response = self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=self.path.read_bytes(),
+            ContentType="application/vnd.sqlite3",
+            **condition,
+        )
+        self.etag = response["ETag"]
+
+    def update(self, apply, attempts: int = 5):
+        """
+        Apply a change and upload it, retrying on concurrent updates.
+
+        Args:
+            apply: Callable taking an sqlite3 connection
+            attempts: Read-modify-write attempts before giving up
+        """
+        for attempt in range(1, attempts + 1):
+            self.load()
+            connection = self.connect()
+            try:
+                with connection:
+                    apply(connection)
+            finally:
+                connection.close()
+            try:
+                self.save()
+                return
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in CONFLICT_ERRORS:
+                    raise
+                if attempt == attempts:
+                    raise
+                print(f"Catalog changed on S3 during update, retrying ({attempt}/{attempts})")
+
+    def record(self, entry: dict):
+        """
+        Add or replace one backup.
+
+        Args:
+            entry: Catalog entry (see entry_from_manifest and friends)
+        """
+        self.update(lambda connection: self.insert(connection, entry))
+        print(f"Catalog updated: s3://{self.bucket}/{self.key}")
+
+    def insert(self, connection, entry: dict):
+        """
+        Write one backup into an open catalog.
+
+        Earlier backups of single-object modes point at the object this
+        one overwrote, so they are marked as superseded by it.
+
+        Args:
+            connection: sqlite3 connection from connect()
+            entry: Catalog entry
+        """
+        connection.execute(
+            "DELETE FROM backups WHERE run_id = ? AND mode = ?",
+            (entry["run_id"], entry["mode"]),
+        )
+        if entry["mode"] in SINGLE_OBJECT_MODES:
+            connection.execute(
+                "UPDATE backups SET superseded_by = ? WHERE uri = ? AND superseded_by IS NULL",
+                (entry["run_id"], entry["uri"]),
+            )
+
+        binlog = entry.get("binlog") or {}
+        cursor = connection.execute(
+            """
+            INSERT INTO backups (
+                run_id, mode, kind, uri, created_at, raw_bytes, bytes, codec,
+                compress_level, seconds, parent_run_id, binlog_file, binlog_position
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                entry["run_id"],
+                entry["mode"],
+                entry["kind"],
+                entry["uri"],
+                entry.get("created_at") or datetime.now().isoformat(timespec="seconds"),
+                entry.get("raw_bytes"),
+                entry.get("bytes"),
+                entry.get("codec"),
+                entry.get("compress_level"),
+                entry.get("seconds"),
+                entry.get("parent_run_id"),
+                binlog.get("file"),
+                binlog.get("position"),
+            ),
+        )
+        backup_id = cursor.lastrowid
+        connection.executemany(
+            """
+            INSERT INTO objects (
+                backup_id, key, name, kind, raw_bytes, bytes, etag, reused_from, checksums
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    backup_id,
+                    obj["key"],
+                    obj.get("name"),
+                    obj.get("kind"),
+                    obj.get("raw_bytes"),
+                    obj.get("bytes"),
+                    obj.get("etag"),
+                    obj.get("reused_from"),
+                    json.dumps(obj["checksums"]) if obj.get("checksums") else None,
+                )
+                for obj in entry.get("objects", [])
+            ],
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO backup_tables (backup_id, name) VALUES (?, ?)",
+            [(backup_id, name) for name in entry.get("tables") or []],
+        )
+
+    def backups(self, mode: str = None, table: str = None, before: str = None) -> list:
+        """
+        List backups, newest first.
+
+        Args:
+            mode: Only backups of this pipeline mode
+            table: Only backups containing this table
+            before: Only backups with a run_id at or before this one
+
+        Returns:
+            List of dicts with the backups columns plus table_count
+        """
+        conditions = []
+        params = []
+        if mode:
+            conditions.append("b.mode = ?")
+            params.append(mode)
+        if table:
+            conditions.append("b.id IN (SELECT backup_id FROM backup_tables WHERE name = ?)")
+            params.append(table)
+        if before:
+            conditions.append("b.run_id <= ?")
+            params.append(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                f"""
+                SELECT b.*, (SELECT COUNT(*) FROM backup_tables t WHERE t.backup_id = b.id)
+                       AS table_count
+                FROM backups b {where}
+                ORDER BY b.run_id DESC, b.id DESC
+                """,
+                params,
+            ).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            connection.close()
+
+    def latest(self, mode: str, before: str = None) -> dict:
+        """
+        Find the newest backup of a mode whose objects still exist.
+
+        Args:
+            mode: Pipeline mode
+            before: Only consider run_ids at or before this one
+
+        Returns:
+            Backup dict, or None if the catalog has none
+        """
+        for backup in self.backups(mode=mode, before=before):
+            if not backup["superseded_by"]:
+                return backup
+        return None
+
+    def latest_chain_base(self, before: str = None) -> dict:
+        """
+        Find the newest full backup that starts an incremental chain.
+
+        A superseded base is returned too, so restore can refuse its chain
+        instead of falling back to an older one.
+
+        Args:
+            before: Only consider run_ids at or before this one
+
+        Returns:
+            Backup dict, or None if the catalog has none
+        """
+        for backup in self.backups(before=before):
+            if backup["kind"] == "full" and backup["binlog_file"]:
+                return backup
+        return None
+
+    def entries(self) -> list:
+        """
+        Read every backup with its objects.
+
+        Returns:
+            List of dicts with the backups columns, binlog and objects,
+            oldest first
+        """
+        connection = self.connect()
+        try:
+            objects = {}
+            for row in connection.execute("SELECT * FROM objects"):
+                obj = dict(row)
+                obj["checksums"] = json.loads(obj["checksums"]) if obj["checksums"] else None
+                objects.setdefault(row["backup_id"], []).append(obj)
+            entries = []
+            for row in connection.execute("SELECT * FROM backups ORDER BY run_id, id"):
+                entry = dict(row)
+                entry["objects"] = objects.get(entry["id"], [])
+                if entry["binlog_file"]:
+                    entry["binlog"] = {
+                        "file": entry["binlog_file"],
+                        "position": entry["binlog_position"],
+                    }
+                entries.append(entry)
+            return entries
+        finally:
+            connection.close()
+
+    def remove(self, entries: list):
+        """
+        Drop backups from the catalog.
+
+        Args:
+            entries: Entries with run_id and mode
+        """
+        self.update(
+            lambda connection: connection.executemany(
+                "DELETE FROM backups WHERE run_id = ? AND mode = ?",
+                [(entry["run_id"], entry["mode"]) for entry in entries],
+            )
+        )
+
+    def rebuild(self, backup) -> int:
+        """
+        Recreate the catalog from an S3 listing of the database prefix.
+
+        Args:
+            backup: MySQLBackupToS3 instance (S3 location and codec)
+
+        Returns:
+            Number of backups recorded
+        """
+        entries = scan_backups(backup)
+
+        def apply(connection):
+            connection.execute("DELETE FROM backups")
+            for entry in entries:
+                self.insert(connection, entry)
+
+        self.update(apply)
+        print(f"Catalog rebuilt with {len(entries)} backup(s): s3://{self.bucket}/{self.key}")
+        return len(entries)
+
+
+def scan_backups(backup) -> list:
+    """
+    Find all backups of a database by listing S3.
+
+    Args:
+        backup: MySQLBackupToS3 instance (S3 location and codec)
+
+    Returns:
+        Catalog entries
+    """
+    s3 = backup.s3_client
+    bucket = backup.s3_bucket
+    db_name = backup.db_name
+    entries = []
+
+    for run_id in list_run_ids(s3, bucket, backup.s3_prefix, db_name, complete=True):
+        prefix = run_prefix(backup.s3_prefix, db_name, run_id)
+        manifest = read_manifest(s3, bucket, prefix)
+        entries.append(entry_from_manifest(manifest, f"s3://{bucket}/{prefix}/manifest.json"))
+
+    for run_id in list_parquet_run_ids(s3, bucket, backup.s3_prefix, db_name):
+        prefix = parquet_run_prefix(backup.s3_prefix, db_name, run_id)
+        manifest = read_manifest(s3, bucket, prefix)
+        entries.append(entry_from_manifest(manifest, f"s3://{bucket}/{prefix}/manifest.json"))
+
+    recipes_prefix = recipe_key(backup.s3_prefix, db_name, "").removesuffix(".json")
+    for key in list_keys(s3, bucket, recipes_prefix):
+        recipe = read_recipe(s3, bucket, key)
+        result = {"key": key, "raw_bytes": recipe["raw_bytes"], "bytes": recipe["new_bytes"]}
+        entries.append(
+            entry_from_upload(
+                "dedup", recipe["run_id"], result, f"s3://{bucket}/{key}", recipe["codec"]
+            )
+        )
+
+    def single_object(mode: str, key: str, run_id: str = None):
+        try:
+            head = s3.head_object(Bucket=bucket, Key=key)
+        except ClientError:
+            return
+        run_id = run_id or head["LastModified"].astimezone().strftime(RUN_ID_FORMAT)
+        result = {"key": key, "bytes": head["ContentLength"], "etag": head["ETag"]}
+        metadata = head.get("Metadata", {})
+        level = metadata.get("compress-level")
+        entries.append(
+            entry_from_upload(
+                mode,
+                run_id,
+                result,
+                f"s3://{bucket}/{key}",
+                metadata.get("codec", codec_for_key(key)),
+                int(level) if level and level != "None" else None,
+            )
+        )
+
+    # Single-object backups: only the latest survives, dated by LastModified
+    for extension in (".gz", ".zst", ".gz.enc", ".zst.enc"):
+        single_object("file", f"{backup.s3_prefix}/{db_name}.sql{extension}")
+        single_object("archive", archive_key(backup.s3_prefix, db_name, extension))
+
+    # Chain bases written to per-run keys
+    for key in list_keys(s3, bucket, base_prefix(backup.s3_prefix, db_name) + "/"):
+        run_id = key.rsplit("/", 2)[-2]
+        single_object("archive" if ".archive.sql" in key else "file", key, run_id)
+
+    # Chains: binlog coordinates of their base and one entry per incremental
+    bases = {}
+    for key in list_keys(s3, bucket, chain_prefix(backup.s3_prefix, db_name) + "/"):
+        chain = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+        bases[chain["base"]["uri"]] = chain["base"]
+        for link in chain["incrementals"]:
+            entries.append(entry_from_chain_link(chain, link, f"s3://{bucket}/{key}"))
+    for entry in entries:
+        base = bases.get(entry["uri"])
+        if not base or entry["kind"] != "full":
+            continue
+        if entry["mode"] in SINGLE_OBJECT_MODES:
+            if base.get("etag") != entry["objects"][0]["etag"]:
+                # The object was overwritten by a later run
+                continue
+            # file and stream mode write the same key
+            entry["mode"] = base["mode"]
+        entry["binlog"] = base["binlog"]
+        entry["run_id"] = base["run_id"]
+    return entries
+
+
+def list_keys(s3_client, bucket: str, prefix: str) -> list:
+    """
+    List all object keys under a prefix.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        prefix: Key prefix
+
+    Returns:
+        Sorted list of keys
+    """
+    keys = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return sorted(keys)
+
+
+def print_backups(backups: list, file=sys.stdout):
+    """
+    Print catalog backups as a table.
+
+    Args:
+        backups: Rows returned by BackupCatalog.backups()
+        file: Output stream
+    """
+    print(
+        f"{'RUN ID':<16} {'MODE':<12} {'KIND':<12} {'BYTES':>15} {'TABLES':>6}  URI",
+        file=file,
+    )
+    for backup in backups:
+        size = f"{backup['bytes']:,}" if backup["bytes"] is not None else "-"
+        superseded = ""
+        if backup.get("superseded_by"):
+            superseded = f"  (superseded by {backup['superseded_by']})"
+        print(
+            f"{backup['run_id']:<16} {backup['mode']:<12} {backup['kind']:<12} "
+            f"{size:>15} {backup['table_count']:>6}  {backup['uri']}{superseded}",
+            file=file,
+        )
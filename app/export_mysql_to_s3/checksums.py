@@ -0,0 +1,113 @@
+"""
+Streaming checksums
+
+Checksums are computed while bytes move through the pipeline: over the
+uncompressed dump ("raw"), over the compressed object as stored on S3
+("stored") and over every uploaded part. Part and object checksums are
+sent as S3 additional checksums, so S3 rejects a part or object that
+arrives corrupted; raw and stored are recorded in the manifest and the
+catalog for the verify command.
+
+Algorithms:
+  sha256 - hashlib; S3 checks every part and a checksum of the part
+           checksums (COMPOSITE)
+  crc32c - much cheaper; S3 checks every part and the whole object
+           (FULL_OBJECT). Requires the awscrt package (pip install
+           boto3[crt])
+
+Values are base64 encoded, as S3 reports them.
+"""
+
+import base64
+import hashlib
+
+try:
+    from awscrt import checksums as crt_checksums
+except ImportError:
+    crt_checksums = None
+
+CHECKSUM_ALGORITHMS = ("none", "sha256", "crc32c")
+
+# S3 name of each algorithm and how S3 checksums multipart objects
+S3_ALGORITHMS = {"sha256": "SHA256", "crc32c": "CRC32C"}
+S3_CHECKSUM_TYPES = {"sha256": "COMPOSITE", "crc32c": "FULL_OBJECT"}
+
+
+class Sha256Checksum:
+    name = "sha256"
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+
+    def digest(self) -> bytes:
+        return self._hash.digest()
+
+    def value(self) -> str:
+        """
+        Base64 encoded digest, as used by S3.
+        """
+        return base64.b64encode(self.digest()).decode()
+
+
+class Crc32cChecksum(Sha256Checksum):
+    name = "crc32c"
+
+    def __init__(self):
+        if crt_checksums is None:
+            raise RuntimeError("awscrt package is required for CRC32C checksums")
+        self._crc = 0
+
+    def update(self, data: bytes):
+        self._crc = crt_checksums.crc32c(data, self._crc)
+
+    def digest(self) -> bytes:
+        return self._crc.to_bytes(4, "big")
+
+
+def new_checksum(algorithm: str):
+    """
+    Create a streaming checksum by algorithm name.
+
+    Args:
+        algorithm: "sha256" or "crc32c"
+
+    Returns:
+        Checksum object with update(data), digest() and value()
+    """
+    if algorithm == "sha256":
+        return Sha256Checksum()
+    if algorithm == "crc32c":
+        return Crc32cChecksum()
+    raise ValueError(f"Unknown checksum algorithm: {algorithm}")
+
+
+def checksum_of(algorithm: str, data: bytes) -> str:
+    """
+    Checksum a byte string in one go.
+
+    Args:
+        algorithm: "sha256" or "crc32c"
+        data: Bytes to checksum
+
+    Returns:
+        Base64 encoded checksum
+    """
+    checksum = new_checksum(algorithm)
+    checksum.update(data)
+    return checksum.value()
+
+
+def s3_argument(algorithm: str) -> str:
+    """
+    Name of the request argument carrying a checksum value.
+
+    Args:
+        algorithm: "sha256" or "crc32c"
+
+    Returns:
+        "ChecksumSHA256" or "ChecksumCRC32C"
+    """
+    return "Checksum" + S3_ALGORITHMS[algorithm]
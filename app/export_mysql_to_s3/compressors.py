@@ -0,0 +1,398 @@
+"""
+Compression backends for backup pipelines
+
+Every backend exposes compressobj() returning an object with
+compress(data) -> bytes and flush() -> bytes, so the same code path
+serves file compression and streaming uploads. decompressobj() returns
+the matching streaming decompressor used by restores. metadata_frame()
+wraps bytes in a frame that decompressors skip, for in-band indexes.
+
+Codecs:
+  gzip  - single-threaded zlib, standard .gz
+  pgzip - block-parallel deflate in the style of pigz; still one
+          standard .gz member readable by gunzip
+  zstd  - multithreaded Zstandard (requires the zstandard package),
+          optionally with a trained dictionary
+"""
+
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ("gzip", "pgzip", "zstd")
+
+MiB = 1024 * 1024
+
+# Deflate back-reference window; pgzip primes each block with this much
+# of the preceding input so ratio stays close to serial gzip
+DEFLATE_WINDOW = 32 * 1024
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# Empty gzip member carrying its payload in the FEXTRA header field
+GZIP_EXTRA_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff"
+GZIP_EXTRA_ID = b"SQ"
+GZIP_EMPTY_MEMBER = b"\x03\x00" + struct.pack("<II", 0, 0)
+
+# Zstandard skippable frame magic number (0x184D2A50-0x184D2A5F)
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+
+class Compressor:
+    name = ""
+    extension = ""
+    content_type = "application/octet-stream"
+    default_level = 0
+
+    def __init__(self, level: int = None):
+        """
+        Initialize compressor.
+
+        Args:
+            level: Compression level (codec default when None)
+        """
+        self.level = self.default_level if level is None else level
+
+    def compressobj(self):
+        """
+        Create a streaming compression object.
+
+        Returns:
+            Object with compress(data) -> bytes and flush() -> bytes
+        """
+        raise NotImplementedError
+
+    def decompressobj(self):
+        """
+        Create a streaming decompression object.
+
+        Returns:
+            Object with decompress(data) -> bytes
+        """
+        raise NotImplementedError
+
+    def metadata_frame(self, payload: bytes) -> bytes:
+        """
+        Wrap bytes in a frame that decompresses to nothing.
+
+        Args:
+            payload: Bytes to embed (at most 64 KiB minus a few bytes)
+
+        Returns:
+            Frame that can be appended between compressed frames
+        """
+        raise NotImplementedError
+
+    def compress_file(self, src: Path, dst: Path, chunk_size: int = MiB) -> int:
+        """
+        Compress a file.
+
+        Args:
+            src: Source file path
+            dst: Destination file path
+            chunk_size: Read size in bytes
+
+        Returns:
+            Size of the compressed file in bytes
+        """
+        obj = self.compressobj()
+        written = 0
+        with open(src, "rb") as fin, open(dst, "wb") as fout:
+            while chunk := fin.read(chunk_size):
+                written += fout.write(obj.compress(chunk))
+            written += fout.write(obj.flush())
+        return written
+
+    def metadata(self) -> dict:
+        """
+        S3 object metadata recording the codec.
+
+        Returns:
+            Dict for the Metadata upload argument
+        """
+        return {"codec": self.name, "compress-level": str(self.level)}
+
+    def s3_extra_args(self) -> dict:
+        """
+        Extra upload arguments for objects written by this compressor.
+
+        Returns:
+            Dict with Metadata and ContentType
+        """
+        return {"Metadata": self.metadata(), "ContentType": self.content_type}
+
+
+class GzipCompressor(Compressor):
+    name = "gzip"
+    extension = ".gz"
+    content_type = "application/gzip"
+    default_level = 6
+
+    def compressobj(self):
+        # wbits=31 selects the gzip container format
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def decompressobj(self):
+        return _MultiMemberDecompressor(lambda: zlib.decompressobj(31))
+
+    def metadata_frame(self, payload: bytes) -> bytes:
+        return _gzip_extra_member(payload)
+
+
+class ParallelGzipCompressor(Compressor):
+    name = "pgzip"
+    extension = ".gz"
+    content_type = "application/gzip"
+    default_level = 6
+
+    def __init__(self, level: int = None, threads: int = None, block_size: int = MiB):
+        """
+        Initialize block-parallel gzip compressor.
+
+        Args:
+            level: Compression level (1-9)
+            threads: Worker threads (CPU count when None)
+            block_size: Uncompressed bytes per block
+        """
+        super().__init__(level)
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+
+    def compressobj(self):
+        return _ParallelGzipStream(self.level, self.threads, self.block_size)
+
+    def decompressobj(self):
+        return _MultiMemberDecompressor(lambda: zlib.decompressobj(31))
+
+    def metadata_frame(self, payload: bytes) -> bytes:
+        return _gzip_extra_member(payload)
+
+    def metadata(self) -> dict:
+        metadata = super().metadata()
+        metadata["compress-threads"] = str(self.threads)
+        return metadata
+
+
+class _ParallelGzipStream:
+    """
+    Streaming state of ParallelGzipCompressor.
+
+    Blocks are raw deflate streams ending in a sync flush, so their
+    concatenation is one valid deflate stream; the final block is
+    finished normally and the gzip trailer is appended in order.
+    """
+
+    def __init__(self, level: int, threads: int, block_size: int):
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = threads * 2
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.previous_tail = b""
+        self.crc = 0
+        self.size = 0
+        self.header_sent = False
+
+    def compress(self, data: bytes) -> bytes:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block, final=False)
+        return self._collect(wait=len(self.pending) >= self.max_pending)
+
+    def flush(self) -> bytes:
+        self._submit(bytes(self.buffer), final=True)
+        self.buffer = bytearray()
+        output = self._collect(wait=True, drain=True)
+        self.executor.shutdown(wait=True)
+        return output + struct.pack("<II", self.crc & 0xFFFFFFFF, self.size & 0xFFFFFFFF)
+
+    def _submit(self, block: bytes, final: bool):
+        future = self.executor.submit(
+            _deflate_block, block, self.previous_tail, self.level, final
+        )
+        self.pending.append((future, block))
+        self.previous_tail = block[-DEFLATE_WINDOW:]
+
+    def _collect(self, wait: bool, drain: bool = False) -> bytes:
+        output = []
+        if not self.header_sent:
+            output.append(GZIP_HEADER)
+            self.header_sent = True
+
+        while self.pending:
+            future, block = self.pending[0]
+            if not future.done():
+                if drain or (wait and len(self.pending) >= self.max_pending):
+                    future.result()
+                else:
+                    break
+            self.pending.popleft()
+            output.append(future.result())
+            self.crc = zlib.crc32(block, self.crc)
+            self.size += len(block)
+        return b"".join(output)
+
+
+class _MultiMemberDecompressor:
+    """
+    Decompress concatenated gzip members or zstd frames as one stream.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+        self.eof = False
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        while data:
+            # eof: the input so far ends exactly after a member or frame
+            self.eof = False
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            self.eof = True
+            data = self.decompressor.unused_data
+            self.decompressor = self.factory()
+        return b"".join(output)
+
+
+def _gzip_extra_member(payload: bytes) -> bytes:
+    extra = GZIP_EXTRA_ID + struct.pack("<H", len(payload)) + payload
+    return GZIP_EXTRA_HEADER + struct.pack("<H", len(extra)) + extra + GZIP_EMPTY_MEMBER
+
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, final: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    output = compressor.compress(block)
+    return output + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ZstdCompressor(Compressor):
+    name = "zstd"
+    extension = ".zst"
+    content_type = "application/zstd"
+    default_level = 3
+
+    def __init__(self, level: int = None, threads: int = None, dictionary: bytes = None):
+        """
+        Initialize multithreaded Zstandard compressor.
+
+        Args:
+            level: Compression level (1-22)
+            threads: Worker threads (CPU count when None)
+            dictionary: Trained dictionary to compress and decompress with
+        """
+        if zstandard is None:
+            raise RuntimeError("zstandard package is required for zstd compression")
+        super().__init__(level)
+        self.threads = threads or os.cpu_count() or 1
+        self.dictionary = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+
+    def with_dictionary(self, dictionary: bytes):
+        """
+        Create a compressor with the same settings using a dictionary.
+
+        Args:
+            dictionary: Trained dictionary bytes
+
+        Returns:
+            ZstdCompressor instance
+        """
+        return ZstdCompressor(self.level, self.threads, dictionary)
+
+    def compressobj(self):
+        compressor = zstandard.ZstdCompressor(
+            level=self.level, threads=self.threads, dict_data=self.dictionary
+        )
+        return compressor.compressobj()
+
+    def decompressobj(self):
+        decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+        return _MultiMemberDecompressor(decompressor.decompressobj)
+
+    def metadata_frame(self, payload: bytes) -> bytes:
+        return struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(payload)) + payload
+
+    def metadata(self) -> dict:
+        metadata = super().metadata()
+        metadata["compress-threads"] = str(self.threads)
+        if self.dictionary:
+            metadata["zstd-dictionary"] = str(self.dictionary.dict_id())
+        return metadata
+
+
+def read_metadata_frame(frame: bytes) -> bytes:
+    """
+    Extract the payload of a frame built by Compressor.metadata_frame().
+
+    Args:
+        frame: Frame bytes, as they appear in the compressed stream
+
+    Returns:
+        Embedded payload
+    """
+    if frame.startswith(GZIP_EXTRA_HEADER):
+        extra_id, length = struct.unpack_from("<2sH", frame, len(GZIP_EXTRA_HEADER) + 2)
+        start = len(GZIP_EXTRA_HEADER) + 6
+        if extra_id == GZIP_EXTRA_ID:
+            return frame[start : start + length]
+    elif len(frame) >= 8:
+        magic, length = struct.unpack_from("<II", frame)
+        if magic == ZSTD_SKIPPABLE_MAGIC:
+            return frame[8 : 8 + length]
+    raise ValueError("Not a metadata frame")
+
+
+def codec_for_key(key: str) -> str:
+    """
+    Guess the codec of an object from its key.
+
+    Args:
+        key: S3 key or file name
+
+    Returns:
+        Codec name ("gzip" for .gz, "zstd" for .zst)
+    """
+    # Encrypted objects append ".enc" to the codec extension (see encryption)
+    key = key.removesuffix(".enc")
+    if key.endswith(".zst"):
+        return "zstd"
+    if key.endswith(".gz"):
+        return "gzip"
+    raise ValueError(f"Cannot determine compression codec of {key}")
+
+
+def get_compressor(codec: str = "gzip", level: int = None, threads: int = None) -> Compressor:
+    """
+    Create a compressor by codec name.
+
+    Args:
+        codec: One of CODECS
+        level: Compression level (codec default when None)
+        threads: Worker threads for multithreaded codecs
+
+    Returns:
+        Compressor instance
+    """
+    if codec == "gzip":
+        return GzipCompressor(level)
+    if codec == "pgzip":
+        return ParallelGzipCompressor(level, threads)
+    if codec == "zstd":
+        return ZstdCompressor(level, threads)
+    raise ValueError(f"Unknown compression codec: {codec}")
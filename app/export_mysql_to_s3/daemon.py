@@ -0,0 +1,403 @@
+"""
+Backup daemon
+
+Runs scheduled backups from one long-lived process instead of starting
+main.py from cron for every backup. boto3 is imported once and a single
+S3 client, with its connection pool and resolved credentials, is shared
+by every run (mirror clients are kept per region, see tee).
+
+Jobs are read from a JSON file with cron schedules:
+
+  {
+    "jobs": [
+      {"name": "hourly", "schedule": "0 * * * *", "targets": "shop,crm@db2",
+       "config": {"backup_mode": "stream"}},
+      {"name": "nightly", "schedule": "30 2 * * *", "targets": "shop",
+       "jobs": 2, "config": {"backup_mode": "tables", "track_binlog": true}}
+    ]
+  }
+
+  schedule - five cron fields (minute hour day month weekday, local time)
+             with *, lists, ranges and steps, or @hourly, @daily,
+             @weekly, @monthly
+  targets  - as BACKUP_TARGETS (default: DB_NAME on DB_HOST), run by a
+             BackupScheduler with jobs / jobs_per_host
+  config   - MySQLBackupToS3 arguments overriding those from the
+             environment
+
+A job that is still running when it is due again skips that run. A
+local HTTP endpoint returns the state of every job as JSON: schedule,
+next run, and the start, duration, bytes and throughput of the last run
+of each of its databases.
+"""
+
+import json
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from botocore.config import Config
+
+from scheduler import BackupScheduler, parse_targets
+
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+}
+
+# (minimum, maximum) of minute, hour, day of month, month, day of week
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# Give up looking for the next run of a schedule that never matches
+MAX_SEARCH_DAYS = 5 * 366
+
+
+def parse_cron_field(value: str, minimum: int, maximum: int) -> set:
+    """
+    Parse one cron field.
+
+    Args:
+        value: Field such as "*", "5", "1-5", "*/15", "5/15" or "0,30"
+        minimum: Lowest allowed value
+        maximum: Highest allowed value
+
+    Returns:
+        Set of matching values
+    """
+    values = set()
+    for item in value.split(","):
+        spec, _, step = item.partition("/")
+        if spec == "*":
+            start, end = minimum, maximum
+        elif "-" in spec:
+            start, end = (int(part) for part in spec.split("-", 1))
+        else:
+            # "N/step" runs from N to the end of the range
+            start = int(spec)
+            end = maximum if step else start
+        step = int(step) if step else 1
+        if not minimum <= start <= end <= maximum or step < 1:
+            raise ValueError(f"Invalid cron field: {value}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    def __init__(self, expression: str):
+        """
+        Parse a cron schedule.
+
+        Args:
+            expression: Five cron fields or an @alias
+        """
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron schedule needs five fields: {expression}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(field, *limits) for field, limits in zip(fields, CRON_FIELDS)
+        )
+        # 0 and 7 are both Sunday; datetime counts Monday as 0
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        # As in cron, day of month and day of week match either when both are
+        # restricted; a field starting with "*" (also "*/2") is not
+        self.any_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+
+    def day_matches(self, when: datetime) -> bool:
+        day = when.day in self.days
+        weekday = when.weekday() in self.weekdays
+        return day or weekday if self.any_day else day and weekday
+
+    def next_after(self, when: datetime) -> datetime:
+        """
+        Find the next time the schedule fires.
+
+        Args:
+            when: Start time (exclusive)
+
+        Returns:
+            First matching minute after when
+        """
+        when = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=MAX_SEARCH_DAYS)
+        while when < limit:
+            if when.month not in self.months or not self.day_matches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError(f"Cron schedule never fires: {self.expression}")
+
+
+def load_jobs(path: str, base_config: dict, jobs: int = 4, jobs_per_host: int = 1) -> list:
+    """
+    Read the daemon's job file.
+
+    Args:
+        path: JSON file (see module docstring)
+        base_config: MySQLBackupToS3 arguments from the environment
+        jobs: Backups a job runs at once unless it sets "jobs"
+        jobs_per_host: Backups per host unless a job sets "jobs_per_host"
+
+    Returns:
+        List of job dicts with name, schedule (CronSchedule), targets,
+        config, jobs and jobs_per_host
+    """
+    with open(path) as f:
+        document = json.load(f)
+
+    loaded = []
+    for index, item in enumerate(document.get("jobs", [])):
+        name = item.get("name") or f"job{index + 1}"
+        overrides = item.get("config", {})
+        unknown = sorted(set(overrides) - set(base_config))
+        if unknown:
+            raise ValueError(f"Unknown config key(s) in job {name}: {', '.join(unknown)}")
+        config = dict(base_config, **overrides)
+        targets = parse_targets(item.get("targets") or config["db_name"], config["db_host"])
+        if not targets:
+            raise ValueError(f"Job {name} has no targets")
+        loaded.append(
+            {
+                "name": name,
+                "schedule": CronSchedule(item["schedule"]),
+                "targets": targets,
+                "config": config,
+                "jobs": item.get("jobs", jobs),
+                "jobs_per_host": item.get("jobs_per_host", jobs_per_host),
+            }
+        )
+    if not loaded:
+        raise ValueError(f"No jobs in {path}")
+    if len({job["name"] for job in loaded}) != len(loaded):
+        raise ValueError(f"Duplicate job names in {path}")
+    return loaded
+
+
+def parse_address(value: str) -> tuple:
+    """
+    Parse a status endpoint address.
+
+    Args:
+        value: "host:port" or "port"
+
+    Returns:
+        Tuple of (host, port); host defaults to 127.0.0.1
+    """
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class BackupDaemon:
+    def __init__(self, backup_class, jobs: list, status_address: tuple = None):
+        """
+        Initialize the daemon.
+
+        Args:
+            backup_class: MySQLBackupToS3
+            jobs: Jobs returned by load_jobs()
+            status_address: (host, port) of the status endpoint, None to
+                disable it
+        """
+        self.backup_class = backup_class
+        self.jobs = jobs
+        self.status_address = status_address
+        self.started_at = datetime.now()
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.state = {
+            job["name"]: {
+                "next_run": None,
+                "running": None,
+                "runs": 0,
+                "failures": 0,
+                "skipped": 0,
+                "last_run": None,
+            }
+            for job in jobs
+        }
+        self.threads = {}
+        self.server = None
+        # Shared by every run, so connections and credentials stay warm
+        connections = sum(
+            job["jobs"] * job["config"].get("upload_concurrency", 10) for job in jobs
+        )
+        self.s3_client = boto3.client(
+            "s3", config=Config(max_pool_connections=connections + 10)
+        )
+
+    def run_job(self, job: dict):
+        """
+        Run every backup of a job and record the outcome.
+
+        Args:
+            job: Job dict from load_jobs()
+        """
+        state = self.state[job["name"]]
+        started = time.monotonic()
+        try:
+            finished = BackupScheduler(
+                self.backup_class,
+                job["config"],
+                job["targets"],
+                jobs=job["jobs"],
+                jobs_per_host=job["jobs_per_host"],
+                s3_client=self.s3_client,
+            ).run()
+            error = None
+        except Exception as e:
+            print(f"Job {job['name']} failed: {e}", file=sys.stderr)
+            finished = []
+            error = str(e)
+        seconds = time.monotonic() - started
+
+        backups = [
+            {
+                "db_name": backup["db_name"],
+                "host": backup["host"],
+                "seconds": round(backup["seconds"], 3),
+                "uri": backup.get("uri"),
+                "raw_bytes": backup.get("raw_bytes"),
+                "bytes": backup.get("bytes"),
+                "bytes_per_second": round(backup["bytes"] / backup["seconds"])
+                if backup.get("bytes") and backup["seconds"]
+                else None,
+                "raw_bytes_per_second": round(backup["raw_bytes"] / backup["seconds"])
+                if backup.get("raw_bytes") and backup["seconds"]
+                else None,
+                "error": backup.get("error"),
+            }
+            for backup in finished
+        ]
+        failed = error is not None or any(backup["error"] for backup in backups)
+        with self.lock:
+            state["last_run"] = {
+                "started_at": state["running"],
+                "finished_at": datetime.now().isoformat(timespec="seconds"),
+                "seconds": round(seconds, 3),
+                "status": "failed" if failed else "ok",
+                "error": error,
+                "bytes": sum(backup["bytes"] or 0 for backup in backups),
+                "backups": backups,
+            }
+            state["running"] = None
+            state["runs"] += 1
+            if failed:
+                state["failures"] += 1
+
+    def start_job(self, job: dict):
+        """
+        Start a due job in its own thread, unless it is still running.
+
+        Args:
+            job: Job dict from load_jobs()
+        """
+        state = self.state[job["name"]]
+        with self.lock:
+            if state["running"]:
+                state["skipped"] += 1
+                print(f"Job {job['name']} still running since {state['running']}; skipped")
+                return
+            state["running"] = datetime.now().isoformat(timespec="seconds")
+        print(f"Starting job {job['name']} ({len(job['targets'])} database(s))")
+        thread = threading.Thread(target=self.run_job, args=(job,), name=job["name"])
+        self.threads[job["name"]] = thread
+        thread.start()
+
+    def status(self) -> dict:
+        """
+        Current state of the daemon.
+
+        Returns:
+            Dict with started_at and jobs (name, schedule, targets,
+            next_run, running, runs, failures, skipped and last_run)
+        """
+        with self.lock:
+            return {
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "jobs": [
+                    {
+                        "name": job["name"],
+                        "schedule": job["schedule"].expression,
+                        "targets": [f"{db_name}@{host}" for host, db_name in job["targets"]],
+                        **self.state[job["name"]],
+                    }
+                    for job in self.jobs
+                ],
+            }
+
+    def serve_status(self):
+        """
+        Start the status endpoint in a background thread.
+        """
+        daemon = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/status"):
+                    self.send_error(404)
+                    return
+                body = json.dumps(daemon.status(), indent=2).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(self.status_address, StatusHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address[:2]
+        print(f"Status endpoint: http://{host}:{port}/status")
+
+    def stop(self, *_):
+        """
+        Stop scheduling; running jobs are allowed to finish.
+        """
+        self.stop_event.set()
+
+    def run(self):
+        """
+        Run jobs on their schedules until SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if self.status_address:
+            self.serve_status()
+
+        now = datetime.now()
+        due = {job["name"]: job["schedule"].next_after(now) for job in self.jobs}
+        for job in self.jobs:
+            name = job["name"]
+            print(f"Job {name} ({job['schedule'].expression}): next run {due[name]}")
+
+        while not self.stop_event.is_set():
+            with self.lock:
+                for name, when in due.items():
+                    self.state[name]["next_run"] = when.isoformat(timespec="seconds")
+            self.stop_event.wait(max(0, (min(due.values()) - datetime.now()).total_seconds()))
+            if self.stop_event.is_set():
+                break
+            now = datetime.now()
+            for job in self.jobs:
+                if due[job["name"]] <= now:
+                    self.start_job(job)
+                    due[job["name"]] = job["schedule"].next_after(now)
+
+        print("Stopping; waiting for running jobs")
+        for thread in self.threads.values():
+            thread.join()
+        if self.server:
+            self.server.shutdown()
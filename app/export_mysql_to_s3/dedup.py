@@ -0,0 +1,470 @@
+"""
+Content-defined chunk deduplication
+
+The dump stream is cut into chunks at content-defined boundaries, so an
+insert or update only changes the chunks around it and the rest of the
+dump produces the same chunks as the day before. Every chunk is stored
+once, compressed, under the SHA-256 of its content:
+
+    {s3_prefix}/{db_name}/chunks/{sha256[:2]}/{sha256}{ext}
+
+and each backup is a recipe listing its chunks in order:
+
+    {s3_prefix}/{db_name}/recipes/{run_id}.json
+
+Chunks that no recipe references are marked for deletion by prune in
+`{s3_prefix}/{db_name}/prune-candidates.json`. A backup that reuses a
+marked chunk copies it in place first, so its new LastModified keeps
+prune from deleting it before the recipe referencing it is written.
+
+Boundaries are only considered at SQL record separators (row separators
+inside extended INSERTs and line ends), where the hash of the preceding
+window decides whether to cut. Scanning stays in C (re, zlib) instead of
+a per-byte Python loop.
+"""
+
+import hashlib
+import json
+import re
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from compressors import codec_for_key, get_compressor
+from encryption import object_encryption
+from manifest import new_run_id
+from s3_multipart import TransferStats
+
+MiB = 1024 * 1024
+KiB = 1024
+
+RECIPE_VERSION = 1
+
+MIN_CHUNK_SIZE = 256 * KiB
+AVG_CHUNK_SIZE = 1 * MiB
+MAX_CHUNK_SIZE = 4 * MiB
+
+# Bytes before a candidate boundary that decide whether to cut there
+WINDOW_SIZE = 64
+
+CANDIDATE_PATTERN = re.compile(rb"\n|\),\(")
+
+# Dump bytes kept for parsing binlog coordinates
+HEAD_SIZE = 64 * 1024
+
+
+def chunk_prefix(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key prefix of the chunk store.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{s3_prefix}/{db_name}/chunks"
+
+
+def chunk_key(s3_prefix: str, db_name: str, digest: str, extension: str) -> str:
+    """
+    Build the S3 key of a stored chunk.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        digest: Hex SHA-256 of the uncompressed chunk
+        extension: Compressor file extension
+
+    Returns:
+        S3 key
+    """
+    return f"{chunk_prefix(s3_prefix, db_name)}/{digest[:2]}/{digest}{extension}"
+
+
+def candidates_key(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key of the chunks prune has marked for deletion.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        S3 key
+    """
+    return f"{s3_prefix}/{db_name}/prune-candidates.json"
+
+
+def recipe_key(s3_prefix: str, db_name: str, run_id: str) -> str:
+    """
+    Build the S3 key of a backup recipe.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        run_id: Backup run identifier
+
+    Returns:
+        S3 key
+    """
+    return f"{s3_prefix}/{db_name}/recipes/{run_id}.json"
+
+
+class ContentDefinedChunker:
+    def __init__(
+        self,
+        min_size: int = MIN_CHUNK_SIZE,
+        avg_size: int = AVG_CHUNK_SIZE,
+        max_size: int = MAX_CHUNK_SIZE,
+    ):
+        """
+        Initialize chunker.
+
+        Args:
+            min_size: No boundary is placed closer than this to the last one
+            avg_size: Expected chunk size
+            max_size: A boundary is forced at this size
+        """
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+    def chunks(self, reader, read_size: int = MiB):
+        """
+        Split a binary stream into chunks.
+
+        Args:
+            reader: Binary file object to read until EOF
+            read_size: Read size in bytes
+
+        Yields:
+            Chunk bytes, in stream order
+        """
+        buffer = bytearray()
+        scan_pos = 0
+        previous = 0
+        while True:
+            data = reader.read(read_size)
+            if data:
+                buffer += data
+
+            while True:
+                cut, scan_pos, previous = self._find_cut(buffer, scan_pos, previous)
+                if cut is None:
+                    break
+                yield bytes(buffer[:cut])
+                del buffer[:cut]
+                scan_pos = 0
+                previous = 0
+
+            if not data:
+                if buffer:
+                    yield bytes(buffer)
+                return
+
+    def _find_cut(self, buffer: bytearray, scan_pos: int, previous: int) -> tuple:
+        """
+        Look for the next boundary in the buffer.
+
+        A candidate at distance d from the previous candidate is accepted
+        with probability d / (avg_size - min_size), decided by the CRC of
+        the window before it, so long records cut as readily as many
+        short ones.
+
+        Returns:
+            Tuple of (cut or None, position to resume scanning, previous
+            candidate position)
+        """
+        if len(buffer) < self.min_size:
+            return None, scan_pos, previous
+
+        start = max(scan_pos, self.min_size)
+        end = min(len(buffer), self.max_size)
+        spread = self.avg_size - self.min_size
+        if previous == 0:
+            previous = self.min_size
+
+        for match in CANDIDATE_PATTERN.finditer(buffer, start, end):
+            position = match.end()
+            window = buffer[position - WINDOW_SIZE : position]
+            if zlib.crc32(window) * spread < (position - previous) << 32:
+                return position, 0, 0
+            previous = position
+
+        if len(buffer) >= self.max_size:
+            return self.max_size, 0, 0
+        # Resume after the last candidate seen; a separator may span reads
+        return None, max(previous, end - 2), previous
+
+
+class DedupUpload:
+    def __init__(self, backup, chunker: ContentDefinedChunker = None):
+        """
+        Initialize deduplicating upload.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing S3 location, client,
+                compression and upload concurrency
+            chunker: Chunker (defaults to ContentDefinedChunker())
+        """
+        self.backup = backup
+        self.chunker = chunker or ContentDefinedChunker()
+        self.run_id = new_run_id()
+        self.known = set()
+        self.marked = set()
+        self.stats = TransferStats()
+
+    def load_known_chunks(self):
+        """
+        List chunks already in the store.
+        """
+        backup = self.backup
+        extension = backup.extension
+        paginator = backup.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=backup.s3_bucket,
+            Prefix=chunk_prefix(backup.s3_prefix, backup.db_name) + "/",
+        ):
+            for obj in page.get("Contents", []):
+                name = obj["Key"].rsplit("/", 1)[-1]
+                if name.endswith(extension):
+                    self.known.add(name.removesuffix(extension))
+
+    def load_marked_chunks(self):
+        """
+        Read the chunks prune has marked for deletion.
+        """
+        backup = self.backup
+        try:
+            response = backup.s3_client.get_object(
+                Bucket=backup.s3_bucket, Key=candidates_key(backup.s3_prefix, backup.db_name)
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            return
+        self.marked = set(json.loads(response["Body"].read()))
+
+    def touch_chunk(self, key: str) -> int:
+        """
+        Copy a stored chunk onto itself to refresh its LastModified.
+
+        Args:
+            key: S3 key of the chunk
+
+        Returns:
+            0, as nothing new is stored
+        """
+        backup = self.backup
+        head = backup.s3_client.head_object(Bucket=backup.s3_bucket, Key=key)
+        backup.s3_client.copy_object(
+            Bucket=backup.s3_bucket,
+            Key=key,
+            CopySource={"Bucket": backup.s3_bucket, "Key": key},
+            MetadataDirective="REPLACE",
+            Metadata=head.get("Metadata", {}),
+            ContentType=head.get("ContentType", "application/octet-stream"),
+            StorageClass=head.get("StorageClass", "STANDARD"),
+        )
+        return 0
+
+    def store_chunk(self, key: str, data: bytes) -> int:
+        """
+        Compress, encrypt if configured, and upload one chunk.
+
+        Args:
+            key: Destination S3 key
+            data: Uncompressed chunk
+
+        Returns:
+            Stored (compressed) size in bytes
+        """
+        backup = self.backup
+        obj = backup.compressor.compressobj()
+        body = obj.compress(data) + obj.flush()
+        if backup.encryption:
+            body = backup.encryption.encrypt_bytes(body)
+
+        if backup.upload_limiter:
+            backup.upload_limiter.consume(len(body))
+        started = time.monotonic()
+        backup.s3_client.put_object(
+            Bucket=backup.s3_bucket, Key=key, Body=body, **backup.object_args()
+        )
+        self.stats.record(len(body), time.monotonic() - started)
+        return len(body)
+
+    def upload(self, reader, s3_key: str = None, before_complete=None) -> dict:
+        """
+        Chunk a dump stream, upload new chunks and write the recipe.
+
+        Args:
+            reader: Binary file object with the dump
+            s3_key: Recipe S3 key (recipe_key() for this run when None)
+            before_complete: Optional callable run after EOF and before the
+                recipe is written; raising from it discards the backup
+
+        Returns:
+            Dict with key, raw_bytes, bytes (newly stored), etag (of the
+            recipe), upload_stats, head and recipe
+        """
+        backup = self.backup
+        s3_key = s3_key or recipe_key(backup.s3_prefix, backup.db_name, self.run_id)
+        extension = backup.extension
+        self.load_known_chunks()
+        self.load_marked_chunks()
+
+        chunks = []
+        raw_bytes = 0
+        new_chunks = 0
+        head = b""
+        pending = deque()
+        max_pending = backup.upload_concurrency * 2
+
+        def collect(limit: int):
+            while len(pending) > limit:
+                index, future = pending.popleft()
+                chunks[index][2] = future.result()
+
+        try:
+            with ThreadPoolExecutor(max_workers=backup.upload_concurrency) as executor:
+                for data in self.chunker.chunks(reader):
+                    if len(head) < HEAD_SIZE:
+                        head += data[: HEAD_SIZE - len(head)]
+                    raw_bytes += len(data)
+
+                    digest = hashlib.sha256(data).hexdigest()
+                    chunks.append([digest, len(data), 0])
+                    key = chunk_key(backup.s3_prefix, backup.db_name, digest, extension)
+                    if digest in self.known:
+                        if key not in self.marked:
+                            continue
+                        # Marked by prune; refresh it so prune sees it in use
+                        self.marked.discard(key)
+                        future = executor.submit(self.touch_chunk, key)
+                    else:
+                        self.known.add(digest)
+                        self.marked.discard(key)
+                        new_chunks += 1
+                        future = executor.submit(self.store_chunk, key, data)
+                    pending.append((len(chunks) - 1, future))
+                    collect(max_pending)
+                collect(0)
+
+            if before_complete:
+                before_complete()
+        except ClientError as e:
+            print(f"Error uploading to S3: {e}", file=sys.stderr)
+            raise
+        self.stats.finish()
+
+        stored = sum(chunk[2] for chunk in chunks)
+        recipe = {
+            "version": RECIPE_VERSION,
+            "db_name": backup.db_name,
+            "run_id": self.run_id,
+            "codec": backup.compressor.name,
+            "extension": extension,
+            "raw_bytes": raw_bytes,
+            "new_chunks": new_chunks,
+            "new_bytes": stored,
+            # [sha256, uncompressed size, stored size if uploaded by this run]
+            "chunks": chunks,
+        }
+        response = backup.s3_client.put_object(
+            Bucket=backup.s3_bucket,
+            Key=s3_key,
+            Body=json.dumps(recipe).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+        reused = len(chunks) - new_chunks
+        print(
+            f"Dedup backup: {len(chunks):,} chunk(s), {reused:,} already stored; "
+            f"uploaded {stored:,} bytes for {raw_bytes:,} bytes of dump"
+        )
+        print(f"Upload stats: {self.stats.summary()}")
+        return {
+            "key": s3_key,
+            "raw_bytes": raw_bytes,
+            "bytes": stored,
+            "etag": response.get("ETag"),
+            "upload_stats": self.stats.as_dict(),
+            "head": head,
+            "recipe": recipe,
+        }
+
+
+def read_recipe(s3_client, bucket: str, key: str) -> dict:
+    """
+    Download a backup recipe.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        key: S3 key of the recipe
+
+    Returns:
+        Recipe dictionary
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return json.loads(response["Body"].read())
+
+
+def reassemble(
+    s3_client,
+    bucket: str,
+    s3_prefix: str,
+    recipe: dict,
+    writer,
+    concurrency: int = 8,
+    encryption=None,
+) -> int:
+    """
+    Fetch the chunks of a recipe in parallel and write them in order.
+
+    At most 2 * concurrency chunks are held in memory.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        recipe: Recipe dictionary
+        writer: Binary file object receiving the dump
+        concurrency: Chunks fetched at once
+        encryption: Encryption holding the key of encrypted chunks
+
+    Returns:
+        Number of bytes written
+    """
+    extension = recipe["extension"]
+    compressor = get_compressor(codec_for_key(f"chunk{extension}"))
+    encryption = object_encryption(f"chunk{extension}", encryption)
+
+    def fetch(digest: str) -> bytes:
+        key = chunk_key(s3_prefix, recipe["db_name"], digest, extension)
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        if encryption:
+            body = encryption.decrypt_bytes(body)
+        data = compressor.decompressobj().decompress(body)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Chunk {key} does not match its hash")
+        return data
+
+    written = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, (digest, _, _) in enumerate(recipe["chunks"]):
+            pending.append(executor.submit(fetch, digest))
+            last = index == len(recipe["chunks"]) - 1
+            while pending and (last or len(pending) >= concurrency * 2):
+                data = pending.popleft().result()
+                writer.write(data)
+                written += len(data)
+    return written
@@ -0,0 +1,543 @@
+"""
+Client-side encryption of backup objects
+
+Encryption is the last stage before bytes leave the host: whatever the
+pipeline writes (compressed dump, archive frames, binlogs, dedup chunks)
+is split into fixed-size chunks, each sealed with AES-256-GCM by a pool
+of worker threads, so encryption adds no disk pass and keeps up with
+compression. Requires the cryptography package.
+
+Object layout:
+
+  header   32 bytes: magic, chunk size, key ID, 8-byte nonce prefix
+  chunk i  ciphertext of plaintext bytes [i * chunk_size, (i + 1) *
+           chunk_size) followed by the 16-byte GCM tag
+
+Every chunk but the last holds exactly chunk_size bytes; the last holds
+fewer (possibly none), so the plaintext size follows from the object
+size. A chunk's nonce is the object's random prefix followed by the chunk
+number, and the header plus a final-chunk flag are authenticated with
+it, so chunks cannot be reordered, swapped between objects or cut off.
+
+Because chunk boundaries are fixed, any plaintext byte range maps to a
+whole number of chunks: ranged reads (archive sections) fetch and
+decrypt only those, each chunk on its own.
+
+Encrypted objects carry a ".enc" suffix after the codec extension. The
+key is read from a local key file holding 32 bytes, raw, hex or base64.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+from s3_multipart import MiB
+
+ENCRYPTED_EXTENSION = ".enc"
+
+ALGORITHM = "aes-256-gcm"
+
+KEY_SIZE = 32
+TAG_SIZE = 16
+
+# Plaintext bytes per chunk, also the granularity of ranged reads
+CHUNK_SIZE = MiB
+
+HEADER = struct.Struct(">8sI8s8s4x")
+HEADER_MAGIC = b"SQLENC1\x00"
+
+
+def load_key(path: str) -> bytes:
+    """
+    Read an AES-256 key from a key file.
+
+    Args:
+        path: File holding 32 raw bytes, 64 hex digits or base64 of 32 bytes
+
+    Returns:
+        32-byte key
+    """
+    data = Path(path).read_bytes()
+    if len(data) == KEY_SIZE:
+        return data
+    text = data.strip()
+    try:
+        key = bytes.fromhex(text.decode("ascii"))
+    except (UnicodeDecodeError, ValueError):
+        try:
+            key = base64.b64decode(text, validate=True)
+        except binascii.Error:
+            key = b""
+    if len(key) != KEY_SIZE:
+        raise ValueError(f"Key file {path} does not hold a {KEY_SIZE}-byte key")
+    return key
+
+
+def is_encrypted(key: str) -> bool:
+    """
+    Tell encrypted objects apart by their key.
+
+    Args:
+        key: S3 key or file name
+
+    Returns:
+        True for keys ending in ".enc"
+    """
+    return key.endswith(ENCRYPTED_EXTENSION)
+
+
+def object_encryption(key: str, encryption):
+    """
+    Pick the encryption needed to read an object.
+
+    Args:
+        key: S3 key of the object
+        encryption: Encryption of the backup configuration, or None
+
+    Returns:
+        encryption for encrypted objects, None for plain ones
+    """
+    if not is_encrypted(key):
+        return None
+    if encryption is None:
+        raise RuntimeError(f"{key} is encrypted; set ENCRYPTION_KEY_FILE to read it")
+    return encryption
+
+
+class Encryption:
+    def __init__(self, key: bytes, chunk_size: int = CHUNK_SIZE, threads: int = None):
+        """
+        Initialize chunked AES-GCM encryption.
+
+        Args:
+            key: 32-byte AES key
+            chunk_size: Plaintext bytes per chunk of new objects
+            threads: Threads sealing chunks (CPU count when None)
+        """
+        if AESGCM is None:
+            raise RuntimeError("cryptography package is required for encryption")
+        if len(key) != KEY_SIZE:
+            raise ValueError(f"Encryption key must be {KEY_SIZE} bytes")
+        self.aead = AESGCM(key)
+        # Identifies the key without revealing it, so a wrong key is named
+        self.key_id = hashlib.sha256(b"backup-key-id" + key).digest()[:8]
+        self.chunk_size = chunk_size
+        self.threads = threads or os.cpu_count() or 1
+
+    def metadata(self) -> dict:
+        """
+        S3 object metadata describing the encryption.
+
+        Returns:
+            Dict merged into the Metadata upload argument
+        """
+        return {
+            "encryption": ALGORITHM,
+            "encryption-key-id": self.key_id.hex(),
+            "encryption-chunk-size": str(self.chunk_size),
+        }
+
+    def encryptobj(self):
+        """
+        Create a streaming encryption object for one new object.
+
+        Returns:
+            Object with compress(data) -> bytes and flush() -> bytes
+        """
+        return _EncryptStream(self)
+
+    def decryptobj(self, size: int):
+        """
+        Create a streaming decryption object for one object.
+
+        Args:
+            size: Size of the encrypted object in bytes
+
+        Returns:
+            Object with decompress(data) -> bytes and eof
+        """
+        return _DecryptStream(self, size)
+
+    def writer(self, raw):
+        """
+        Wrap a binary writer so everything written to it is encrypted.
+
+        Args:
+            raw: File object or S3MultipartWriter receiving the object
+
+        Returns:
+            EncryptingWriter
+        """
+        return EncryptingWriter(raw, self.encryptobj())
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        """
+        Encrypt a whole object held in memory.
+
+        Args:
+            data: Plaintext
+
+        Returns:
+            Encrypted object
+        """
+        stream = self.encryptobj()
+        return stream.compress(data) + stream.flush()
+
+    def decrypt_bytes(self, data: bytes) -> bytes:
+        """
+        Decrypt a whole object held in memory.
+
+        Args:
+            data: Encrypted object
+
+        Returns:
+            Plaintext
+        """
+        stream = self.decryptobj(len(data))
+        plaintext = stream.decompress(data)
+        if not stream.eof:
+            raise ValueError("Encrypted object is truncated")
+        return plaintext
+
+    def parse_header(self, header: bytes) -> tuple:
+        """
+        Check an object header against this key.
+
+        Args:
+            header: First HEADER.size bytes of an encrypted object
+
+        Returns:
+            (chunk_size, nonce_prefix) of the object
+        """
+        try:
+            magic, chunk_size, key_id, nonce_prefix = HEADER.unpack(header)
+        except struct.error:
+            magic = None
+        if magic != HEADER_MAGIC:
+            raise ValueError("Not an encrypted backup object")
+        if key_id != self.key_id:
+            raise ValueError(
+                f"Object was encrypted with key {key_id.hex()}, "
+                f"but the key file holds key {self.key_id.hex()}"
+            )
+        return chunk_size, nonce_prefix
+
+    def seal(self, header: bytes, index: int, data: bytes, final: bool) -> bytes:
+        """
+        Encrypt one chunk.
+
+        Args:
+            header: Header of the object
+            index: Chunk number
+            data: Plaintext, at most chunk_size bytes
+            final: Whether this is the last chunk of the object
+
+        Returns:
+            Ciphertext followed by the GCM tag
+        """
+        nonce = header[20:28] + struct.pack(">I", index)
+        return self.aead.encrypt(nonce, data, header + (b"\x01" if final else b"\x00"))
+
+    def unseal(self, header: bytes, index: int, data: bytes, final: bool) -> bytes:
+        """
+        Decrypt and authenticate one chunk.
+
+        Args:
+            header: Header of the object
+            index: Chunk number
+            data: Ciphertext followed by the GCM tag
+            final: Whether this is the last chunk of the object
+
+        Returns:
+            Plaintext
+        """
+        nonce = header[20:28] + struct.pack(">I", index)
+        try:
+            return self.aead.decrypt(nonce, data, header + (b"\x01" if final else b"\x00"))
+        except InvalidTag:
+            raise ValueError(f"Encrypted chunk {index} failed authentication") from None
+
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    """
+    Number of chunks of an encrypted object.
+
+    Args:
+        size: Encrypted object size in bytes
+        chunk_size: Plaintext bytes per chunk
+
+    Returns:
+        Chunk count, the last chunk being shorter than the others
+    """
+    return (size - HEADER.size) // (chunk_size + TAG_SIZE) + 1
+
+
+def plaintext_size(size: int, chunk_size: int) -> int:
+    """
+    Plaintext size of an encrypted object.
+
+    Args:
+        size: Encrypted object size in bytes
+        chunk_size: Plaintext bytes per chunk
+
+    Returns:
+        Size of the decrypted object in bytes
+    """
+    return size - HEADER.size - chunk_count(size, chunk_size) * TAG_SIZE
+
+
+class _EncryptStream:
+    """
+    Streaming state of one encrypted object.
+
+    Chunks are sealed in worker threads and emitted in order; at most
+    two chunks per thread are in flight.
+    """
+
+    def __init__(self, encryption: Encryption):
+        self.encryption = encryption
+        self.chunk_size = encryption.chunk_size
+        self.header = HEADER.pack(
+            HEADER_MAGIC, self.chunk_size, encryption.key_id, os.urandom(8)
+        )
+        self.max_pending = encryption.threads * 2
+        self.executor = None
+        if encryption.threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=encryption.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.index = 0
+        self.header_sent = False
+
+    def compress(self, data: bytes) -> bytes:
+        self.buffer += data
+        # Keep at least one byte back: only flush() may seal the final chunk
+        while len(self.buffer) > self.chunk_size:
+            chunk = bytes(self.buffer[: self.chunk_size])
+            del self.buffer[: self.chunk_size]
+            self._submit(chunk, final=False)
+        return self._collect(drain=False)
+
+    def flush(self) -> bytes:
+        # A final chunk of exactly chunk_size bytes is split so the last
+        # chunk is always shorter, which keeps the layout unambiguous
+        if len(self.buffer) == self.chunk_size:
+            self._submit(bytes(self.buffer), final=False)
+            self.buffer = bytearray()
+        self._submit(bytes(self.buffer), final=True)
+        self.buffer = bytearray()
+        output = self._collect(drain=True)
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        return output
+
+    def _submit(self, chunk: bytes, final: bool):
+        args = (self.header, self.index, chunk, final)
+        if self.executor:
+            self.pending.append(self.executor.submit(self.encryption.seal, *args))
+        else:
+            self.pending.append(self.encryption.seal(*args))
+        self.index += 1
+
+    def _collect(self, drain: bool) -> bytes:
+        output = []
+        if not self.header_sent:
+            output.append(self.header)
+            self.header_sent = True
+
+        while self.pending:
+            sealed = self.pending[0]
+            if not isinstance(sealed, bytes):
+                if not (drain or sealed.done() or len(self.pending) >= self.max_pending):
+                    break
+                sealed = sealed.result()
+            self.pending.popleft()
+            output.append(sealed)
+        return b"".join(output)
+
+
+class _DecryptStream:
+    """
+    Streaming decryption of one object whose size is known.
+    """
+
+    def __init__(self, encryption: Encryption, size: int):
+        self.encryption = encryption
+        self.size = size
+        self.buffer = bytearray()
+        self.position = 0
+        self.header = None
+        self.chunk_size = None
+        self.index = 0
+        self.eof = False
+
+    def decompress(self, data: bytes) -> bytes:
+        self.buffer += data
+        if self.header is None:
+            if len(self.buffer) < HEADER.size:
+                return b""
+            self.header = bytes(self.buffer[: HEADER.size])
+            self.chunk_size, _ = self.encryption.parse_header(self.header)
+            del self.buffer[: HEADER.size]
+            self.position = HEADER.size
+
+        output = []
+        while not self.eof:
+            length = min(self.chunk_size + TAG_SIZE, self.size - self.position)
+            if length < TAG_SIZE or len(self.buffer) < length:
+                break
+            final = self.position + length == self.size
+            chunk = bytes(self.buffer[:length])
+            del self.buffer[:length]
+            output.append(self.encryption.unseal(self.header, self.index, chunk, final))
+            self.position += length
+            self.index += 1
+            self.eof = final
+        if len(self.buffer) and self.eof:
+            raise ValueError("Data after the end of the encrypted object")
+        return b"".join(output)
+
+
+class EncryptingWriter:
+    def __init__(self, raw, stream):
+        """
+        Initialize an encrypting writer.
+
+        Args:
+            raw: Writer receiving the encrypted object; attributes such as
+                bytes_written, stats, etag and checksums() are its own
+            stream: Object returned by Encryption.encryptobj()
+        """
+        self.raw = raw
+        self.stream = stream
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def write(self, data: bytes) -> int:
+        self.raw.write(self.stream.compress(data))
+        return len(data)
+
+    def close(self):
+        """
+        Seal the final chunk and close the underlying writer.
+        """
+        self.raw.write(self.stream.flush())
+        return self.raw.close()
+
+    def abort(self):
+        if self.stream.executor:
+            self.stream.executor.shutdown(wait=True, cancel_futures=True)
+        if hasattr(self.raw, "abort"):
+            self.raw.abort()
+
+
+class EncryptedObjectReader:
+    def __init__(self, s3_client, bucket: str, key: str, encryption: Encryption):
+        """
+        Open an encrypted object for ranged reads of its plaintext.
+
+        Reads the header with one ranged GET, which also tells the size.
+
+        Args:
+            s3_client: boto3 S3 client
+            bucket: S3 bucket name
+            key: S3 key of the encrypted object
+            encryption: Encryption holding the object's key
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.encryption = encryption
+        response = s3_client.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes=0-{HEADER.size - 1}"
+        )
+        self.header = response["Body"].read()
+        self.chunk_size, _ = encryption.parse_header(self.header)
+        self.object_size = int(response["ContentRange"].rsplit("/", 1)[1])
+        self.chunks = chunk_count(self.object_size, self.chunk_size)
+        self.size = plaintext_size(self.object_size, self.chunk_size)
+
+    def iter_range(self, start: int, end: int):
+        """
+        Stream a plaintext byte range, decrypting chunk by chunk.
+
+        Args:
+            start: First plaintext byte
+            end: Plaintext offset after the last byte
+
+        Yields:
+            Consecutive pieces of the range
+        """
+        end = min(end, self.size)
+        if start >= end:
+            return
+        sealed_size = self.chunk_size + TAG_SIZE
+        first = start // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        response = self.s3_client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=(
+                f"bytes={HEADER.size + first * sealed_size}-"
+                f"{min(HEADER.size + (last + 1) * sealed_size, self.object_size) - 1}"
+            ),
+        )
+        body = response["Body"]
+        for index in range(first, last + 1):
+            data = self.encryption.unseal(
+                self.header, index, body.read(sealed_size), index == self.chunks - 1
+            )
+            offset = index * self.chunk_size
+            yield data[max(start - offset, 0) : end - offset]
+
+    def read(self, start: int, end: int) -> bytes:
+        """
+        Read a plaintext byte range.
+
+        Args:
+            start: First plaintext byte
+            end: Plaintext offset after the last byte
+
+        Returns:
+            Decrypted bytes
+        """
+        return b"".join(self.iter_range(start, end))
+
+
+class DecryptingDecompressor:
+    """
+    Decrypt an object and decompress the plaintext as one stream.
+    """
+
+    def __init__(self, decryptor, decompressor):
+        self.decryptor = decryptor
+        self.decompressor = decompressor
+
+    @property
+    def eof(self) -> bool:
+        return self.decryptor.eof and getattr(self.decompressor, "eof", True)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(self.decryptor.decompress(data))
@@ -0,0 +1,384 @@
+"""
+Binlog-based incremental backups
+
+A full backup taken with binlog tracking records the binary log
+coordinates of its snapshot and starts a chain manifest at
+`{s3_prefix}/{db_name}/chains/{base_run_id}.json`. Each incremental run
+rotates the binary log, downloads the closed binlog files written since
+the previous link with mysqlbinlog, and uploads them compressed under
+`{s3_prefix}/{db_name}/binlogs/{run_id}/`.
+
+Single-object full backups that start a chain are written to a key of
+their own, `{s3_prefix}/{db_name}/full/{run_id}/{name}`, instead of the
+key every run of their mode overwrites, so a later full backup cannot
+replace the base an older chain replays onto.
+"""
+
+import json
+import re
+import shutil
+import subprocess
+import sys
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+from mysql.connector import Error
+
+from manifest import RUN_ID_FORMAT, new_run_id, run_time
+
+# Offset of the first event in a binlog file, after its magic number
+BINLOG_START_POSITION = 4
+
+# Makes mysqldump write the snapshot coordinates as a commented
+# CHANGE MASTER TO statement (briefly takes FLUSH TABLES WITH READ LOCK)
+SOURCE_DATA_OPTION = "--master-data=2"
+
+COORDINATES_PATTERN = re.compile(
+    rb"(?:MASTER|SOURCE)_LOG_FILE='([^']+)',\s*(?:MASTER|SOURCE)_LOG_POS=(\d+)"
+)
+
+
+def parse_binlog_coordinates(head: bytes) -> dict:
+    """
+    Extract binlog coordinates from the start of a mysqldump output.
+
+    Args:
+        head: First bytes of a dump taken with SOURCE_DATA_OPTION
+
+    Returns:
+        Dict with file and position, or None if not found
+    """
+    match = COORDINATES_PATTERN.search(head)
+    if not match:
+        return None
+    return {"file": match.group(1).decode(), "position": int(match.group(2))}
+
+
+def binlog_status(connection) -> dict:
+    """
+    Read the current binlog coordinates and executed GTID set.
+
+    Args:
+        connection: MySQL connection
+
+    Returns:
+        Dict with file, position and gtid_executed
+    """
+    cursor = connection.cursor()
+    try:
+        try:
+            cursor.execute("SHOW BINARY LOG STATUS")
+        except Error:
+            # Servers before MySQL 8.2 and MariaDB only know the old name
+            cursor.execute("SHOW MASTER STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            raise RuntimeError("Binary logging is not enabled on the server")
+        status = {"file": row[0], "position": int(row[1])}
+
+        try:
+            cursor.execute("SELECT @@GLOBAL.gtid_executed")
+            status["gtid_executed"] = cursor.fetchone()[0] or ""
+        except Error:
+            status["gtid_executed"] = ""
+        return status
+    finally:
+        cursor.close()
+
+
+def chain_prefix(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key prefix holding chain manifests.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{s3_prefix}/{db_name}/chains"
+
+
+def base_prefix(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key prefix holding per-run single-object backups.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{s3_prefix}/{db_name}/full"
+
+
+def base_key(s3_prefix: str, db_name: str, run_id: str, key: str) -> str:
+    """
+    Build the per-run S3 key of a single-object backup that starts a chain.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        run_id: Backup run identifier
+        key: Key the mode writes without binlog tracking
+
+    Returns:
+        S3 key
+    """
+    return f"{base_prefix(s3_prefix, db_name)}/{run_id}/{key.rsplit('/', 1)[-1]}"
+
+
+def new_chain(db_name: str, base: dict, binlog: dict) -> dict:
+    """
+    Start a chain manifest for a full backup.
+
+    Args:
+        db_name: Database name
+        base: Description of the full backup (mode, run_id, key or manifest)
+        binlog: Snapshot coordinates of the full backup
+
+    Returns:
+        Chain dictionary
+    """
+    return {
+        "db_name": db_name,
+        "base": dict(base, binlog=binlog),
+        "incrementals": [],
+    }
+
+
+def save_chain(s3_client, bucket: str, s3_prefix: str, chain: dict) -> str:
+    """
+    Upload a chain manifest.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        chain: Chain dictionary
+
+    Returns:
+        S3 key of the chain manifest
+    """
+    key = f"{chain_prefix(s3_prefix, chain['db_name'])}/{chain['base']['run_id']}.json"
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(chain, indent=2).encode("utf-8"),
+        ContentType="application/json",
+    )
+    return key
+
+
+def load_latest_chain(
+    s3_client, bucket: str, s3_prefix: str, db_name: str, before: datetime = None
+) -> dict:
+    """
+    Download the chain manifest of the most recent full backup.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        before: Only consider full backups taken at or before this time
+
+    Returns:
+        Chain dictionary, or None if no chain exists
+    """
+    keys = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=chain_prefix(s3_prefix, db_name) + "/"
+    ):
+        for obj in page.get("Contents", []):
+            base_run_id = obj["Key"].rsplit("/", 1)[-1].removesuffix(".json")
+            if before is None or run_time(base_run_id) <= before:
+                keys.append(obj["Key"])
+
+    if not keys:
+        return None
+
+    # Run IDs are timestamps, so the lexically last key is the newest chain
+    response = s3_client.get_object(Bucket=bucket, Key=max(keys))
+    return json.loads(response["Body"].read())
+
+
+def find_latest_chain(backup, before: datetime = None) -> dict:
+    """
+    Find the chain of the most recent full backup, using the catalog.
+
+    Falls back to listing the chain prefix when there is no catalog or
+    it knows no chain. A base the catalog knows was overwritten has
+    superseded_by set to the run that overwrote it.
+
+    Args:
+        backup: MySQLBackupToS3 instance (S3 location and catalog)
+        before: Only consider full backups taken at or before this time
+
+    Returns:
+        Chain dictionary, or None if no chain exists
+    """
+    if backup.catalog:
+        base = backup.catalog.latest_chain_base(
+            before.strftime(RUN_ID_FORMAT) if before else None
+        )
+        if base:
+            key = f"{chain_prefix(backup.s3_prefix, backup.db_name)}/{base['run_id']}.json"
+            try:
+                response = backup.s3_client.get_object(Bucket=backup.s3_bucket, Key=key)
+                chain = json.loads(response["Body"].read())
+                if base["superseded_by"]:
+                    chain["base"]["superseded_by"] = base["superseded_by"]
+                return chain
+            except ClientError as e:
+                print(f"Chain {key} from catalog not readable: {e}", file=sys.stderr)
+
+    return load_latest_chain(
+        backup.s3_client, backup.s3_bucket, backup.s3_prefix, backup.db_name, before=before
+    )
+
+
+class IncrementalBackup:
+    def __init__(self, backup):
+        """
+        Initialize incremental backup.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing connection, client
+                options, compression and upload
+        """
+        self.backup = backup
+        self.run_id = new_run_id()
+        self.chain = None
+        self.link = None
+
+    def run(self) -> str:
+        """
+        Upload binlogs written since the last link of the latest chain.
+
+        Returns:
+            S3 URI of the updated chain manifest
+        """
+        backup = self.backup
+        chain = find_latest_chain(backup)
+        if chain is None:
+            raise RuntimeError(
+                "No full backup with binlog coordinates found; "
+                "run a full backup with --track-binlog first"
+            )
+        if chain["base"].get("superseded_by"):
+            raise RuntimeError(
+                f"Base of chain {chain['base']['run_id']} was overwritten by backup "
+                f"{chain['base']['superseded_by']}; run a full backup with --track-binlog"
+            )
+
+        if chain["incrementals"]:
+            start = chain["incrementals"][-1]["end"]
+        else:
+            start = chain["base"]["binlog"]
+
+        connection = backup.connect()
+        try:
+            cursor = connection.cursor()
+            # Close the current binlog so every file we copy is complete
+            cursor.execute("FLUSH BINARY LOGS")
+            cursor.execute("SHOW BINARY LOGS")
+            logs = [row[0] for row in cursor.fetchall()]
+            cursor.close()
+        finally:
+            connection.close()
+
+        # The chain ends where the freshly rotated log starts; a position read
+        # after the flush would skip events committed in between
+        end = {"file": logs[-1], "position": BINLOG_START_POSITION}
+
+        if start["file"] not in logs:
+            raise RuntimeError(
+                f"Binlog {start['file']} has been purged from the server; "
+                "take a new full backup"
+            )
+        files = logs[logs.index(start["file"]) : logs.index(end["file"])]
+
+        print(
+            f"Incremental backup from {start['file']}:{start['position']} "
+            f"to {end['file']}:{end['position']} ({len(files)} binlog file(s))"
+        )
+
+        objects = self.upload_binlogs(files, start["position"])
+
+        self.link = {
+            "run_id": self.run_id,
+            "start": start,
+            "end": end,
+            "objects": objects,
+        }
+        chain["incrementals"].append(self.link)
+        key = save_chain(backup.s3_client, backup.s3_bucket, backup.s3_prefix, chain)
+        self.chain = chain
+
+        total_raw = sum(obj["raw_bytes"] for obj in objects)
+        total = sum(obj["bytes"] for obj in objects)
+        print(f"Uploaded {len(objects)} binlog(s): {total_raw:,} bytes -> {total:,} bytes")
+        return f"s3://{backup.s3_bucket}/{key}"
+
+    def upload_binlogs(self, files: list, start_position: int) -> list:
+        """
+        Download binlog files from the server and upload them compressed.
+
+        Args:
+            files: Binlog file names in order
+            start_position: Position in the first file where replay starts
+
+        Returns:
+            Chain object entries
+        """
+        backup = self.backup
+        work_dir = backup.backup_dir / f"binlogs-{self.run_id}"
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        cmd = [
+            "mysqlbinlog",
+            *backup.client_options(),
+            "--read-from-remote-server",
+            "--raw",
+            f"--result-file={work_dir}/",
+            *files,
+        ]
+
+        objects = []
+        try:
+            try:
+                subprocess.run(cmd, check=True, stderr=subprocess.PIPE, text=True)
+            except subprocess.CalledProcessError as e:
+                print(f"Error downloading binlogs: {e.stderr}", file=sys.stderr)
+                raise
+
+            for index, name in enumerate(files):
+                path = work_dir / name
+                key = (
+                    f"{backup.s3_prefix}/{backup.db_name}/binlogs/{self.run_id}/"
+                    f"{name}{backup.extension}"
+                )
+                with open(path, "rb") as f:
+                    result = backup.upload_stream(f, key)
+                obj = {
+                    "binlog": name,
+                    "key": key,
+                    "start_position": (
+                        start_position if index == 0 else BINLOG_START_POSITION
+                    ),
+                    "raw_bytes": result["raw_bytes"],
+                    "bytes": result["bytes"],
+                    "etag": result["etag"],
+                }
+                if result.get("checksums"):
+                    obj["checksums"] = result["checksums"]
+                objects.append(obj)
+                path.unlink()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        return objects
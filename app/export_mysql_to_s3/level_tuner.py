@@ -0,0 +1,252 @@
+"""
+Adaptive compression level
+
+Whether a heavy or a light compression level finishes a backup sooner
+depends on the host: on a slow link every byte saved shortens the
+upload, on a fast link the compressor becomes the bottleneck.
+
+LevelTuner compresses a sample from the start of the first stream long
+enough to fill it at each candidate level of the configured codec,
+measuring input throughput and ratio. Once a stream has uploaded its
+first part, it also knows the upload throughput. A pipeline at level L
+moves at most min(dump rate, compress rate of L, upload rate / ratio of
+L) bytes of dump per second; the tuner picks the level with the best
+ratio among those within 5% of the fastest.
+
+The chosen level is set on the compressor, so streams started later use
+it from the beginning. Streams already running finish their current
+gzip member or zstd frame and continue at the new level; concatenated
+members and frames decompress as one stream.
+"""
+
+import sys
+import threading
+import time
+
+from compressors import get_compressor
+from s3_multipart import MiB
+
+CANDIDATE_LEVELS = {
+    "gzip": (1, 3, 6, 9),
+    "pgzip": (1, 3, 6, 9),
+    "zstd": (1, 3, 6, 9, 12),
+}
+
+# Uncompressed bytes compressed at every candidate level
+SAMPLE_SIZE = 4 * MiB
+
+# Levels at least this fraction of the fastest count as equally fast
+THROUGHPUT_TOLERANCE = 0.95
+
+
+class LevelTuner:
+    def __init__(
+        self,
+        compressor,
+        upload_concurrency: int = 10,
+        upload_rate_limit: float = None,
+        sample_size: int = SAMPLE_SIZE,
+    ):
+        """
+        Initialize level tuning for one backup.
+
+        Args:
+            compressor: Compressor whose level is tuned and then updated
+            upload_concurrency: Parts uploaded at once per stream
+            upload_rate_limit: Upload cap in bytes per second, if any
+            sample_size: Uncompressed bytes benchmarked per level
+        """
+        self.compressor = compressor
+        self.upload_concurrency = upload_concurrency
+        self.upload_rate_limit = upload_rate_limit
+        self.sample_size = sample_size
+        self.initial_level = compressor.level
+        self.samples = None
+        self.dump_rate = None
+        self.upload_rate = None
+        self.decided = False
+        self._sampling = False
+        self._lock = threading.Lock()
+
+    def compressobj(self, stats):
+        """
+        Create a compression stream that takes part in tuning.
+
+        Args:
+            stats: TransferStats of the upload the output goes to
+
+        Returns:
+            Object with compress(data) -> bytes and flush() -> bytes
+        """
+        return _TunedStream(self, stats)
+
+    def claim_sample(self) -> bool:
+        """
+        Let exactly one stream collect the benchmark sample.
+
+        Returns:
+            True for the first caller
+        """
+        with self._lock:
+            if self._sampling or self.decided:
+                return False
+            self._sampling = True
+            return True
+
+    def release_sample(self):
+        """
+        Let another stream sample after the claiming one ended too early.
+        """
+        with self._lock:
+            self._sampling = False
+
+    def benchmark(self, sample: bytes, dump_rate: float):
+        """
+        Compress the sample at every candidate level.
+
+        Args:
+            sample: Uncompressed bytes from the start of the dump
+            dump_rate: Bytes per second the dump arrived at while sampling
+        """
+        samples = {}
+        for level in CANDIDATE_LEVELS[self.compressor.name]:
+            candidate = get_compressor(
+                self.compressor.name, level, getattr(self.compressor, "threads", None)
+            )
+            started = time.perf_counter()
+            obj = candidate.compressobj()
+            size = len(obj.compress(sample)) + len(obj.flush())
+            seconds = max(time.perf_counter() - started, 1e-6)
+            samples[level] = {
+                "compress_rate": len(sample) / seconds,
+                "ratio": size / len(sample),
+            }
+        self.samples = samples
+        self.dump_rate = dump_rate
+
+    def decide(self, stats) -> bool:
+        """
+        Pick the level once the sample and one uploaded part are measured.
+
+        Args:
+            stats: TransferStats of the calling stream's upload
+
+        Returns:
+            True once a level has been chosen
+        """
+        if self.decided:
+            return True
+        if self.samples is None or not stats.latencies:
+            return False
+        with self._lock:
+            if self.decided:
+                return True
+            upload_rate = stats.part_bytes_per_second * self.upload_concurrency
+            if self.upload_rate_limit:
+                upload_rate = min(upload_rate, self.upload_rate_limit)
+            self.upload_rate = upload_rate
+
+            rates = {
+                level: min(
+                    self.dump_rate or float("inf"),
+                    sample["compress_rate"],
+                    upload_rate / sample["ratio"],
+                )
+                for level, sample in self.samples.items()
+            }
+            fastest = max(rates.values())
+            fast_enough = [
+                level
+                for level, rate in rates.items()
+                if rate >= fastest * THROUGHPUT_TOLERANCE
+            ]
+            level = min(fast_enough, key=lambda level: self.samples[level]["ratio"])
+            self.compressor.level = level
+            self.decided = True
+
+        print(
+            f"Compression level {level} chosen ({self.compressor.name}, was "
+            f"{self.initial_level}): ~{rates[level] / MiB:,.1f} MiB/s of dump; upload "
+            f"{upload_rate / MiB:,.1f} MiB/s"
+        )
+        return True
+
+    def as_dict(self) -> dict:
+        """
+        Measurements and the chosen level, for the manifest.
+
+        Returns:
+            Dict with codec, initial_level, level, dump_rate, upload_rate
+            and per-level compress_rate and ratio (rates in bytes/s)
+        """
+        return {
+            "codec": self.compressor.name,
+            "initial_level": self.initial_level,
+            "level": self.compressor.level,
+            "dump_rate": round(self.dump_rate) if self.dump_rate else None,
+            "upload_rate": round(self.upload_rate) if self.upload_rate else None,
+            "candidates": {
+                str(level): {
+                    "compress_rate": round(sample["compress_rate"]),
+                    "ratio": round(sample["ratio"], 4),
+                }
+                for level, sample in (self.samples or {}).items()
+            },
+        }
+
+
+class _TunedStream:
+    """
+    Streaming compressor that switches to the tuned level when known.
+    """
+
+    def __init__(self, tuner: LevelTuner, stats):
+        self.tuner = tuner
+        self.stats = stats
+        self.level = tuner.compressor.level
+        self.obj = tuner.compressor.compressobj()
+        self.sample = bytearray() if tuner.claim_sample() else None
+        self.started = None
+        self.compress_seconds = 0.0
+
+    def compress(self, data: bytes) -> bytes:
+        output = b""
+        if self.sample is not None:
+            self._collect(data)
+        if not self.tuner.decided:
+            self.tuner.decide(self.stats)
+        if self.tuner.decided and self.tuner.compressor.level != self.level:
+            # End the current member/frame; the rest uses the new level
+            output = self.obj.flush()
+            self.level = self.tuner.compressor.level
+            self.obj = self.tuner.compressor.compressobj()
+
+        started = time.perf_counter()
+        output += self.obj.compress(data)
+        self.compress_seconds += time.perf_counter() - started
+        return output
+
+    def flush(self) -> bytes:
+        if self.sample is not None:
+            # Too short to sample; a later stream may be long enough
+            self.sample = None
+            self.tuner.release_sample()
+        return self.obj.flush()
+
+    def _collect(self, data: bytes):
+        now = time.perf_counter()
+        if self.started is None:
+            self.started = now
+        self.sample += data[: self.tuner.sample_size - len(self.sample)]
+        if len(self.sample) < self.tuner.sample_size:
+            return
+
+        # Time not spent compressing was spent waiting for the dump
+        waiting = now - self.started - self.compress_seconds
+        dump_rate = len(self.sample) / waiting if waiting > 0.01 else None
+        try:
+            self.tuner.benchmark(bytes(self.sample), dump_rate)
+        except Exception as e:
+            print(f"Warning: compression level not tuned: {e}", file=sys.stderr)
+            self.tuner.decided = True
+        self.sample = None
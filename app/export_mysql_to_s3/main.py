@@ -3,17 +3,102 @@
 MySQL Database Backup to S3
 
 This script creates a MySQL database backup using mysqldump,
-compresses it with gzip, and uploads it to AWS S3.
+compresses it (gzip, parallel gzip or zstd), and uploads it to AWS S3.
+
+Pipeline modes:
+  file   - dump to backup_dir, compress the file, then upload it
+  stream - pipe mysqldump through in-process compression straight into
+           an S3 multipart upload without touching local disk
+  tables - dump tables concurrently, one streamed object per table,
+           plus a manifest
+  archive - stream one seekable archive with an index of per-table
+           frames, so single tables can be extracted with ranged GETs
+  dedup  - split the dump into content-defined chunks stored once under
+           their hash, plus a recipe; only changed chunks are uploaded
+  parquet - export every table as Parquet files, optionally partitioned
+           by a date column, for querying without a restore
+  incremental - upload binlogs written since the last full or
+           incremental backup (needs a full backup taken with
+           binlog tracking)
+
+With an encryption key file, every object is encrypted with chunked
+AES-GCM before it leaves the host (see encryption).
+
+Stream and archive backups can be mirrored to more S3 buckets, regions
+or a local path while they are written (see tee), reading the database
+once for all copies.
+
+The daemon command runs cron-scheduled backups of many databases from
+one long-lived process with warm S3 clients (see daemon).
 """
 
+import argparse
 import os
+import shutil
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 import boto3
+import mysql.connector
 from botocore.exceptions import ClientError
 
+from archive import archive_key, upload_archive
+from catalog import (
+    BackupCatalog,
+    entry_from_chain_link,
+    entry_from_manifest,
+    entry_from_upload,
+    print_backups,
+)
+from checksums import CHECKSUM_ALGORITHMS, new_checksum, s3_argument
+from compressors import CODECS, get_compressor
+from daemon import BackupDaemon, load_jobs, parse_address
+from dedup import DedupUpload, recipe_key
+from encryption import ENCRYPTED_EXTENSION, Encryption, load_key
+from incremental import (
+    SOURCE_DATA_OPTION,
+    IncrementalBackup,
+    base_key,
+    new_chain,
+    parse_binlog_coordinates,
+    save_chain,
+)
+from level_tuner import LevelTuner
+from manifest import new_run_id
+from metrics import RunMetrics
+from native_dump import ENGINES, NativeDump
+from parquet_export import PARTITION_GRANULARITIES, ParquetExport, parse_partition_columns
+from planner import BackupPlanner
+from restore import RestoreFromS3
+from retention import Prune
+from scheduler import BackupScheduler, parse_targets
+from s3_multipart import ResumableFileUpload, S3MultipartWriter, MiB
+from table_dump import CONSISTENCY_MODES, SKIP_MODES, ParallelTableDump, list_tables
+from tee import (
+    MAX_ATTEMPTS,
+    LocalSink,
+    S3Sink,
+    TeeWriter,
+    mirror_client,
+    parse_destinations,
+    print_mirror_results,
+    relative_key,
+)
+from throttle import AdaptiveThrottle, RateLimiter, ThrottledWriter, throttled_reader
+from verify import BackupVerifier
+from zstd_dictionary import DICTIONARY_MODES
+
+BACKUP_MODES = ("file", "stream", "tables", "archive", "dedup", "parquet", "incremental")
+
+# Bytes kept from the start of each dump to read header comments such as
+# the binlog coordinates written by --master-data
+HEAD_SIZE = 64 * 1024
+
 
 class MySQLBackupToS3:
     def __init__(
@@ -25,6 +110,43 @@ class MySQLBackupToS3:
         s3_bucket: str,
         s3_prefix: str = "mysql-backups",
         backup_dir: str = "/tmp",
+        backup_mode: str = "file",
+        compress_codec: str = "gzip",
+        compress_level: int = None,
+        compress_threads: int = None,
+        upload_part_size_mb: int = None,
+        upload_concurrency: int = 10,
+        upload_use_threads: bool = True,
+        dump_concurrency: int = 4,
+        dump_consistency: str = "lock",
+        dump_chunk_rows: int = 5_000_000,
+        dump_skip_unchanged: str = "none",
+        dump_engine: str = "mysqldump",
+        dump_fetch_size: int = 10_000,
+        dump_batch_size_kb: int = 1024,
+        parquet_partition_columns: dict = None,
+        parquet_partition_by: str = "month",
+        parquet_row_group_rows: int = 100_000,
+        track_binlog: bool = False,
+        use_catalog: bool = True,
+        s3_client=None,
+        dump_rate_limit_mb: float = None,
+        upload_rate_limit_mb: float = None,
+        dump_limiter: RateLimiter = None,
+        upload_limiter: RateLimiter = None,
+        throttle_adaptive: bool = False,
+        throttle_probe_query: str = "SELECT 1",
+        throttle_max_latency_ms: float = 100,
+        throttle_max_threads_running: int = None,
+        compress_level_auto: bool = False,
+        zstd_dictionary: str = "off",
+        zstd_dictionary_max_age_days: float = 7,
+        checksum_algorithm: str = "none",
+        mirror_destinations: list = None,
+        mirror_max_attempts: int = MAX_ATTEMPTS,
+        encryption_key_file: str = None,
+        metrics_dir: str = None,
+        report_dir: str = None,
     ):
         """
         Initialize MySQL backup configuration.
@@ -37,7 +159,92 @@ class MySQLBackupToS3:
             s3_bucket: S3 bucket name
             s3_prefix: S3 prefix/folder for backups
             backup_dir: Local directory for temporary backup files
+            backup_mode: Pipeline mode ("file", "stream", "tables", "archive",
+                "dedup", "parquet" or "incremental")
+            compress_codec: Compression codec ("gzip", "pgzip" or "zstd")
+            compress_level: Compression level (codec default when None)
+            compress_threads: Threads for pgzip/zstd (CPU count when None)
+            upload_part_size_mb: Multipart part size in MiB (auto when None)
+            upload_concurrency: Parts uploaded concurrently per object
+            upload_use_threads: Upload parts from worker threads
+            dump_concurrency: Tables dumped at once in tables and parquet mode
+            dump_consistency: Snapshot strategy in tables and parquet mode
+                ("lock" or "none")
+            dump_chunk_rows: Split tables above this row estimate into
+                primary-key ranges in tables mode (0 disables)
+            dump_skip_unchanged: Reuse objects of tables unchanged since the
+                previous run in tables mode ("none", "update_time" or "checksum")
+            dump_engine: "mysqldump" or "native" (mysql.connector streaming
+                cursors, no mysqldump binary needed)
+            dump_fetch_size: Rows fetched per round trip by the native engine
+            dump_batch_size_kb: Maximum INSERT statement size of the native
+                engine in KiB
+            parquet_partition_columns: Dict mapping table name to the date
+                column its Parquet files are partitioned by
+            parquet_partition_by: Partition granularity ("year", "month" or "day")
+            parquet_row_group_rows: Rows per Parquet row group
+            track_binlog: Record binlog coordinates of full backups and
+                start a new incremental chain from them
+            use_catalog: Record every backup in the catalog on S3 and use it
+                to find backups instead of listing the prefix
+            s3_client: boto3 S3 client to use (a new one when None), so
+                several backups can share one connection pool
+            dump_rate_limit_mb: Cap on MiB/s read from MySQL (None for no cap)
+            upload_rate_limit_mb: Cap on MiB/s sent to S3 (None for no cap)
+            dump_limiter: RateLimiter shared with other backups, used instead
+                of one built from dump_rate_limit_mb
+            upload_limiter: RateLimiter shared with other backups, used
+                instead of one built from upload_rate_limit_mb
+            throttle_adaptive: Lower the dump rate while a probe query on
+                the source server is slow or Threads_running is high
+            throttle_probe_query: Query timed by adaptive throttling
+            throttle_max_latency_ms: Probe latency that triggers a back-off
+            throttle_max_threads_running: Threads_running that triggers a
+                back-off (None disables the check)
+            compress_level_auto: Measure compression and upload throughput at
+                the start of the dump and switch to the fastest level
+                (stream, tables and incremental mode)
+            zstd_dictionary: "auto" compresses small tables with a dictionary
+                trained from earlier runs (tables mode, zstd codec)
+            zstd_dictionary_max_age_days: Days after which a new dictionary
+                is trained
+            checksum_algorithm: "sha256" or "crc32c" to compute checksums
+                while uploading, send them to S3 and record them, "none" to
+                disable
+            mirror_destinations: Destinations returned by
+                tee.parse_destinations() that receive a copy of every object
+                while it is uploaded (stream and archive mode)
+            mirror_max_attempts: Attempts per S3 request or local write of
+                a mirror
+            encryption_key_file: File holding the AES-256 key that objects
+                are encrypted with before upload (no encryption when None)
+            metrics_dir: Directory receiving a Prometheus textfile with the
+                phase metrics of every run (none when None)
+            report_dir: Directory receiving a JSON report of every run
+                (none when None)
         """
+        if backup_mode not in BACKUP_MODES:
+            raise ValueError(f"Unknown backup mode: {backup_mode}")
+        if dump_engine not in ENGINES:
+            raise ValueError(f"Unknown dump engine: {dump_engine}")
+        if track_binlog and backup_mode == "parquet":
+            raise ValueError("Parquet exports cannot be the base of an incremental chain")
+        if compress_level_auto and backup_mode not in ("stream", "tables", "incremental"):
+            raise ValueError(
+                "Adaptive compression level needs the stream, tables or incremental mode"
+            )
+        if zstd_dictionary != "off" and (backup_mode != "tables" or compress_codec != "zstd"):
+            raise ValueError("zstd dictionaries need the tables mode and the zstd codec")
+        if checksum_algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError(f"Unknown checksum algorithm: {checksum_algorithm}")
+        if checksum_algorithm != "none":
+            # Fails early when the algorithm's package is missing
+            new_checksum(checksum_algorithm)
+        if mirror_destinations and backup_mode not in ("stream", "archive"):
+            raise ValueError("Mirror destinations need the stream or archive mode")
+        if encryption_key_file and backup_mode == "parquet":
+            raise ValueError("Parquet exports cannot be encrypted; they are read in place")
+
         self.db_host = db_host
         self.db_user = db_user
         self.db_password = db_password
@@ -45,52 +252,239 @@ class MySQLBackupToS3:
         self.s3_bucket = s3_bucket
         self.s3_prefix = s3_prefix
         self.backup_dir = Path(backup_dir)
-        self.s3_client = boto3.client("s3")
+        self.backup_mode = backup_mode
+        self.compressor = get_compressor(compress_codec, compress_level, compress_threads)
+        self.encryption = None
+        if encryption_key_file:
+            self.encryption = Encryption(
+                load_key(encryption_key_file), threads=compress_threads
+            )
+        self.upload_part_size = upload_part_size_mb * MiB if upload_part_size_mb else None
+        self.upload_concurrency = upload_concurrency
+        self.upload_use_threads = upload_use_threads
+        self.dump_concurrency = dump_concurrency
+        self.dump_consistency = dump_consistency
+        self.dump_chunk_rows = dump_chunk_rows
+        self.dump_skip_unchanged = dump_skip_unchanged
+        self.zstd_dictionary = zstd_dictionary
+        self.zstd_dictionary_max_age_days = zstd_dictionary_max_age_days
+        self.checksum_algorithm = None if checksum_algorithm == "none" else checksum_algorithm
+        self.mirror_destinations = mirror_destinations or []
+        self.mirror_max_attempts = mirror_max_attempts
+        self.dump_engine = dump_engine
+        self.dump_fetch_size = dump_fetch_size
+        self.dump_batch_size = dump_batch_size_kb * 1024
+        self.parquet_partition_columns = parquet_partition_columns or {}
+        self.parquet_partition_by = parquet_partition_by
+        self.parquet_row_group_rows = parquet_row_group_rows
+        self.track_binlog = track_binlog
+        self.binlog_coordinates = None
+        self.last_upload = None
+        # Summary of the last successful run() (see backup_entry())
+        self.last_run = None
+        self.metrics_dir = metrics_dir
+        self.report_dir = report_dir
+        # RunMetrics of the last run(), failed or not
+        self.last_metrics = None
+        self.s3_client = s3_client or boto3.client("s3")
+        # One client per S3 mirror, with the mirror's region and retries
+        self.mirror_clients = [
+            mirror_client(destination, mirror_max_attempts)
+            if destination["kind"] == "s3"
+            else None
+            for destination in self.mirror_destinations
+        ]
+        # Shared by all threads of the backup, so the caps hold in total
+        self.dump_limiter = dump_limiter
+        if dump_limiter is None and (dump_rate_limit_mb or throttle_adaptive):
+            self.dump_limiter = RateLimiter(
+                dump_rate_limit_mb * MiB if dump_rate_limit_mb else None
+            )
+        self.upload_limiter = upload_limiter
+        if upload_limiter is None and upload_rate_limit_mb:
+            self.upload_limiter = RateLimiter(upload_rate_limit_mb * MiB)
+        self.throttle_adaptive = throttle_adaptive
+        self.throttle_probe_query = throttle_probe_query
+        self.throttle_max_latency_ms = throttle_max_latency_ms
+        self.throttle_max_threads_running = throttle_max_threads_running
+        self.level_tuner = None
+        if compress_level_auto:
+            self.level_tuner = LevelTuner(
+                self.compressor,
+                upload_concurrency=upload_concurrency,
+                upload_rate_limit=self.upload_limiter.rate if self.upload_limiter else None,
+            )
+        self.catalog = None
+        if use_catalog:
+            self.catalog = BackupCatalog(
+                self.s3_client, s3_bucket, s3_prefix, db_name, self.backup_dir
+            )
 
-    def create_dump(self) -> Path:
+    @property
+    def extension(self) -> str:
         """
-        Create MySQL dump using mysqldump command.
+        File name extension of backup objects (codec, then ".enc" if encrypted).
+        """
+        if self.encryption:
+            return self.compressor.extension + ENCRYPTED_EXTENSION
+        return self.compressor.extension
+
+    def object_args(self, compressor=None) -> dict:
+        """
+        Extra upload arguments for backup objects.
+
+        Args:
+            compressor: Compressor that wrote the object (the configured one
+                when None)
 
         Returns:
-            Path to the dump file
+            Dict with Metadata and ContentType, describing the encryption
+            of encrypted objects
         """
-        dump_filename = f"{self.db_name}.sql"
-        dump_path = self.backup_dir / dump_filename
+        extra_args = (compressor or self.compressor).s3_extra_args()
+        if self.encryption:
+            extra_args["Metadata"].update(self.encryption.metadata())
+            extra_args["ContentType"] = "application/octet-stream"
+        return extra_args
 
-        print(f"Creating MySQL dump: {dump_filename}")
+    def connect(self):
+        """
+        Open a MySQL connection to the backup database.
 
-        # mysqldump command
-        cmd = [
+        Returns:
+            mysql.connector connection
+        """
+        return mysql.connector.connect(
+            host=self.db_host,
+            user=self.db_user,
+            password=self.db_password,
+            database=self.db_name,
+            charset="utf8mb4",
+        )
+
+    def mysqldump_command(self, tables: list = (), options: list = ()) -> list:
+        """
+        Build the mysqldump command line.
+
+        Args:
+            tables: Tables to dump (all tables when empty)
+            options: Additional mysqldump options
+
+        Returns:
+            Command as a list of arguments
+        """
+        return [
             "mysqldump",
-            f"--host={self.db_host}",
-            f"--user={self.db_user}",
-            f"--password={self.db_password}",
+            *self.client_options(),
             "--single-transaction",
             "--quick",
             "--lock-tables=false",
+            *options,
+            self.db_name,
+            *tables,
+        ]
+
+    def native_dump(
+        self, tables: list = (), options: list = (), connection=None
+    ) -> NativeDump:
+        """
+        Create a native engine dump taking mysqldump-style arguments.
+
+        Args:
+            tables: Tables to dump (all tables when empty)
+            options: mysqldump options understood by the native engine
+            connection: Connection already inside a consistent snapshot to
+                dump on (a new one is opened when None)
+
+        Returns:
+            NativeDump instance
+        """
+        return NativeDump(
+            self,
+            tables=tables,
+            options=options,
+            connection=connection,
+            fetch_size=self.dump_fetch_size,
+            batch_size=self.dump_batch_size,
+        )
+
+    def client_options(self) -> list:
+        """
+        Connection options shared by the MySQL command line clients.
+
+        Returns:
+            List of command line options
+        """
+        return [
+            f"--host={self.db_host}",
+            f"--user={self.db_user}",
+            f"--password={self.db_password}",
             "--ssl",
             "--ssl-verify-server-cert=0",
-            self.db_name,
         ]
 
+    def full_dump_options(self) -> list:
+        """
+        Extra mysqldump options for single-file full dumps.
+
+        Returns:
+            List of mysqldump options
+        """
+        return [SOURCE_DATA_OPTION] if self.track_binlog else []
+
+    def create_dump(self) -> Path:
+        """
+        Create MySQL dump using mysqldump or the native engine.
+
+        Returns:
+            Path to the dump file
+        """
+        dump_filename = f"{self.db_name}.sql"
+        dump_path = self.backup_dir / dump_filename
+
+        print(f"Creating MySQL dump: {dump_filename}")
+
         try:
-            with open(dump_path, "w") as f:
-                subprocess.run(
-                    cmd,
-                    stdout=f,
-                    stderr=subprocess.PIPE,
-                    check=True,
-                    text=True,
-                )
+            if self.dump_engine == "native":
+                with open(dump_path, "wb") as f:
+                    writer = ThrottledWriter(f, self.dump_limiter) if self.dump_limiter else f
+                    self.native_dump(options=self.full_dump_options()).run(writer)
+            else:
+                cmd = self.mysqldump_command(options=self.full_dump_options())
+                with open(dump_path, "wb") as f, tempfile.TemporaryFile() as stderr:
+                    # Throttled dumps are copied through the limiter; otherwise
+                    # mysqldump writes the file itself
+                    process = subprocess.Popen(
+                        cmd, stdout=subprocess.PIPE if self.dump_limiter else f, stderr=stderr
+                    )
+                    if self.dump_limiter:
+                        shutil.copyfileobj(
+                            throttled_reader(process.stdout, self.dump_limiter), f, MiB
+                        )
+                    if process.wait() != 0:
+                        stderr.seek(0)
+                        raise subprocess.CalledProcessError(
+                            process.returncode,
+                            cmd[0],
+                            stderr=stderr.read().decode(errors="replace"),
+                        )
             print(f"Dump created successfully: {dump_path}")
+            if self.track_binlog:
+                with open(dump_path, "rb") as f:
+                    self.binlog_coordinates = parse_binlog_coordinates(f.read(HEAD_SIZE))
             return dump_path
         except subprocess.CalledProcessError as e:
             print(f"Error creating dump: {e.stderr}", file=sys.stderr)
             raise
+        except mysql.connector.Error as e:
+            print(f"Error creating dump: {e}", file=sys.stderr)
+            raise
 
     def compress_dump(self, dump_path: Path) -> Path:
         """
-        Compress dump file using gzip.
+        Compress dump file with the configured codec.
+
+        The uncompressed dump is removed once compression succeeds.
 
         Args:
             dump_path: Path to the dump file
@@ -98,48 +492,498 @@ class MySQLBackupToS3:
         Returns:
             Path to the compressed file
         """
-        compressed_path = Path(f"{dump_path}.gz")
-        print(f"Compressing dump file: {dump_path.name}")
+        compressed_path = Path(f"{dump_path}{self.extension}")
+        print(f"Compressing dump file: {dump_path.name} ({self.compressor.name})")
 
         try:
-            subprocess.run(
-                ["gzip", "-f", str(dump_path)],
-                check=True,
-                stderr=subprocess.PIPE,
-                text=True,
-            )
+            if self.encryption:
+                # Encrypted in the same pass, so no plaintext file is left
+                obj = self.compressor.compressobj()
+                with open(dump_path, "rb") as fin, open(compressed_path, "wb") as fout:
+                    writer = self.encryption.writer(fout)
+                    while chunk := fin.read(MiB):
+                        writer.write(obj.compress(chunk))
+                    writer.write(obj.flush())
+                    writer.close()
+            else:
+                self.compressor.compress_file(dump_path, compressed_path)
+            dump_path.unlink()
             print(f"Compression completed: {compressed_path}")
             return compressed_path
-        except subprocess.CalledProcessError as e:
-            print(f"Error compressing file: {e.stderr}", file=sys.stderr)
+        except (OSError, RuntimeError) as e:
+            print(f"Error compressing file: {e}", file=sys.stderr)
+            self.cleanup(compressed_path)
             raise
 
-    def upload_to_s3(self, file_path: Path) -> str:
+    def pending_upload(self) -> Path:
+        """
+        Find a compressed dump left behind by an interrupted upload.
+
+        Returns:
+            Path to the compressed dump, or None when nothing is pending
+        """
+        compressed_path = self.backup_dir / f"{self.db_name}.sql{self.extension}"
+        state_path = ResumableFileUpload.state_path_for(compressed_path)
+        if compressed_path.exists() and state_path.exists():
+            return compressed_path
+        return None
+
+    def object_key(self, run_id: str, key: str) -> str:
+        """
+        Build the S3 key of a single-object backup.
+
+        Backups that start an incremental chain get a key of their own, so
+        the next full backup cannot overwrite the base of a chain.
+
+        Args:
+            run_id: Backup run identifier
+            key: Key the mode overwrites on every run
+
+        Returns:
+            S3 key
+        """
+        if self.track_binlog:
+            return base_key(self.s3_prefix, self.db_name, run_id, key)
+        return key
+
+    def upload_to_s3(self, file_path: Path, s3_key: str = None, metadata: dict = None) -> str:
         """
         Upload compressed dump to S3.
 
+        Completed parts are recorded next to the file, so a failed upload
+        is resumed by the next run instead of starting over.
+
         Args:
             file_path: Path to the compressed dump file
+            s3_key: Destination S3 key (`{s3_prefix}/{file name}` when None)
+            metadata: Run details recorded with the upload state (see
+                ResumableFileUpload)
 
         Returns:
             S3 URI of the uploaded file
         """
-        s3_key = f"{self.s3_prefix}/{file_path.name}"
+        s3_key = s3_key or f"{self.s3_prefix}/{file_path.name}"
         print(f"Uploading to S3: s3://{self.s3_bucket}/{s3_key}")
 
+        upload = ResumableFileUpload(
+            self.s3_client,
+            self.s3_bucket,
+            s3_key,
+            file_path,
+            part_size=self.upload_part_size,
+            max_workers=self.upload_concurrency,
+            use_threads=self.upload_use_threads,
+            extra_args=self.object_args(),
+            limiter=self.upload_limiter,
+            checksum_algorithm=self.checksum_algorithm,
+            metadata=metadata,
+        )
         try:
-            self.s3_client.upload_file(
-                str(file_path),
-                self.s3_bucket,
-                s3_key,
-            )
+            response = upload.upload()
+            self.last_upload = {
+                "key": s3_key,
+                "bytes": file_path.stat().st_size,
+                "etag": response.get("ETag"),
+            }
+            if self.checksum_algorithm:
+                # Parts are checksummed as they are read; verify recomputes
+                # S3's checksum of the part checksums from the part size
+                self.last_upload["checksums"] = {
+                    "algorithm": self.checksum_algorithm,
+                    "s3": response.get(s3_argument(self.checksum_algorithm)),
+                    "type": "COMPOSITE",
+                    "part_size": upload.state["part_size"],
+                }
             s3_uri = f"s3://{self.s3_bucket}/{s3_key}"
             print(f"Upload completed: {s3_uri}")
+            print(f"Upload stats: {upload.stats.summary()}")
             return s3_uri
         except ClientError as e:
             print(f"Error uploading to S3: {e}", file=sys.stderr)
             raise
 
+    def stream_to_s3(self, run_id: str) -> str:
+        """
+        Stream compressed mysqldump output into an S3 multipart upload.
+
+        The dump is compressed in-process and parts are uploaded by a
+        worker pool while mysqldump keeps producing output, so no local
+        scratch space is needed.
+
+        Args:
+            run_id: Backup run identifier
+
+        Returns:
+            S3 URI of the uploaded file
+        """
+        s3_key = self.object_key(
+            run_id, f"{self.s3_prefix}/{self.db_name}.sql{self.extension}"
+        )
+        result = self.stream_dump_to_s3(s3_key, options=self.full_dump_options())
+        self.last_upload = result
+        if self.track_binlog:
+            self.binlog_coordinates = parse_binlog_coordinates(result["head"])
+        return f"s3://{self.s3_bucket}/{s3_key}"
+
+    def archive_to_s3(self, run_id: str) -> str:
+        """
+        Stream mysqldump output into a seekable archive on S3.
+
+        Args:
+            run_id: Backup run identifier
+
+        Returns:
+            S3 URI of the uploaded archive
+        """
+        s3_key = self.object_key(
+            run_id, archive_key(self.s3_prefix, self.db_name, self.extension)
+        )
+        result = self.stream_dump_to_s3(
+            s3_key,
+            options=self.full_dump_options(),
+            upload=lambda *args, **kwargs: upload_archive(self, *args, **kwargs),
+        )
+        self.last_upload = result
+        if self.track_binlog:
+            self.binlog_coordinates = parse_binlog_coordinates(result["head"])
+        return f"s3://{self.s3_bucket}/{s3_key}"
+
+    def dedup_to_s3(self) -> str:
+        """
+        Stream mysqldump output into the chunk deduplication store.
+
+        Returns:
+            S3 URI of the recipe
+        """
+        upload = DedupUpload(self)
+        s3_key = recipe_key(self.s3_prefix, self.db_name, upload.run_id)
+        result = self.stream_dump_to_s3(
+            s3_key, options=self.full_dump_options(), upload=upload.upload
+        )
+        self.last_upload = result
+        if self.track_binlog:
+            self.binlog_coordinates = parse_binlog_coordinates(result["head"])
+        return f"s3://{self.s3_bucket}/{s3_key}"
+
+    def stream_dump_to_s3(
+        self, s3_key: str, tables: list = (), options: list = (), upload=None, connection=None
+    ) -> dict:
+        """
+        Dump with the configured engine and stream the output to S3.
+
+        Args:
+            s3_key: Destination S3 key
+            tables: Tables to dump (all tables when empty)
+            options: mysqldump options
+            upload: Upload callable (see stream_command_to_s3)
+            connection: Connection inside a shared snapshot to dump on; the
+                native engine is used, as mysqldump cannot join a snapshot
+
+        Returns:
+            Result of the upload callable
+        """
+        if self.dump_engine == "native" or connection:
+            dump = self.native_dump(tables, options, connection)
+            return self.stream_native_to_s3(dump, s3_key, upload)
+        cmd = self.mysqldump_command(tables, options)
+        return self.stream_command_to_s3(cmd, s3_key, upload)
+
+    def stream_native_to_s3(self, dump: NativeDump, s3_key: str, upload=None) -> dict:
+        """
+        Run a native dump in a thread and stream its output to S3.
+
+        The dump writes into a pipe read by the upload, so rows are
+        compressed and uploaded while they are still being fetched.
+
+        Args:
+            dump: NativeDump to run
+            s3_key: Destination S3 key
+            upload: Upload callable (see stream_command_to_s3)
+
+        Returns:
+            Result of the upload callable
+        """
+        print(f"Streaming native MySQL dump to S3: s3://{self.s3_bucket}/{s3_key}")
+
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, "rb")
+        errors = []
+
+        def produce():
+            try:
+                with os.fdopen(write_fd, "wb") as writer:
+                    dump.run(writer)
+            except BrokenPipeError:
+                # The upload failed and closed the reader
+                pass
+            except Exception as e:
+                errors.append(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        def check_exit():
+            producer.join()
+            if errors:
+                print(f"Error creating dump: {errors[0]}", file=sys.stderr)
+                raise errors[0]
+
+        try:
+            upload = upload or self.upload_stream
+            return upload(
+                throttled_reader(reader, self.dump_limiter), s3_key, before_complete=check_exit
+            )
+        finally:
+            reader.close()
+            producer.join()
+
+    def stream_command_to_s3(self, cmd: list, s3_key: str, upload=None) -> dict:
+        """
+        Run a dump command and stream its compressed stdout to S3.
+
+        Args:
+            cmd: Command producing the dump on stdout
+            s3_key: Destination S3 key
+            upload: Callable taking (reader, s3_key, before_complete) that
+                uploads the output (upload_stream when None)
+
+        Returns:
+            Dict with key, raw_bytes (dump size) and bytes (uploaded size)
+        """
+        print(f"Streaming MySQL dump to S3: s3://{self.s3_bucket}/{s3_key}")
+
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        # Drain stderr in the background so a chatty mysqldump cannot block
+        stderr_chunks = []
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+        )
+        stderr_thread.start()
+
+        def check_exit():
+            returncode = process.wait()
+            stderr_thread.join()
+            if returncode != 0:
+                stderr = b"".join(stderr_chunks).decode(errors="replace")
+                raise subprocess.CalledProcessError(returncode, cmd[0], stderr=stderr)
+
+        try:
+            upload = upload or self.upload_stream
+            return upload(
+                throttled_reader(process.stdout, self.dump_limiter),
+                s3_key,
+                before_complete=check_exit,
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"Error creating dump: {e.stderr}", file=sys.stderr)
+            raise
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def open_writer(self, s3_key: str, extra_args: dict):
+        """
+        Open a streaming multipart upload, mirrored and encrypted when
+        configured.
+
+        Args:
+            s3_key: Destination S3 key
+            extra_args: Extra arguments for the upload (see object_args())
+
+        Returns:
+            S3MultipartWriter, or TeeWriter that also writes every mirror,
+            wrapped in an EncryptingWriter with encryption; bytes_written
+            counts the stored bytes
+        """
+        writer_args = {
+            "part_size": self.upload_part_size,
+            "max_workers": self.upload_concurrency,
+            "use_threads": self.upload_use_threads,
+            "extra_args": extra_args,
+            "limiter": self.upload_limiter,
+            "checksum_algorithm": self.checksum_algorithm,
+        }
+        writer = S3MultipartWriter(self.s3_client, self.s3_bucket, s3_key, **writer_args)
+        if self.mirror_destinations:
+            writer = self.mirror_writer(writer, s3_key, writer_args)
+        if self.encryption:
+            # Encrypted once, so every mirror stores the same ciphertext
+            writer = self.encryption.writer(writer)
+        return writer
+
+    def mirror_writer(self, writer: S3MultipartWriter, s3_key: str, writer_args: dict):
+        """
+        Fan an upload out to the mirror destinations.
+
+        Args:
+            writer: Upload to the backup bucket
+            s3_key: Key of that upload
+            writer_args: S3MultipartWriter arguments reused for S3 mirrors
+
+        Returns:
+            TeeWriter
+        """
+        relative = relative_key(s3_key, self.s3_prefix)
+        sinks = []
+        for destination, client in zip(self.mirror_destinations, self.mirror_clients):
+            if destination["kind"] == "s3":
+                sink = S3Sink(destination, client, relative, **writer_args)
+            else:
+                sink = LocalSink(destination, relative, self.mirror_max_attempts)
+            sinks.append((sink, destination))
+        return TeeWriter(writer, sinks)
+
+    def upload_stream(
+        self, reader, s3_key: str, before_complete=None, compressor=None
+    ) -> dict:
+        """
+        Compress a binary stream and upload it with a multipart upload.
+
+        Args:
+            reader: Binary file object to read until EOF
+            s3_key: Destination S3 key
+            before_complete: Optional callable run after EOF and before the
+                upload is completed; raising from it aborts the upload
+            compressor: Compressor used instead of the configured one (not
+                level-tuned)
+
+        Returns:
+            Dict with key, raw_bytes (input size), bytes (uploaded size),
+            etag, upload_stats, head (first bytes of the input), checksums
+            (None without a checksum algorithm) and mirrors (results of
+            TeeWriter, None without mirrors)
+        """
+        s3_uri = f"s3://{self.s3_bucket}/{s3_key}"
+        writer = self.open_writer(s3_key, self.object_args(compressor))
+        raw = new_checksum(self.checksum_algorithm) if self.checksum_algorithm else None
+        if compressor:
+            compressor = compressor.compressobj()
+        elif self.level_tuner:
+            compressor = self.level_tuner.compressobj(writer.stats)
+        else:
+            compressor = self.compressor.compressobj()
+
+        raw_bytes = 0
+        head = b""
+        try:
+            with writer:
+                while chunk := reader.read(MiB):
+                    if raw_bytes < HEAD_SIZE:
+                        head += chunk[: HEAD_SIZE - raw_bytes]
+                    raw_bytes += len(chunk)
+                    if raw:
+                        raw.update(chunk)
+                    writer.write(compressor.compress(chunk))
+                writer.write(compressor.flush())
+
+                if before_complete:
+                    before_complete()
+        except ClientError as e:
+            print(f"Error uploading to S3: {e}", file=sys.stderr)
+            raise
+
+        print(f"Upload completed: {s3_uri} ({writer.bytes_written:,} bytes)")
+        print(f"Upload stats: {writer.stats.summary()}")
+        mirrors = None
+        if self.mirror_destinations:
+            mirrors = writer.results()
+            print_mirror_results(mirrors)
+        checksums = writer.checksums()
+        if checksums:
+            checksums["raw"] = raw.value()
+        return {
+            "key": s3_key,
+            "raw_bytes": raw_bytes,
+            "bytes": writer.bytes_written,
+            "etag": writer.etag,
+            "upload_stats": writer.stats.as_dict(),
+            "head": head,
+            "checksums": checksums,
+            "mirrors": mirrors,
+        }
+
+    def record_chain(self, base: dict):
+        """
+        Start a new incremental chain from the last full backup.
+
+        Args:
+            base: Description of the full backup (mode and key or manifest)
+        """
+        if not self.binlog_coordinates:
+            print(
+                "Warning: binlog coordinates not found; incremental chain not started",
+                file=sys.stderr,
+            )
+            return
+
+        base = dict(base, run_id=base.get("run_id") or new_run_id())
+        chain = new_chain(self.db_name, base, self.binlog_coordinates)
+        key = save_chain(self.s3_client, self.s3_bucket, self.s3_prefix, chain)
+        coordinates = self.binlog_coordinates
+        print(
+            f"Incremental chain started at {coordinates['file']}:{coordinates['position']}: "
+            f"s3://{self.s3_bucket}/{key}"
+        )
+
+    def backup_entry(self, s3_uri: str, run_id: str, source=None) -> dict:
+        """
+        Describe a finished backup as a catalog entry.
+
+        Args:
+            s3_uri: S3 URI returned by the pipeline
+            run_id: Backup run identifier
+            source: ParallelTableDump, ParquetExport or IncrementalBackup
+                that produced the backup, if any
+
+        Returns:
+            Catalog entry; single-object backups other than archives have
+            no table list yet
+        """
+        if self.backup_mode == "incremental":
+            entry = entry_from_chain_link(source.chain, source.link, s3_uri)
+        elif source is not None:
+            entry = entry_from_manifest(source.manifest, s3_uri)
+        else:
+            entry = entry_from_upload(
+                self.backup_mode,
+                run_id,
+                self.last_upload,
+                s3_uri,
+                self.compressor.name,
+                self.compressor.level,
+            )
+        if entry["kind"] == "full" and self.binlog_coordinates:
+            entry["binlog"] = self.binlog_coordinates
+        return entry
+
+    def update_catalog(self, entry: dict):
+        """
+        Record a finished backup in the catalog.
+
+        The backup itself is already on S3, so failures only warn.
+
+        Args:
+            entry: Entry returned by backup_entry(), with seconds
+        """
+        try:
+            if "tables" not in entry:
+                connection = self.connect()
+                try:
+                    entry["tables"] = [
+                        t["name"] for t in list_tables(connection, self.db_name)
+                    ]
+                finally:
+                    connection.close()
+            self.catalog.record(entry)
+        except (ClientError, sqlite3.Error, mysql.connector.Error) as e:
+            print(f"Warning: catalog not updated: {e}", file=sys.stderr)
+
     def cleanup(self, file_path: Path):
         """
         Clean up local backup file.
@@ -151,6 +995,60 @@ class MySQLBackupToS3:
             print(f"Cleaning up local file: {file_path}")
             file_path.unlink()
 
+    def run_pipeline(self, run_id: str) -> tuple:
+        """
+        Run the pipeline of any mode but file, whose phases run() drives
+        itself.
+
+        Args:
+            run_id: Run identifier picked by run()
+
+        Returns:
+            Tuple of (S3 URI, run_id, source); run_id is the pipeline's own
+            where it picks one, source the ParallelTableDump, ParquetExport
+            or IncrementalBackup that produced the backup, if any
+        """
+        source = None
+        if self.backup_mode == "incremental":
+            source = IncrementalBackup(self)
+            s3_uri = source.run()
+            run_id = source.run_id
+        elif self.backup_mode == "stream":
+            s3_uri = self.stream_to_s3(run_id)
+        elif self.backup_mode == "archive":
+            s3_uri = self.archive_to_s3(run_id)
+        elif self.backup_mode == "dedup":
+            s3_uri = self.dedup_to_s3()
+            run_id = self.last_upload["recipe"]["run_id"]
+        elif self.backup_mode == "parquet":
+            source = ParquetExport(
+                self,
+                concurrency=self.dump_concurrency,
+                consistency=self.dump_consistency,
+                partition_columns=self.parquet_partition_columns,
+                partition_by=self.parquet_partition_by,
+                row_group_rows=self.parquet_row_group_rows,
+            )
+            s3_uri = source.run()
+            run_id = source.run_id
+        elif self.backup_mode == "tables":
+            source = ParallelTableDump(
+                self,
+                concurrency=self.dump_concurrency,
+                consistency=self.dump_consistency,
+                chunk_rows=self.dump_chunk_rows,
+                track_binlog=self.track_binlog,
+                skip_unchanged=self.dump_skip_unchanged,
+                zstd_dictionary=self.zstd_dictionary,
+                dictionary_max_age_days=self.zstd_dictionary_max_age_days,
+            )
+            s3_uri = source.run()
+            run_id = source.run_id
+            self.binlog_coordinates = source.binlog
+        else:
+            raise ValueError(f"No pipeline for mode: {self.backup_mode}")
+        return s3_uri, run_id, source
+
     def run(self) -> str:
         """
         Execute the full backup process.
@@ -162,18 +1060,116 @@ class MySQLBackupToS3:
         print("MySQL Backup to S3 - Starting")
         print("=" * 60)
 
+        started = time.monotonic()
+        run_id = new_run_id()
+        metrics = RunMetrics(self.db_name, self.backup_mode, run_id)
+        error = None
+        source = None
         dump_path = None
         compressed_path = None
+        raw_bytes = None
+        throttle = None
+        if self.throttle_adaptive and self.backup_mode != "incremental":
+            throttle = AdaptiveThrottle(
+                self,
+                self.dump_limiter,
+                probe_query=self.throttle_probe_query,
+                max_latency_ms=self.throttle_max_latency_ms,
+                max_threads_running=self.throttle_max_threads_running,
+            )
 
         try:
-            # Create dump
-            dump_path = self.create_dump()
+            if throttle:
+                throttle.start()
+            pipeline = None
+            if self.backup_mode == "file":
+                compressed_path = self.pending_upload()
+                s3_key = self.object_key(
+                    run_id, f"{self.s3_prefix}/{self.db_name}.sql{self.extension}"
+                )
+                if compressed_path:
+                    state = ResumableFileUpload.saved_state(compressed_path) or {}
+                    metadata = state.get("metadata") or {}
+                    if "run_id" not in metadata or (
+                        self.track_binlog and not metadata.get("binlog_coordinates")
+                    ):
+                        # Without them the upload could not be cataloged or
+                        # start a chain as the run that took the dump
+                        print(
+                            f"Interrupted upload of {compressed_path} lacks its run details; "
+                            f"taking a fresh dump"
+                        )
+                        ResumableFileUpload(
+                            self.s3_client, self.s3_bucket, s3_key, compressed_path
+                        ).discard()
+                        self.cleanup(compressed_path)
+                        compressed_path = None
+                if compressed_path:
+                    print(f"Found interrupted upload, resuming: {compressed_path}")
+                    # Recorded as the interrupted run, under the key it picked
+                    run_id = metadata["run_id"]
+                    s3_key = state.get("key") or s3_key
+                    self.binlog_coordinates = metadata.get("binlog_coordinates")
+                else:
+                    # Create dump
+                    with metrics.phase("create_dump") as phase:
+                        dump_path = self.create_dump()
+                        raw_bytes = phase["bytes_out"] = dump_path.stat().st_size
+
+                    # Compress dump
+                    with metrics.phase("compress_dump") as phase:
+                        phase["bytes_in"] = raw_bytes
+                        compressed_path = self.compress_dump(dump_path)
+                        phase["bytes_out"] = compressed_path.stat().st_size
+
+                # Upload to S3
+                with metrics.phase("upload_to_s3") as phase:
+                    phase["bytes_in"] = compressed_path.stat().st_size
+                    s3_uri = self.upload_to_s3(
+                        compressed_path,
+                        s3_key,
+                        metadata={
+                            "run_id": run_id,
+                            "binlog_coordinates": self.binlog_coordinates,
+                        },
+                    )
+                    phase["bytes_out"] = phase["bytes_in"]
+                if raw_bytes is not None:
+                    self.last_upload["raw_bytes"] = raw_bytes
+            else:
+                with metrics.phase(f"{self.backup_mode}_to_s3") as pipeline:
+                    s3_uri, run_id, source = self.run_pipeline(run_id)
+            metrics.run_id = run_id
+
+            if self.track_binlog and self.backup_mode != "incremental":
+                base = {"mode": self.backup_mode, "uri": s3_uri, "run_id": run_id}
+                if self.last_upload:
+                    # Restore checks the base is still the object this run wrote
+                    base["etag"] = self.last_upload.get("etag")
+                self.record_chain(base)
 
-            # Compress dump
-            compressed_path = self.compress_dump(dump_path)
+            entry = self.backup_entry(s3_uri, run_id, source)
+            entry["seconds"] = round(time.monotonic() - started, 3)
+            self.last_run = {
+                field: entry[field]
+                for field in ("run_id", "mode", "uri", "raw_bytes", "bytes", "seconds")
+            }
+            metrics.raw_bytes = entry["raw_bytes"]
+            metrics.bytes = entry["bytes"]
+            if pipeline:
+                pipeline["bytes_in"] = entry["raw_bytes"]
+                pipeline["bytes_out"] = entry["bytes"]
+            if self.catalog:
+                with metrics.phase("update_catalog"):
+                    self.update_catalog(entry)
 
-            # Upload to S3
-            s3_uri = self.upload_to_s3(compressed_path)
+            # The backup itself is complete; a missing copy still fails the run
+            mirrors = (self.last_upload or {}).get("mirrors") or []
+            failed = [mirror["uri"] for mirror in mirrors if mirror["error"]]
+            if failed:
+                raise RuntimeError(
+                    f"{len(failed)} mirror copy(ies) failed: {', '.join(failed)}"
+                )
 
             print("=" * 60)
             print("Backup completed successfully!")
@@ -183,21 +1179,420 @@ class MySQLBackupToS3:
             return s3_uri
 
         except Exception as e:
+            error = e
             print("=" * 60)
             print(f"Backup failed: {e}", file=sys.stderr)
             print("=" * 60)
             raise
 
         finally:
+            if throttle:
+                throttle.stop()
             # Cleanup local files
-            if compressed_path:
-                self.cleanup(compressed_path)
+            if dump_path or compressed_path:
+                with metrics.phase("cleanup"):
+                    if dump_path:
+                        self.cleanup(dump_path)
+                    if compressed_path:
+                        # Keep a partially uploaded file so the next run can resume it
+                        if ResumableFileUpload.state_path_for(compressed_path).exists():
+                            print(f"Keeping {compressed_path} for resumed upload")
+                        else:
+                            self.cleanup(compressed_path)
+            metrics.finish(error)
+            self.last_metrics = metrics
+            metrics.write(self.metrics_dir, self.report_dir)
+
+
+def env_int(name: str, default: int = None) -> int:
+    """
+    Read an integer environment variable.
+
+    Args:
+        name: Environment variable name
+        default: Value used when the variable is unset or empty
+
+    Returns:
+        Integer value or default
+    """
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def parse_compress_level(value: str):
+    """
+    Parse a compression level setting.
+
+    Args:
+        value: Level number, "auto", or empty for the codec default
+
+    Returns:
+        Level as int, "auto", or None for the codec default
+    """
+    if not value:
+        return None
+    if value.lower() == "auto":
+        return "auto"
+    return int(value)
+
+
+def parse_part_size(value: str) -> int:
+    """
+    Parse a multipart part size setting.
+
+    Args:
+        value: Size in MiB, or "auto"/empty for automatic sizing
+
+    Returns:
+        Size in MiB, or None for automatic sizing
+    """
+    if not value or value.lower() == "auto":
+        return None
+    return int(value)
 
 
 def main():
     """
-    Main function - Configure and run backup.
+    Main function - Configure and run backup, restore or maintenance commands.
     """
+    parser = argparse.ArgumentParser(
+        description="Back up a MySQL database to S3, restore it, or list and prune backups",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Required environment variables:
+  DB_PASSWORD, S3_BUCKET
+
+Optional environment variables:
+  DB_HOST, DB_USER, DB_NAME, S3_PREFIX, BACKUP_DIR
+  BACKUP_MODE: Pipeline mode, "file", "stream", "tables", "archive", "dedup",
+               "parquet" or "incremental" (default: file)
+  COMPRESS_CODEC: "gzip", "pgzip" or "zstd" (default: gzip)
+  COMPRESS_LEVEL: Compression level, or "auto" to pick the fastest level from
+                  measured throughput (default: 6 for gzip/pgzip, 3 for zstd)
+  COMPRESS_THREADS: Threads for pgzip/zstd (default: CPU count)
+  CHECKSUM_ALGORITHM: "sha256" or "crc32c" computes checksums while uploading,
+                      sends them to S3 and records them (default: none)
+  ENCRYPTION_KEY_FILE: File with a 32-byte AES key (raw, hex or base64); every
+                       object is encrypted with chunked AES-256-GCM before upload
+  MIRROR_DESTINATIONS: Comma-separated s3://bucket/prefix[?region=...] or local
+                       paths that receive a copy of stream/archive backups
+  MIRROR_MAX_ATTEMPTS: Attempts per request or write of a mirror (default: 5)
+  ZSTD_DICTIONARY: "auto" compresses small tables with a trained zstd
+                   dictionary in tables mode (default: off)
+  ZSTD_DICTIONARY_MAX_AGE_DAYS: Days before a new dictionary is trained (default: 7)
+  UPLOAD_PART_SIZE_MB: Multipart part size or "auto" (default: auto)
+  UPLOAD_CONCURRENCY: Concurrent part uploads per object (default: 10)
+  UPLOAD_USE_THREADS: "false" uploads parts in the calling thread (default: true)
+  DUMP_RATE_LIMIT_MB: Cap on MiB/s read from MySQL (default: no cap)
+  UPLOAD_RATE_LIMIT_MB: Cap on MiB/s sent to S3 (default: no cap)
+  THROTTLE_ADAPTIVE: "true" lowers the dump rate while the server is busy
+  THROTTLE_PROBE_QUERY: Query timed by adaptive throttling (default: SELECT 1)
+  THROTTLE_MAX_LATENCY_MS: Probe latency that triggers a back-off (default: 100)
+  THROTTLE_MAX_THREADS_RUNNING: Threads_running that triggers a back-off
+                                (default: not checked)
+  DUMP_CONCURRENCY: Tables dumped at once in tables/parquet mode (default: 4)
+  DUMP_CONSISTENCY: "lock" or "none" in tables/parquet mode (default: lock)
+  DUMP_CHUNK_ROWS: Rows per primary-key chunk in tables mode, 0 disables
+                   chunking (default: 5000000)
+  DUMP_ENGINE: "mysqldump" or "native" (default: mysqldump)
+  DUMP_FETCH_SIZE: Rows per fetch of the native engine (default: 10000)
+  DUMP_BATCH_SIZE_KB: INSERT statement size of the native engine (default: 1024)
+  DUMP_SKIP_UNCHANGED: "none", "update_time" or "checksum"; reuse objects of
+                       unchanged tables in tables mode (default: none)
+  PARQUET_PARTITION_COLUMNS: Comma-separated table.column date columns to
+                             partition Parquet files by
+  PARQUET_PARTITION_BY: "year", "month" or "day" (default: month)
+  PARQUET_ROW_GROUP_ROWS: Rows per Parquet row group (default: 100000)
+  TRACK_BINLOG: "true" records binlog coordinates of full backups for
+                incremental mode (default: false)
+  CATALOG_ENABLED: "false" disables the backup catalog on S3 (default: true)
+  METRICS_TEXTFILE_DIR: Directory for a Prometheus textfile-collector file with
+                        per-phase time, bytes, throughput and peak RSS of each run
+  RUN_REPORT_DIR: Directory for a JSON report of every run
+  RETENTION_KEEP_DAILY / RETENTION_KEEP_WEEKLY / RETENTION_KEEP_MONTHLY:
+                   Backups the prune command keeps per mode (default: 7 / 4 / 12)
+  BACKUP_TARGETS: Databases the schedule command backs up, comma-separated
+                  "database" or "database@host" (host defaults to DB_HOST)
+  SCHEDULE_JOBS: Backups the schedule command runs at once (default: 4)
+  SCHEDULE_JOBS_PER_HOST: Backups it runs at once per MySQL host (default: 1)
+  DAEMON_CONFIG: JSON file with the cron-scheduled jobs of the daemon command
+  DAEMON_STATUS_ADDRESS: "host:port" of the daemon's JSON status endpoint, or
+                         "off" (default: 127.0.0.1:8780)
+  RETENTION_CHUNK_GRACE_HOURS: Hours before unreferenced dedup chunks are
+                               deleted (default: 24)
+
+Examples:
+  main.py --plan                                      # estimate before the first backup
+  main.py --metrics-dir /var/lib/node_exporter/textfile --report-dir /var/log/backups
+  main.py --mode stream --track-binlog
+  main.py --mode tables --dump-rate-mb 20 --adaptive-throttle
+  main.py --mode stream --codec zstd --compress-level auto
+  main.py --mode tables --codec zstd --zstd-dictionary auto
+  main.py restore --target-db mydb_restored
+  main.py restore --until "2025-01-31 12:00:00"
+  main.py --checksum crc32c --mode stream             # checksum while uploading
+  main.py --mode archive --encryption-key-file /run/secrets/backup.key
+  main.py --mode stream --mirror s3://dr-bucket/mysql?region=eu-west-1 \
+          --mirror /mnt/nas/mysql-backups             # three copies, one dump
+  main.py verify --mode tables                        # check the latest run on S3
+  main.py extract --mode archive                      # list archive sections
+  main.py extract --mode archive --table orders --output orders.sql
+  main.py restore --mode archive --table orders --table customers
+  main.py --mode parquet --codec zstd --partition-column credit_histories.used_at
+  main.py catalog --table orders                      # backups containing orders
+  main.py catalog --rebuild                           # re-index from an S3 listing
+  main.py prune --keep-daily 3 --dry-run              # show what would be deleted
+  main.py schedule --target shop --target crm@db2 --jobs 4 --mode stream
+  main.py daemon --daemon-config /etc/backup-jobs.json   # cron-scheduled jobs
+        """,
+    )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=(
+            "backup", "restore", "extract", "catalog", "prune", "schedule", "verify", "daemon"
+        ),
+        default="backup",
+        help="Operation to run (default: backup)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Estimate dump time, size, parts, disk and memory of every mode, then exit",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=BACKUP_MODES,
+        default=os.getenv("BACKUP_MODE", "file"),
+        help="Pipeline mode (default: file)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("DUMP_CONCURRENCY", "4")),
+        help="Tables dumped at once in tables/parquet mode (default: 4)",
+    )
+    parser.add_argument(
+        "--consistency",
+        choices=CONSISTENCY_MODES,
+        default=os.getenv("DUMP_CONSISTENCY", "lock"),
+        help="Snapshot strategy in tables/parquet mode (default: lock)",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=int(os.getenv("DUMP_CHUNK_ROWS", "5000000")),
+        help="Rows per primary-key chunk in tables mode, 0 disables (default: 5000000)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=os.getenv("DUMP_ENGINE", "mysqldump"),
+        help="Dump engine (default: mysqldump)",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        choices=SKIP_MODES,
+        default=os.getenv("DUMP_SKIP_UNCHANGED", "none"),
+        help="Reuse objects of tables unchanged since the previous run (default: none)",
+    )
+    parser.add_argument(
+        "--partition-column",
+        action="append",
+        dest="partition_columns",
+        help="table.column to partition Parquet files by (repeatable)",
+    )
+    parser.add_argument(
+        "--partition-by",
+        choices=PARTITION_GRANULARITIES,
+        default=os.getenv("PARQUET_PARTITION_BY", "month"),
+        help="Parquet partition granularity (default: month)",
+    )
+    parser.add_argument(
+        "--codec",
+        choices=CODECS,
+        default=os.getenv("COMPRESS_CODEC", "gzip"),
+        help="Compression codec (default: gzip)",
+    )
+    parser.add_argument(
+        "--compress-level",
+        type=parse_compress_level,
+        default=parse_compress_level(os.getenv("COMPRESS_LEVEL", "")),
+        help='Compression level, or "auto" (default: codec default)',
+    )
+    parser.add_argument(
+        "--checksum",
+        choices=CHECKSUM_ALGORITHMS,
+        default=os.getenv("CHECKSUM_ALGORITHM", "none"),
+        help="Checksum computed while uploading and sent to S3 (default: none)",
+    )
+    parser.add_argument(
+        "--encryption-key-file",
+        default=os.getenv("ENCRYPTION_KEY_FILE") or None,
+        help="Encrypt objects with the AES-256 key in this file (default: no encryption)",
+    )
+    parser.add_argument(
+        "--mirror",
+        action="append",
+        dest="mirrors",
+        help="s3://bucket/prefix[?region=...] or local path receiving a copy (repeatable)",
+    )
+    parser.add_argument(
+        "--zstd-dictionary",
+        choices=DICTIONARY_MODES,
+        default=os.getenv("ZSTD_DICTIONARY", "off"),
+        help="Compress small tables with a trained zstd dictionary (default: off)",
+    )
+    parser.add_argument(
+        "--part-size-mb",
+        type=parse_part_size,
+        default=parse_part_size(os.getenv("UPLOAD_PART_SIZE_MB", "auto")),
+        help='Multipart part size in MiB or "auto" (default: auto)',
+    )
+    parser.add_argument(
+        "--upload-concurrency",
+        type=int,
+        default=int(os.getenv("UPLOAD_CONCURRENCY", "10")),
+        help="Concurrent part uploads per object (default: 10)",
+    )
+    parser.add_argument(
+        "--no-upload-threads",
+        dest="upload_use_threads",
+        action="store_false",
+        default=os.getenv("UPLOAD_USE_THREADS", "true").lower() != "false",
+        help="Upload parts one by one in the calling thread",
+    )
+    parser.add_argument(
+        "--dump-rate-mb",
+        type=float,
+        default=float(os.getenv("DUMP_RATE_LIMIT_MB") or 0) or None,
+        help="Cap on MiB/s read from MySQL (default: no cap)",
+    )
+    parser.add_argument(
+        "--upload-rate-mb",
+        type=float,
+        default=float(os.getenv("UPLOAD_RATE_LIMIT_MB") or 0) or None,
+        help="Cap on MiB/s sent to S3 (default: no cap)",
+    )
+    parser.add_argument(
+        "--adaptive-throttle",
+        action="store_true",
+        default=os.getenv("THROTTLE_ADAPTIVE", "false").lower() == "true",
+        help="Lower the dump rate while a probe query on the server is slow",
+    )
+    parser.add_argument(
+        "--track-binlog",
+        action="store_true",
+        default=os.getenv("TRACK_BINLOG", "false").lower() == "true",
+        help="Record binlog coordinates of full backups for incremental mode",
+    )
+    parser.add_argument(
+        "--no-catalog",
+        dest="use_catalog",
+        action="store_false",
+        default=os.getenv("CATALOG_ENABLED", "true").lower() != "false",
+        help="Do not record or consult the backup catalog",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        default=os.getenv("METRICS_TEXTFILE_DIR") or None,
+        help="Write phase metrics of every run as a Prometheus textfile here",
+    )
+    parser.add_argument(
+        "--report-dir",
+        default=os.getenv("RUN_REPORT_DIR") or None,
+        help="Write a JSON report of every run here",
+    )
+    restore_group = parser.add_argument_group("restore, extract, verify and catalog options")
+    restore_group.add_argument("--key", help="Restore or verify this single backup object")
+    restore_group.add_argument(
+        "--run-id", help="Restore or verify this per-table (or Parquet) backup run"
+    )
+    restore_group.add_argument(
+        "--until",
+        type=datetime.fromisoformat,
+        help="Restore the chain based before this time and replay binlogs up to it",
+    )
+    restore_group.add_argument(
+        "--target-db", help="Database to restore into (default: DB_NAME)"
+    )
+    restore_group.add_argument(
+        "--table",
+        action="append",
+        dest="tables",
+        help=(
+            "Restore or extract only this table from an archive, or list only "
+            "backups containing it (repeatable)"
+        ),
+    )
+    restore_group.add_argument(
+        "--output",
+        default="-",
+        help="File the extract command writes SQL to (default: stdout)",
+    )
+    restore_group.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Recreate the catalog from an S3 listing before listing it",
+    )
+    prune_group = parser.add_argument_group("prune options")
+    prune_group.add_argument(
+        "--keep-daily",
+        type=int,
+        default=int(os.getenv("RETENTION_KEEP_DAILY", "7")),
+        help="Days to keep the newest backup of (default: 7)",
+    )
+    prune_group.add_argument(
+        "--keep-weekly",
+        type=int,
+        default=int(os.getenv("RETENTION_KEEP_WEEKLY", "4")),
+        help="ISO weeks to keep the newest backup of (default: 4)",
+    )
+    prune_group.add_argument(
+        "--keep-monthly",
+        type=int,
+        default=int(os.getenv("RETENTION_KEEP_MONTHLY", "12")),
+        help="Months to keep the newest backup of (default: 12)",
+    )
+    prune_group.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print what prune would delete without deleting it",
+    )
+    schedule_group = parser.add_argument_group("schedule options")
+    schedule_group.add_argument(
+        "--target",
+        action="append",
+        dest="targets",
+        help='"database" or "database@host" to back up (repeatable)',
+    )
+    schedule_group.add_argument(
+        "--jobs",
+        type=int,
+        default=int(os.getenv("SCHEDULE_JOBS", "4")),
+        help="Backups running at once (default: 4)",
+    )
+    schedule_group.add_argument(
+        "--jobs-per-host",
+        type=int,
+        default=int(os.getenv("SCHEDULE_JOBS_PER_HOST", "1")),
+        help="Backups running at once against one MySQL host (default: 1)",
+    )
+
+    daemon_group = parser.add_argument_group("daemon options")
+    daemon_group.add_argument(
+        "--daemon-config",
+        default=os.getenv("DAEMON_CONFIG"),
+        help="JSON file with the daemon's scheduled jobs",
+    )
+    daemon_group.add_argument(
+        "--status-address",
+        default=os.getenv("DAEMON_STATUS_ADDRESS", "127.0.0.1:8780"),
+        help='"host:port" of the daemon status endpoint, "off" to disable '
+        "(default: 127.0.0.1:8780)",
+    )
+    args = parser.parse_args()
+
     # Configuration from environment variables
     config = {
         "db_host": os.getenv("DB_HOST", "localhost"),
@@ -207,6 +1602,45 @@ def main():
         "s3_bucket": os.getenv("S3_BUCKET", "my-backup-bucket"),
         "s3_prefix": os.getenv("S3_PREFIX", "mysql-backups"),
         "backup_dir": os.getenv("BACKUP_DIR", "/tmp"),
+        "backup_mode": args.mode,
+        "compress_codec": args.codec,
+        "compress_level": None if args.compress_level == "auto" else args.compress_level,
+        "compress_threads": env_int("COMPRESS_THREADS"),
+        "upload_part_size_mb": args.part_size_mb,
+        "upload_concurrency": args.upload_concurrency,
+        "upload_use_threads": args.upload_use_threads,
+        "dump_concurrency": args.concurrency,
+        "dump_consistency": args.consistency,
+        "dump_chunk_rows": args.chunk_rows,
+        "dump_skip_unchanged": args.skip_unchanged,
+        "dump_engine": args.engine,
+        "dump_fetch_size": env_int("DUMP_FETCH_SIZE", 10_000),
+        "dump_batch_size_kb": env_int("DUMP_BATCH_SIZE_KB", 1024),
+        "parquet_partition_columns": parse_partition_columns(
+            ",".join(args.partition_columns or [])
+            or os.getenv("PARQUET_PARTITION_COLUMNS", "")
+        ),
+        "parquet_partition_by": args.partition_by,
+        "parquet_row_group_rows": env_int("PARQUET_ROW_GROUP_ROWS", 100_000),
+        "track_binlog": args.track_binlog,
+        "use_catalog": args.use_catalog,
+        "dump_rate_limit_mb": args.dump_rate_mb,
+        "upload_rate_limit_mb": args.upload_rate_mb,
+        "throttle_adaptive": args.adaptive_throttle,
+        "throttle_probe_query": os.getenv("THROTTLE_PROBE_QUERY") or "SELECT 1",
+        "throttle_max_latency_ms": env_int("THROTTLE_MAX_LATENCY_MS", 100),
+        "throttle_max_threads_running": env_int("THROTTLE_MAX_THREADS_RUNNING"),
+        "compress_level_auto": args.compress_level == "auto",
+        "zstd_dictionary": args.zstd_dictionary,
+        "zstd_dictionary_max_age_days": env_int("ZSTD_DICTIONARY_MAX_AGE_DAYS", 7),
+        "checksum_algorithm": args.checksum,
+        "mirror_destinations": parse_destinations(
+            ",".join(args.mirrors or []) or os.getenv("MIRROR_DESTINATIONS", "")
+        ),
+        "mirror_max_attempts": env_int("MIRROR_MAX_ATTEMPTS", MAX_ATTEMPTS),
+        "encryption_key_file": args.encryption_key_file,
+        "metrics_dir": args.metrics_dir,
+        "report_dir": args.report_dir,
     }
 
     # Validate required configuration
@@ -218,8 +1652,110 @@ def main():
         print("Error: S3_BUCKET environment variable is required", file=sys.stderr)
         sys.exit(1)
 
-    # Run backup
+    if args.command == "schedule":
+        targets = parse_targets(
+            ",".join(args.targets or []) or os.getenv("BACKUP_TARGETS", ""),
+            config["db_host"],
+        )
+        if not targets:
+            print("Error: no targets; set BACKUP_TARGETS or --target", file=sys.stderr)
+            sys.exit(1)
+        finished = BackupScheduler(
+            MySQLBackupToS3,
+            config,
+            targets,
+            jobs=args.jobs,
+            jobs_per_host=args.jobs_per_host,
+        ).run()
+        if any("error" in job for job in finished):
+            sys.exit(1)
+        return
+
+    if args.command == "daemon":
+        if not args.daemon_config:
+            print("Error: no jobs; set DAEMON_CONFIG or --daemon-config", file=sys.stderr)
+            sys.exit(1)
+        jobs = load_jobs(
+            args.daemon_config, config, jobs=args.jobs, jobs_per_host=args.jobs_per_host
+        )
+        status_address = None
+        if args.status_address != "off":
+            status_address = parse_address(args.status_address)
+        BackupDaemon(MySQLBackupToS3, jobs, status_address).run()
+        return
+
     backup = MySQLBackupToS3(**config)
+
+    if args.command == "catalog":
+        if backup.catalog is None:
+            print("Error: the catalog is disabled", file=sys.stderr)
+            sys.exit(1)
+        if args.rebuild:
+            backup.catalog.rebuild(backup)
+        backups = backup.catalog.backups()
+        for table in args.tables or []:
+            matching = {b["id"] for b in backup.catalog.backups(table=table)}
+            backups = [b for b in backups if b["id"] in matching]
+        print_backups(backups)
+        return
+
+    if args.command == "prune":
+        Prune(
+            backup,
+            keep_daily=args.keep_daily,
+            keep_weekly=args.keep_weekly,
+            keep_monthly=args.keep_monthly,
+            chunk_grace_hours=env_int("RETENTION_CHUNK_GRACE_HOURS", 24),
+            dry_run=args.dry_run,
+        ).run()
+        return
+
+    if args.command == "extract":
+        restore = RestoreFromS3(backup)
+        if not args.tables:
+            restore.list_archive(key=args.key)
+        elif args.output == "-":
+            restore.extract(args.tables, sys.stdout.buffer, key=args.key)
+        else:
+            with open(args.output, "wb") as f:
+                restore.extract(args.tables, f, key=args.key)
+        return
+
+    if args.command == "verify":
+        results = BackupVerifier(backup, concurrency=args.upload_concurrency).run(
+            key=args.key, run_id=args.run_id
+        )
+        if any(result["errors"] for result in results):
+            sys.exit(1)
+        return
+
+    if args.command == "restore":
+        print("=" * 60)
+        print("MySQL Restore from S3 - Starting")
+        print("=" * 60)
+        restore = RestoreFromS3(
+            backup, target_db=args.target_db, concurrency=args.concurrency
+        )
+        try:
+            source = restore.run(
+                key=args.key, run_id=args.run_id, until=args.until, tables=args.tables
+            )
+        except Exception as e:
+            print("=" * 60)
+            print(f"Restore failed: {e}", file=sys.stderr)
+            print("=" * 60)
+            raise
+        print("=" * 60)
+        print("Restore completed successfully!")
+        print(f"Source: {source}")
+        print("=" * 60)
+        return
+
+    if args.plan:
+        BackupPlanner(backup).run()
+        return
+
+    # Run backup
     backup.run()
 
 
@@ -0,0 +1,177 @@
+"""
+Backup manifest helpers
+
+Multi-object backups are written under a run prefix
+`{s3_prefix}/{db_name}/{run_id}/` and described by a `manifest.json`
+stored next to the objects it lists.
+"""
+
+import json
+import re
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+RUN_ID_FORMAT = "%Y%m%dT%H%M%S"
+RUN_ID_PATTERN = re.compile(r"^\d{8}T\d{6}$")
+
+
+def new_run_id() -> str:
+    """
+    Generate a sortable identifier for a backup run.
+
+    Returns:
+        Timestamp string such as 20250101T013000
+    """
+    return datetime.now().strftime(RUN_ID_FORMAT)
+
+
+def run_time(run_id: str) -> datetime:
+    """
+    Parse the timestamp of a run identifier.
+
+    Args:
+        run_id: Backup run identifier
+
+    Returns:
+        Local datetime of the run
+    """
+    return datetime.strptime(run_id, RUN_ID_FORMAT)
+
+
+def list_run_ids(
+    s3_client, bucket: str, s3_prefix: str, db_name: str, complete: bool = False
+) -> list:
+    """
+    List run identifiers stored under a database prefix.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        complete: Only list runs that have a manifest; failed runs and runs
+            pruned while later runs still reuse their objects have none
+
+    Returns:
+        Sorted list of run identifiers (oldest first)
+    """
+    run_ids = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=f"{s3_prefix}/{db_name}/", Delimiter="/"
+    ):
+        for common in page.get("CommonPrefixes", []):
+            name = common["Prefix"].rstrip("/").rsplit("/", 1)[-1]
+            if RUN_ID_PATTERN.match(name):
+                run_ids.append(name)
+    if complete:
+        run_ids = [
+            run_id
+            for run_id in run_ids
+            if has_manifest(s3_client, bucket, run_prefix(s3_prefix, db_name, run_id))
+        ]
+    return sorted(run_ids)
+
+
+def run_prefix(s3_prefix: str, db_name: str, run_id: str) -> str:
+    """
+    Build the S3 key prefix for one backup run.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        run_id: Backup run identifier
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{s3_prefix}/{db_name}/{run_id}"
+
+
+def new_manifest(db_name: str, run_id: str, mode: str, **fields) -> dict:
+    """
+    Create an empty manifest for a backup run.
+
+    Args:
+        db_name: Database name
+        run_id: Backup run identifier
+        mode: Pipeline mode that produced the backup
+        fields: Additional top-level fields
+
+    Returns:
+        Manifest dictionary
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "db_name": db_name,
+        "run_id": run_id,
+        "mode": mode,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "objects": [],
+    }
+    manifest.update(fields)
+    return manifest
+
+
+def write_manifest(s3_client, bucket: str, prefix: str, manifest: dict) -> str:
+    """
+    Upload a manifest next to the objects it describes.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        prefix: Run prefix returned by run_prefix()
+        manifest: Manifest dictionary
+
+    Returns:
+        S3 key of the manifest
+    """
+    key = f"{prefix}/{MANIFEST_NAME}"
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(manifest, indent=2).encode("utf-8"),
+        ContentType="application/json",
+    )
+    return key
+
+
+def has_manifest(s3_client, bucket: str, prefix: str) -> bool:
+    """
+    Check whether a backup run has a manifest.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        prefix: Run prefix returned by run_prefix()
+
+    Returns:
+        True if the manifest exists
+    """
+    try:
+        s3_client.head_object(Bucket=bucket, Key=f"{prefix}/{MANIFEST_NAME}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+        return False
+    return True
+
+
+def read_manifest(s3_client, bucket: str, prefix: str) -> dict:
+    """
+    Download the manifest of a backup run.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        prefix: Run prefix returned by run_prefix()
+
+    Returns:
+        Manifest dictionary
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=f"{prefix}/{MANIFEST_NAME}")
+    return json.loads(response["Body"].read())
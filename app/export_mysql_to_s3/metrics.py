@@ -0,0 +1,272 @@
+"""
+Backup phase metrics
+
+Every run is split into phases that are timed separately, so a slow
+backup shows whether the dump, the compression or the upload was slow.
+In file mode these are create_dump, compress_dump, upload_to_s3 and
+cleanup; the streaming modes dump, compress and upload concurrently and
+report one phase for the whole pipeline. update_catalog is timed in
+every mode.
+
+Each phase records wall time, bytes in and out, throughput (bytes of
+dump, or of the compressed file for the upload, per second) and the peak
+RSS of the process and of its largest finished child (mysqldump) at the
+end of the phase. Peak RSS is the high-water mark since the process
+started, so in the daemon it covers earlier runs too.
+
+Results are written as:
+
+  {metrics_dir}/mysql_backup_{db}_{mode}.prom
+      Prometheus text format for node_exporter's textfile collector,
+      replaced atomically after every run, failed ones included
+  {report_dir}/{db}-{mode}-{run_id}.json
+      full run report, one file per run
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+METRIC_PREFIX = "mysql_backup"
+
+# name -> (help, field of the phase dict)
+PHASE_METRICS = {
+    "phase_duration_seconds": ("Wall time of a backup phase", "seconds"),
+    "phase_bytes_in": ("Bytes read by a backup phase", "bytes_in"),
+    "phase_bytes_out": ("Bytes written by a backup phase", "bytes_out"),
+    "phase_throughput_bytes_per_second": (
+        "Bytes processed per second by a backup phase",
+        "throughput",
+    ),
+    "phase_peak_rss_bytes": (
+        "Peak RSS of the backup process at the end of a backup phase",
+        "peak_rss",
+    ),
+}
+
+
+def peak_rss() -> tuple:
+    """
+    Peak resident set size of this process and of its children.
+
+    Returns:
+        Tuple of (self, children) in bytes; children is the largest
+        finished child process
+    """
+    # ru_maxrss is in KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return own, children
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Phase:
+    """
+    Context manager timing one phase; callers fill bytes_in / bytes_out,
+    also after the phase when the counts are only known later.
+    """
+
+    def __init__(self, metrics, name: str):
+        self.metrics = metrics
+        self.record = {"name": name, "bytes_in": None, "bytes_out": None}
+
+    def __enter__(self) -> dict:
+        self.started = time.monotonic()
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        record = self.record
+        record["seconds"] = round(time.monotonic() - self.started, 3)
+        record["peak_rss"], record["peak_rss_children"] = peak_rss()
+        record["error"] = str(exc) if exc else None
+        self.metrics.phases.append(record)
+        return False
+
+
+class RunMetrics:
+    def __init__(self, db_name: str, mode: str, run_id: str):
+        """
+        Initialize metrics of one backup run.
+
+        Args:
+            db_name: Database name
+            mode: Pipeline mode
+            run_id: Backup run identifier (may be replaced once the
+                pipeline has picked its own)
+        """
+        self.db_name = db_name
+        self.mode = mode
+        self.run_id = run_id
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.phases = []
+        self.raw_bytes = None
+        self.bytes = None
+        self.status = None
+        self.error = None
+        self.seconds = None
+
+    def phase(self, name: str) -> _Phase:
+        """
+        Time a phase.
+
+        Args:
+            name: Phase name
+
+        Returns:
+            Context manager yielding the phase dict, whose bytes_in and
+            bytes_out the caller sets
+        """
+        return _Phase(self, name)
+
+    def finish(self, error: Exception = None):
+        """
+        Close the run.
+
+        Args:
+            error: Exception that failed the run, None on success
+        """
+        self.seconds = round(time.monotonic() - self.started, 3)
+        self.status = "failed" if error else "ok"
+        self.error = str(error) if error else None
+        for phase in self.phases:
+            processed = phase["bytes_in"] or phase["bytes_out"]
+            phase["throughput"] = None
+            if processed and phase["seconds"]:
+                phase["throughput"] = round(processed / phase["seconds"])
+
+    @property
+    def ratio(self) -> float:
+        """
+        Compressed bytes per dump byte, None if either is unknown.
+        """
+        if self.raw_bytes and self.bytes is not None:
+            return round(self.bytes / self.raw_bytes, 4)
+        return None
+
+    def report(self) -> dict:
+        """
+        Build the JSON run report.
+
+        Returns:
+            Dict with run_id, database, mode, started_at, seconds, status,
+            error, raw_bytes, bytes, compression_ratio, peak_rss,
+            peak_rss_children and phases
+        """
+        own, children = peak_rss()
+        return {
+            "run_id": self.run_id,
+            "database": self.db_name,
+            "mode": self.mode,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "seconds": self.seconds,
+            "status": self.status,
+            "error": self.error,
+            "raw_bytes": self.raw_bytes,
+            "bytes": self.bytes,
+            "compression_ratio": self.ratio,
+            "peak_rss": own,
+            "peak_rss_children": children,
+            "phases": self.phases,
+        }
+
+    def textfile(self) -> str:
+        """
+        Render the run in the Prometheus text format.
+
+        Returns:
+            Metrics text
+        """
+        run_labels = (
+            f'database="{escape_label(self.db_name)}",mode="{escape_label(self.mode)}"'
+        )
+        lines = []
+
+        def metric(name: str, help_text: str, samples: list):
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{{{labels}}} {value}")
+
+        for name, (help_text, field) in PHASE_METRICS.items():
+            metric(
+                name,
+                help_text,
+                [
+                    (f'{run_labels},phase="{escape_label(phase["name"])}"', phase[field])
+                    for phase in self.phases
+                ],
+            )
+        own, children = peak_rss()
+        metric(
+            "duration_seconds",
+            "Wall time of the last backup run",
+            [(run_labels, self.seconds)],
+        )
+        metric(
+            "success",
+            "1 if the last backup run succeeded, 0 if it failed",
+            [(run_labels, int(self.status == "ok"))],
+        )
+        metric(
+            "last_run_timestamp_seconds",
+            "Unix time the last backup run started",
+            [(run_labels, round(self.started_at.timestamp()))],
+        )
+        metric(
+            "raw_bytes", "Dump bytes of the last backup run", [(run_labels, self.raw_bytes)]
+        )
+        metric("bytes", "Stored bytes of the last backup run", [(run_labels, self.bytes)])
+        metric(
+            "compression_ratio",
+            "Stored bytes per dump byte of the last backup run",
+            [(run_labels, self.ratio)],
+        )
+        metric(
+            "peak_rss_bytes",
+            "Peak RSS of the backup process and its largest child",
+            [
+                (f'{run_labels},process="self"', own),
+                (f'{run_labels},process="children"', children),
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_dir: str = None, report_dir: str = None):
+        """
+        Write the textfile and the run report.
+
+        Failures only warn; the backup itself is unaffected.
+
+        Args:
+            metrics_dir: Directory of the Prometheus textfile (skipped when None)
+            report_dir: Directory of the JSON run report (skipped when None)
+        """
+        outputs = []
+        if metrics_dir:
+            path = Path(metrics_dir) / f"{METRIC_PREFIX}_{self.db_name}_{self.mode}.prom"
+            outputs.append((path, self.textfile()))
+        if report_dir:
+            path = Path(report_dir) / f"{self.db_name}-{self.mode}-{self.run_id}.json"
+            outputs.append((path, json.dumps(self.report(), indent=2) + "\n"))
+
+        for path, content in outputs:
+            # Write-then-rename so the collector never reads a partial file
+            temp_path = path.with_name(f".{path.name}.tmp")
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path.write_text(content)
+                os.replace(temp_path, path)
+                print(f"Metrics written: {path}")
+            except OSError as e:
+                print(f"Warning: metrics not written to {path}: {e}", file=sys.stderr)
@@ -0,0 +1,506 @@
+"""
+Native Python dump engine
+
+Produces mysqldump-compatible SQL with mysql.connector instead of the
+mysqldump binary. Rows are streamed with unbuffered raw cursors (values
+arrive as the server's text representation and are only escaped, never
+converted) and written as multi-row INSERT statements of at most
+batch_size bytes.
+
+Accepts the subset of mysqldump options the backup pipelines use, so it
+can replace mysqldump_command() wherever a dump is produced. Section
+comments match mysqldump's, which keeps archive splitting and binlog
+coordinate parsing working.
+"""
+
+import re
+
+from incremental import SOURCE_DATA_OPTION, binlog_status
+from table_dump import list_tables, quote_identifier, start_consistent_snapshot
+
+MiB = 1024 * 1024
+
+ENGINES = ("mysqldump", "native")
+
+NUMERIC_TYPES = frozenset(
+    (
+        "tinyint", "smallint", "mediumint", "int", "integer", "bigint",
+        "decimal", "numeric", "float", "double", "real", "year",
+    )
+)
+BINARY_TYPES = frozenset(
+    (
+        "binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob", "bit",
+        "geometry", "point", "linestring", "polygon", "multipoint",
+        "multilinestring", "multipolygon", "geometrycollection", "geomcollection",
+    )
+)
+
+ESCAPE_PATTERN = re.compile(rb"[\x00\n\r\\'\"\x1a]")
+ESCAPES = {
+    b"\x00": b"\\0",
+    b"\n": b"\\n",
+    b"\r": b"\\r",
+    b"\\": b"\\\\",
+    b"'": b"\\'",
+    b'"': b'\\"',
+    b"\x1a": b"\\Z",
+}
+
+DUMP_HEADER = b"""/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET @OLD_CHARACTER_SET_RESULTS=@@CHARACTER_SET_RESULTS */;
+/*!40101 SET @OLD_COLLATION_CONNECTION=@@COLLATION_CONNECTION */;
+/*!50503 SET NAMES utf8mb4 */;
+/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE */;
+/*!40103 SET TIME_ZONE='+00:00' */;
+/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
+/*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
+"""
+
+DUMP_FOOTER = b"""/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;
+/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
+/*!40101 SET CHARACTER_SET_RESULTS=@OLD_CHARACTER_SET_RESULTS */;
+/*!40101 SET COLLATION_CONNECTION=@OLD_COLLATION_CONNECTION */;
+/*!40111 SET SQL_NOTES=@OLD_SQL_NOTES */;
+"""
+
+
+def parse_dump_options(options: list) -> dict:
+    """
+    Translate mysqldump options into native engine settings.
+
+    Args:
+        options: mysqldump options as passed to mysqldump_command()
+
+    Returns:
+        Dict with where, create_info, data, triggers, routines, events
+        and source_data
+    """
+    settings = {
+        "where": None,
+        "create_info": True,
+        "data": True,
+        "triggers": True,
+        "routines": False,
+        "events": False,
+        "source_data": False,
+    }
+    for option in options:
+        if option.startswith("--where="):
+            settings["where"] = option.split("=", 1)[1]
+        elif option == "--no-create-info":
+            settings["create_info"] = False
+        elif option == "--no-data":
+            settings["data"] = False
+        elif option == "--skip-triggers":
+            settings["triggers"] = False
+        elif option == "--routines":
+            settings["routines"] = True
+        elif option == "--events":
+            settings["events"] = True
+        elif option == SOURCE_DATA_OPTION:
+            settings["source_data"] = True
+        else:
+            raise ValueError(f"Option not supported by the native dump engine: {option}")
+    return settings
+
+
+def escape_string(value) -> bytes:
+    """
+    Escape a string value for a single-quoted SQL literal.
+
+    Args:
+        value: Raw bytes of the value
+
+    Returns:
+        Escaped bytes without quotes
+    """
+    if ESCAPE_PATTERN.search(value) is None:
+        return bytes(value)
+    return ESCAPE_PATTERN.sub(lambda match: ESCAPES[match.group()], value)
+
+
+def format_numeric(value) -> bytes:
+    return b"NULL" if value is None else bytes(value)
+
+
+def format_binary(value) -> bytes:
+    if value is None:
+        return b"NULL"
+    return b"0x" + value.hex().encode() if value else b"''"
+
+
+def format_string(value) -> bytes:
+    return b"NULL" if value is None else b"'" + escape_string(value) + b"'"
+
+
+def value_formatter(data_type: str):
+    """
+    Pick the literal formatter for a column type.
+
+    Args:
+        data_type: information_schema.COLUMNS.DATA_TYPE
+
+    Returns:
+        Callable turning a raw value (or None) into an SQL literal
+    """
+    if data_type in NUMERIC_TYPES:
+        return format_numeric
+    if data_type in BINARY_TYPES:
+        return format_binary
+    return format_string
+
+
+class NativeDump:
+    def __init__(
+        self,
+        backup,
+        tables: list = (),
+        options: list = (),
+        fetch_size: int = 10_000,
+        batch_size: int = MiB,
+        connection=None,
+    ):
+        """
+        Initialize native dump.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing the connection
+            tables: Tables and views to dump (all when empty)
+            options: mysqldump options (see parse_dump_options)
+            fetch_size: Rows fetched from the server per round trip
+            batch_size: Maximum size of one INSERT statement in bytes
+            connection: Connection already inside a consistent snapshot,
+                shared with other dumps; it is left open. A connection
+                with its own snapshot is opened when None
+        """
+        if connection and SOURCE_DATA_OPTION in options:
+            raise ValueError("Binlog coordinates cannot be read on a shared snapshot")
+        self.backup = backup
+        self.tables = list(tables)
+        self.settings = parse_dump_options(options)
+        self.fetch_size = fetch_size
+        self.batch_size = batch_size
+        self.connection = connection
+        self.binlog = None
+
+    def run(self, writer) -> int:
+        """
+        Dump into a binary file object.
+
+        Args:
+            writer: Binary file object receiving the SQL
+
+        Returns:
+            Number of rows dumped
+        """
+        if self.connection:
+            return self.dump(self.connection, writer)
+
+        connection = self.backup.connect()
+        try:
+            self.start_snapshot(connection)
+            rows = self.dump(connection, writer)
+            connection.rollback()
+            return rows
+        finally:
+            connection.close()
+
+    def dump(self, connection, writer) -> int:
+        """
+        Dump into a binary file object from a connection inside a snapshot.
+
+        Args:
+            connection: MySQL connection
+            writer: Binary file object receiving the SQL
+
+        Returns:
+            Number of rows dumped
+        """
+        db_name = self.backup.db_name
+
+        objects = list_tables(connection, db_name)
+        if self.tables:
+            wanted = set(self.tables)
+            objects = [t for t in objects if t["name"] in wanted]
+        base_tables = [t["name"] for t in objects if t["type"] == "BASE TABLE"]
+        views = [t["name"] for t in objects if t["type"] == "VIEW"]
+        columns = self.table_columns(connection)
+
+        writer.write(f"-- Native dump of database `{db_name}`\n".encode())
+        if self.binlog:
+            writer.write(
+                f"-- CHANGE MASTER TO MASTER_LOG_FILE='{self.binlog['file']}', "
+                f"MASTER_LOG_POS={self.binlog['position']};\n".encode()
+            )
+        writer.write(DUMP_HEADER)
+
+        rows = 0
+        for name in base_tables:
+            if self.settings["create_info"]:
+                self.write_table_definition(connection, writer, name)
+            if self.settings["data"]:
+                rows += self.write_table_data(connection, writer, name, columns[name])
+            if self.settings["triggers"]:
+                self.write_triggers(connection, writer, name)
+
+        if not self.settings["create_info"]:
+            views = []
+        # Placeholders first, so views may reference each other
+        for name in views:
+            self.write_view_placeholder(writer, name, columns[name])
+        if self.settings["routines"]:
+            self.write_routines(connection, writer)
+        if self.settings["events"]:
+            self.write_events(connection, writer)
+        for name in views:
+            self.write_view_definition(connection, writer, name)
+
+        writer.write(DUMP_FOOTER)
+        return rows
+
+    def start_snapshot(self, connection):
+        """
+        Start a consistent snapshot, recording binlog coordinates if asked.
+
+        Args:
+            connection: MySQL connection
+        """
+        if not self.settings["source_data"]:
+            start_consistent_snapshot(connection)
+            return
+        cursor = connection.cursor()
+        try:
+            # Same as mysqldump --master-data: a brief global read lock
+            # pins the binlog position to the snapshot
+            cursor.execute("FLUSH TABLES WITH READ LOCK")
+            start_consistent_snapshot(connection)
+            self.binlog = binlog_status(connection)
+            cursor.execute("UNLOCK TABLES")
+        finally:
+            cursor.close()
+
+    def table_columns(self, connection) -> dict:
+        """
+        Look up the columns of every table and view.
+
+        Args:
+            connection: MySQL connection
+
+        Returns:
+            Dict mapping table name to a list of (column, data_type,
+            generated) tuples in ordinal order
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE,
+                       COALESCE(GENERATION_EXPRESSION, '') <> ''
+                FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = %s
+                ORDER BY TABLE_NAME, ORDINAL_POSITION
+                """,
+                (self.backup.db_name,),
+            )
+            columns = {}
+            for table, column, data_type, generated in cursor.fetchall():
+                columns.setdefault(table, []).append(
+                    (column, data_type.lower(), bool(generated))
+                )
+            return columns
+        finally:
+            cursor.close()
+
+    def show_create(self, connection, statement: str, column: int) -> tuple:
+        """
+        Run a SHOW CREATE statement.
+
+        Args:
+            connection: MySQL connection
+            statement: SHOW CREATE ... statement
+            column: Index of the column holding the definition
+
+        Returns:
+            Tuple of the result row and the definition
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute(statement)
+            row = cursor.fetchone()
+            return row, row[column]
+        finally:
+            cursor.close()
+
+    def write_table_definition(self, connection, writer, name: str):
+        quoted = quote_identifier(name)
+        _, definition = self.show_create(connection, f"SHOW CREATE TABLE {quoted}", 1)
+        writer.write(
+            f"\n--\n-- Table structure for table {quoted}\n--\n\n"
+            f"DROP TABLE IF EXISTS {quoted};\n{definition};\n".encode()
+        )
+
+    def write_table_data(self, connection, writer, name: str, columns: list) -> int:
+        """
+        Stream the rows of a table as multi-row INSERT statements.
+
+        Args:
+            connection: MySQL connection
+            writer: Binary file object receiving the SQL
+            name: Table name
+            columns: Columns from table_columns()
+
+        Returns:
+            Number of rows written
+        """
+        quoted = quote_identifier(name)
+        stored = [
+            (column, data_type) for column, data_type, generated in columns if not generated
+        ]
+        column_list = ", ".join(quote_identifier(column) for column, _ in stored)
+        formatters = [value_formatter(data_type) for _, data_type in stored]
+
+        query = f"SELECT {column_list} FROM {quoted}"
+        if self.settings["where"]:
+            query += f" WHERE {self.settings['where']}"
+        if len(stored) == len(columns):
+            prefix = f"INSERT INTO {quoted} VALUES ".encode()
+        else:
+            # Generated columns cannot be inserted, so name the others
+            prefix = f"INSERT INTO {quoted} ({column_list}) VALUES ".encode()
+
+        writer.write(f"\n--\n-- Dumping data for table {quoted}\n--\n\n".encode())
+
+        rows = 0
+        batch = []
+        batch_bytes = 0
+        cursor = connection.cursor(raw=True)
+        try:
+            cursor.execute(query)
+            while fetched := cursor.fetchmany(self.fetch_size):
+                for row in fetched:
+                    values = b"(" + b",".join(
+                        [format_value(value) for format_value, value in zip(formatters, row)]
+                    ) + b")"
+                    batch.append(values)
+                    batch_bytes += len(values) + 1
+                    if batch_bytes >= self.batch_size:
+                        writer.write(prefix + b",".join(batch) + b";\n")
+                        batch = []
+                        batch_bytes = 0
+                rows += len(fetched)
+            if batch:
+                writer.write(prefix + b",".join(batch) + b";\n")
+        finally:
+            cursor.close()
+        return rows
+
+    def write_triggers(self, connection, writer, name: str):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT TRIGGER_NAME FROM information_schema.TRIGGERS
+                WHERE EVENT_OBJECT_SCHEMA = %s AND EVENT_OBJECT_TABLE = %s
+                ORDER BY ACTION_ORDER
+                """,
+                (self.backup.db_name, name),
+            )
+            triggers = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+        for trigger in triggers:
+            row, definition = self.show_create(
+                connection, f"SHOW CREATE TRIGGER {quote_identifier(trigger)}", 2
+            )
+            self.write_compound(writer, row[1], definition)
+
+    def write_view_placeholder(self, writer, name: str, columns: list):
+        quoted = quote_identifier(name)
+        select = ", ".join(f"1 AS {quote_identifier(column)}" for column, _, _ in columns)
+        writer.write(
+            f"\n--\n-- Temporary view structure for view {quoted}\n--\n\n"
+            f"DROP TABLE IF EXISTS {quoted};\n"
+            f"/*!50001 DROP VIEW IF EXISTS {quoted}*/;\n"
+            f"/*!50001 CREATE VIEW {quoted} AS SELECT {select or '1'} */;\n".encode()
+        )
+
+    def write_view_definition(self, connection, writer, name: str):
+        quoted = quote_identifier(name)
+        _, definition = self.show_create(connection, f"SHOW CREATE VIEW {quoted}", 1)
+        writer.write(
+            f"\n--\n-- Final view structure for view {quoted}\n--\n\n"
+            f"/*!50001 DROP VIEW IF EXISTS {quoted}*/;\n{definition};\n".encode()
+        )
+
+    def write_routines(self, connection, writer):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT ROUTINE_TYPE, ROUTINE_NAME FROM information_schema.ROUTINES
+                WHERE ROUTINE_SCHEMA = %s ORDER BY ROUTINE_TYPE, ROUTINE_NAME
+                """,
+                (self.backup.db_name,),
+            )
+            routines = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        writer.write(
+            f"\n--\n-- Dumping routines for database '{self.backup.db_name}'\n--\n".encode()
+        )
+        for routine_type, routine in routines:
+            quoted = quote_identifier(routine)
+            row, definition = self.show_create(
+                connection, f"SHOW CREATE {routine_type} {quoted}", 2
+            )
+            if definition is None:
+                raise RuntimeError(
+                    f"No privilege to read the definition of {routine_type} {routine}"
+                )
+            writer.write(f"/*!50003 DROP {routine_type} IF EXISTS {quoted} */;\n".encode())
+            self.write_compound(writer, row[1], definition)
+
+    def write_events(self, connection, writer):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT EVENT_NAME FROM information_schema.EVENTS "
+                "WHERE EVENT_SCHEMA = %s ORDER BY EVENT_NAME",
+                (self.backup.db_name,),
+            )
+            events = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+        writer.write(
+            f"\n--\n-- Dumping events for database '{self.backup.db_name}'\n--\n".encode()
+        )
+        for event in events:
+            quoted = quote_identifier(event)
+            row, definition = self.show_create(connection, f"SHOW CREATE EVENT {quoted}", 3)
+            writer.write(f"/*!50106 DROP EVENT IF EXISTS {quoted} */;\n".encode())
+            self.write_compound(writer, row[1], definition)
+
+    def write_compound(self, writer, sql_mode: str, definition: str):
+        """
+        Write a trigger, routine or event body under its own sql_mode.
+
+        Args:
+            writer: Binary file object receiving the SQL
+            sql_mode: sql_mode the object was created with
+            definition: CREATE statement
+        """
+        writer.write(
+            f"/*!50003 SET @saved_sql_mode = @@sql_mode */;\n"
+            f"/*!50003 SET sql_mode = '{sql_mode}' */;\n"
+            f"DELIMITER ;;\n{definition} ;;\nDELIMITER ;\n"
+            f"/*!50003 SET sql_mode = @saved_sql_mode */;\n".encode()
+        )
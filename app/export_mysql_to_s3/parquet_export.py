@@ -0,0 +1,608 @@
+"""
+Columnar Parquet export
+
+Writes every base table as Parquet files (requires the pyarrow package)
+so backups can be queried in place with Athena, DuckDB, Spark or pandas
+instead of being restored into MySQL. Each MySQL table becomes one
+Hive-partitioned dataset across runs:
+
+    {s3_prefix}/{db_name}/parquet/{table}/run_id={run_id}/part-00000.parquet
+
+Tables with a configured partition column are split further by its date:
+
+    .../run_id={run_id}/{column}_{granularity}={value}/part-00000.parquet
+
+Rows are streamed with unbuffered cursors and written in row groups with
+min/max statistics, so engines skip row groups and columns they do not
+need. A manifest per run is stored under `parquet/_runs/{run_id}/`.
+"""
+
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from manifest import MANIFEST_NAME, RUN_ID_PATTERN, new_manifest, new_run_id, write_manifest
+from s3_multipart import S3MultipartWriter
+from table_dump import (
+    CONSISTENCY_MODES,
+    close_snapshots,
+    list_tables,
+    lock_tables,
+    open_snapshots,
+    quote_identifier,
+    start_consistent_snapshot,
+    unlock_tables,
+)
+
+PARTITION_GRANULARITIES = {"year": "%Y", "month": "%Y-%m", "day": "%Y-%m-%d"}
+
+# Hive's name for the partition of NULL values
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+# Parquet page compression used for each backup codec
+PARQUET_CODECS = {"gzip": "gzip", "pgzip": "gzip", "zstd": "zstd"}
+
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "integer", "bigint")
+BINARY_TYPES = (
+    "binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob",
+    "geometry", "point", "linestring", "polygon", "multipoint",
+    "multilinestring", "multipolygon", "geometrycollection", "geomcollection",
+)
+
+
+def parquet_prefix(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key prefix of the Parquet datasets of a database.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{s3_prefix}/{db_name}/parquet"
+
+
+def parquet_run_prefix(s3_prefix: str, db_name: str, run_id: str) -> str:
+    """
+    Build the S3 key prefix holding the manifest of one Parquet export.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        run_id: Backup run identifier
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{parquet_prefix(s3_prefix, db_name)}/_runs/{run_id}"
+
+
+def list_parquet_run_ids(s3_client, bucket: str, s3_prefix: str, db_name: str) -> list:
+    """
+    List the Parquet exports that completed with a manifest.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Sorted list of run identifiers (oldest first)
+    """
+    run_ids = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=parquet_run_prefix(s3_prefix, db_name, "")
+    ):
+        for obj in page.get("Contents", []):
+            run_id, name = obj["Key"].rsplit("/", 2)[-2:]
+            if name == MANIFEST_NAME and RUN_ID_PATTERN.match(run_id):
+                run_ids.append(run_id)
+    return sorted(run_ids)
+
+
+def parse_partition_columns(value: str) -> dict:
+    """
+    Parse a partition column setting.
+
+    Args:
+        value: Comma-separated "table.column" pairs, e.g.
+            "credit_histories.used_at,orders.created_at"
+
+    Returns:
+        Dict mapping table name to column name
+    """
+    columns = {}
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        table, sep, column = item.partition(".")
+        if not sep or not table or not column:
+            raise ValueError(f"Partition column must be table.column: {item}")
+        columns[table] = column
+    return columns
+
+
+def arrow_type(data_type: str, column_type: str, precision: int, scale: int):
+    """
+    Map a MySQL column type to an Arrow type.
+
+    Args:
+        data_type: information_schema.COLUMNS.DATA_TYPE
+        column_type: information_schema.COLUMNS.COLUMN_TYPE
+        precision: NUMERIC_PRECISION (decimals only)
+        scale: NUMERIC_SCALE (decimals only)
+
+    Returns:
+        pyarrow DataType
+    """
+    if data_type in INTEGER_TYPES:
+        return pa.uint64() if "unsigned" in column_type else pa.int64()
+    if data_type in ("decimal", "numeric"):
+        if precision > 38:
+            return pa.decimal256(precision, scale)
+        return pa.decimal128(precision, scale)
+    if data_type == "float":
+        return pa.float32()
+    if data_type in ("double", "real"):
+        return pa.float64()
+    if data_type == "date":
+        return pa.date32()
+    if data_type == "datetime":
+        return pa.timestamp("us")
+    if data_type == "timestamp":
+        # Read with session time_zone '+00:00'
+        return pa.timestamp("us", tz="UTC")
+    if data_type == "time":
+        return pa.duration("us")
+    if data_type == "year":
+        return pa.int16()
+    if data_type == "bit":
+        return pa.uint64()
+    if data_type in BINARY_TYPES:
+        return pa.binary()
+    return pa.string()
+
+
+def to_text(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, set):
+        return ",".join(sorted(value))
+    return value
+
+
+def partition_value(value, granularity: str) -> str:
+    """
+    Format the partition directory value of a date column value.
+
+    Args:
+        value: date, datetime or None
+        granularity: One of PARTITION_GRANULARITIES
+
+    Returns:
+        Partition value string
+    """
+    if not isinstance(value, date):
+        return NULL_PARTITION
+    return value.strftime(PARTITION_GRANULARITIES[granularity])
+
+
+class ParquetFile:
+    def __init__(self, backup, key: str, schema, compression: str, compression_level: int):
+        """
+        Open a Parquet file streamed into an S3 multipart upload.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing the upload settings
+            key: Destination S3 key
+            schema: pyarrow Schema
+            compression: Parquet compression codec
+            compression_level: Codec level
+        """
+        self.key = key
+        self.schema = schema
+        self.dump_limiter = backup.dump_limiter
+        self.rows = 0
+        self.row_groups = 0
+        self.upload = S3MultipartWriter(
+            backup.s3_client,
+            backup.s3_bucket,
+            key,
+            part_size=backup.upload_part_size,
+            max_workers=backup.upload_concurrency,
+            use_threads=backup.upload_use_threads,
+            extra_args={"ContentType": PARQUET_CONTENT_TYPE},
+            limiter=backup.upload_limiter,
+            checksum_algorithm=backup.checksum_algorithm,
+        )
+        self.writer = pq.ParquetWriter(
+            pa.PythonFile(self.upload, mode="w"),
+            schema,
+            compression=compression,
+            compression_level=compression_level,
+            write_statistics=True,
+        )
+
+    def write_rows(self, rows: list):
+        """
+        Write rows as one row group.
+
+        Args:
+            rows: Row tuples in schema column order
+        """
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema,
+        )
+        if self.dump_limiter:
+            # Rows are already fetched; pacing here slows the next fetches
+            self.dump_limiter.consume(table.nbytes)
+        self.writer.write_table(table, row_group_size=len(rows))
+        self.rows += len(rows)
+        self.row_groups += 1
+
+    def close(self) -> int:
+        """
+        Write the footer and complete the upload.
+
+        Returns:
+            Size of the file in bytes
+        """
+        self.writer.close()
+        self.upload.close()
+        return self.upload.bytes_written
+
+    def abort(self):
+        """
+        Abort the upload.
+        """
+        self.upload.abort()
+
+
+class ParquetExport:
+    def __init__(
+        self,
+        backup,
+        concurrency: int = 4,
+        consistency: str = "lock",
+        partition_columns: dict = None,
+        partition_by: str = "month",
+        row_group_rows: int = 100_000,
+    ):
+        """
+        Initialize Parquet export.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing connection, S3
+                location, compression level and upload settings
+            concurrency: Tables exported at once
+            consistency: Snapshot strategy (see table_dump.CONSISTENCY_MODES)
+            partition_columns: Dict mapping table name to a date, datetime
+                or timestamp column to partition by
+            partition_by: Partition granularity ("year", "month" or "day")
+            row_group_rows: Rows per Parquet row group
+        """
+        if pa is None:
+            raise RuntimeError("pyarrow package is required for parquet mode")
+        if consistency not in CONSISTENCY_MODES:
+            raise ValueError(f"Unknown consistency mode: {consistency}")
+        if partition_by not in PARTITION_GRANULARITIES:
+            raise ValueError(f"Unknown partition granularity: {partition_by}")
+
+        self.backup = backup
+        self.concurrency = concurrency
+        self.consistency = consistency
+        self.partition_columns = partition_columns or {}
+        self.partition_by = partition_by
+        self.row_group_rows = row_group_rows
+        self.compression = PARQUET_CODECS[backup.compressor.name]
+        self.compression_level = backup.compressor.level
+        self.manifest = None
+        self.run_id = new_run_id()
+        self.prefix = parquet_prefix(backup.s3_prefix, backup.db_name)
+
+    def table_schemas(self, connection) -> dict:
+        """
+        Build the Arrow schema of every table from information_schema.
+
+        Args:
+            connection: MySQL connection
+
+        Returns:
+            Dict mapping table name to a pyarrow Schema
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, COLUMN_TYPE,
+                       NUMERIC_PRECISION, NUMERIC_SCALE
+                FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = %s
+                ORDER BY TABLE_NAME, ORDINAL_POSITION
+                """,
+                (self.backup.db_name,),
+            )
+            fields = {}
+            for table, column, data_type, column_type, precision, scale in cursor.fetchall():
+                field = pa.field(
+                    column,
+                    arrow_type(data_type.lower(), column_type.lower(), precision, scale),
+                )
+                fields.setdefault(table, []).append(field)
+            return {table: pa.schema(table_fields) for table, table_fields in fields.items()}
+        finally:
+            cursor.close()
+
+    def partition_column(self, table: str, schema) -> str:
+        """
+        Look up and validate the partition column of a table.
+
+        Args:
+            table: Table name
+            schema: Arrow schema of the table
+
+        Returns:
+            Column name, or None when the table is not partitioned
+        """
+        column = self.partition_columns.get(table)
+        if column is None:
+            return None
+        if column not in schema.names:
+            raise ValueError(f"Partition column {table}.{column} does not exist")
+        field_type = schema.field(column).type
+        if not (pa.types.is_date(field_type) or pa.types.is_timestamp(field_type)):
+            raise ValueError(
+                f"Partition column {table}.{column} must be a date, datetime or timestamp"
+            )
+        return column
+
+    def export_table(
+        self, name: str, schema, fetch_size: int = 10_000, snapshots: queue.Queue = None
+    ) -> list:
+        """
+        Stream one table into Parquet files on S3.
+
+        Partitioned tables are read ordered by the partition column, so
+        only one file is open at a time and row group statistics stay
+        tight; an index on the column avoids a filesort.
+
+        Args:
+            name: Table name
+            schema: Arrow schema of the table
+            fetch_size: Rows fetched from the server per round trip
+            snapshots: Idle connections from open_snapshots(); the export
+                borrows one and reads inside its snapshot
+
+        Returns:
+            Manifest object entries, one per file
+        """
+        column = self.partition_column(name, schema)
+        table_prefix = f"{self.prefix}/{name}/run_id={self.run_id}"
+        text_columns = [
+            index for index, field in enumerate(schema) if pa.types.is_string(field.type)
+        ]
+        partition_index = schema.names.index(column) if column else None
+
+        query = "SELECT " + ", ".join(quote_identifier(n) for n in schema.names)
+        query += f" FROM {quote_identifier(name)}"
+        if column:
+            query += f" ORDER BY {quote_identifier(column)}"
+
+        entries = []
+        current = None
+        partition = None
+        rows = []
+
+        def open_file(value: str = None) -> ParquetFile:
+            directory = table_prefix
+            if column:
+                directory += f"/{column}_{self.partition_by}={value}"
+            return ParquetFile(
+                self.backup,
+                f"{directory}/part-00000.parquet",
+                schema,
+                self.compression,
+                self.compression_level,
+            )
+
+        def close_file():
+            size = current.close()
+            entry = {
+                "name": name,
+                "kind": "parquet",
+                "key": current.key,
+                "rows": current.rows,
+                "row_groups": current.row_groups,
+                "bytes": size,
+            }
+            if column:
+                entry["partition"] = partition
+            if current.upload.checksum:
+                entry["checksums"] = current.upload.checksums()
+            entries.append(entry)
+
+        started = time.monotonic()
+        snapshot = snapshots.get() if snapshots else None
+        connection = snapshot or self.backup.connect()
+        try:
+            if snapshot is None:
+                start_consistent_snapshot(connection)
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query)
+                while fetched := cursor.fetchmany(fetch_size):
+                    for row in fetched:
+                        if text_columns:
+                            row = list(row)
+                            for index in text_columns:
+                                row[index] = to_text(row[index])
+                        if column:
+                            value = partition_value(row[partition_index], self.partition_by)
+                            if value != partition:
+                                if rows:
+                                    current.write_rows(rows)
+                                    rows = []
+                                if current:
+                                    close_file()
+                                partition = value
+                                current = open_file(value)
+                        elif current is None:
+                            current = open_file()
+                        rows.append(row)
+                        if len(rows) >= self.row_group_rows:
+                            current.write_rows(rows)
+                            rows = []
+            finally:
+                cursor.close()
+            if snapshot is None:
+                connection.rollback()
+
+            if current is None:
+                # Empty table: keep its schema queryable
+                current = open_file(NULL_PARTITION) if column else open_file()
+            elif rows:
+                current.write_rows(rows)
+            close_file()
+            current = None
+        except Exception:
+            if current:
+                current.abort()
+            raise
+        finally:
+            if snapshot is None:
+                connection.close()
+            else:
+                snapshots.put(snapshot)
+
+        seconds = round(time.monotonic() - started, 3)
+        for entry in entries:
+            entry["seconds"] = seconds
+        return entries
+
+    def run(self) -> str:
+        """
+        Export all base tables concurrently and write the manifest.
+
+        Returns:
+            S3 URI of the manifest
+        """
+        backup = self.backup
+        connection = backup.connect()
+        snapshots = []
+        try:
+            tables = [
+                t["name"] for t in list_tables(connection, backup.db_name)
+                if t["type"] == "BASE TABLE"
+            ]
+            schemas = self.table_schemas(connection)
+            unknown = sorted(set(self.partition_columns) - set(tables))
+            if unknown:
+                raise ValueError(
+                    f"Partition columns given for unknown tables: {', '.join(unknown)}"
+                )
+            for name in tables:
+                self.partition_column(name, schemas[name])
+
+            if self.consistency == "lock" and tables:
+                # Workers start their snapshots while writes wait on the lock
+                lock_tables(connection, tables)
+                try:
+                    snapshots = open_snapshots(backup, min(self.concurrency, len(tables)))
+                finally:
+                    # Before any row group is fetched and throttled
+                    unlock_tables(connection)
+
+            print(
+                f"Exporting {len(tables)} table(s) to Parquet with concurrency "
+                f"{self.concurrency} (consistency: {self.consistency}, "
+                f"compression: {self.compression})"
+            )
+            entries = self.export_tables(tables, schemas, snapshots)
+        finally:
+            close_snapshots(snapshots)
+            connection.close()
+
+        entries.sort(key=lambda e: (e["name"], e.get("partition", "")))
+        manifest = new_manifest(
+            backup.db_name,
+            self.run_id,
+            "parquet",
+            compression=self.compression,
+            compress_level=self.compression_level,
+            consistency=self.consistency,
+            partition_by=self.partition_by,
+            partition_columns=self.partition_columns,
+            row_group_rows=self.row_group_rows,
+            # [column, Arrow type] per table
+            schemas={
+                name: [[field.name, str(field.type)] for field in schemas[name]]
+                for name in tables
+            },
+        )
+        manifest["objects"] = entries
+        manifest_key = write_manifest(
+            backup.s3_client,
+            backup.s3_bucket,
+            parquet_run_prefix(backup.s3_prefix, backup.db_name, self.run_id),
+            manifest,
+        )
+        self.manifest = manifest
+
+        rows = sum(e["rows"] for e in entries)
+        total = sum(e["bytes"] for e in entries)
+        print(f"Exported {rows:,} row(s) into {len(entries)} Parquet file(s): {total:,} bytes")
+        return f"s3://{backup.s3_bucket}/{manifest_key}"
+
+    def export_tables(self, tables: list, schemas: dict, snapshots: list = ()) -> list:
+        """
+        Run table exports through the worker pool.
+
+        Args:
+            tables: Base table names
+            schemas: Arrow schemas from table_schemas()
+            snapshots: Connections from open_snapshots() shared by the
+                workers; empty to give every table its own snapshot
+
+        Returns:
+            Manifest object entries in completion order
+        """
+        idle = None
+        if snapshots:
+            idle = queue.Queue()
+            for connection in snapshots:
+                idle.put(connection)
+
+        entries = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self.export_table, name, schemas[name], self.backup.dump_fetch_size, idle
+                ): name
+                for name in tables
+            }
+            try:
+                for future in as_completed(futures):
+                    entries.extend(future.result())
+            except Exception as e:
+                print(f"Error exporting {futures[future]}: {e}", file=sys.stderr)
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        return entries
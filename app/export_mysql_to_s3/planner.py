@@ -0,0 +1,456 @@
+"""
+Backup size and duration estimates
+
+`main.py --plan` estimates what a backup of the database will take
+before the first one runs, without dumping it:
+
+  size   - row counts and data/index lengths from information_schema
+  ratio  - a few pages worth of rows of each large table, formatted the
+           way the native engine writes them and compressed with the
+           configured codec, give dump bytes per row and the
+           compression ratio; other tables use the averages
+  speed  - dump throughput of the last runs of each mode in the
+           catalog, otherwise the compression speed measured on the
+           samples, capped by the configured rate limits
+
+For every pipeline mode it prints dump time, compressed size, S3 parts
+(or chunk objects), peak scratch disk in backup_dir and peak memory held
+in upload buffers. InnoDB row counts are themselves estimates, and
+Parquet sizes use the SQL dump ratio, so treat the numbers as a guide.
+Incremental backups depend on binlog volume and are not estimated.
+"""
+
+import math
+import sqlite3
+import statistics
+import sys
+import time
+
+import mysql.connector
+from botocore.exceptions import ClientError
+
+from dedup import AVG_CHUNK_SIZE, MAX_CHUNK_SIZE
+from encryption import CHUNK_SIZE
+from native_dump import value_formatter
+from s3_multipart import MAX_PARTS, MiB, auto_part_size, stream_part_size
+from table_dump import list_tables, quote_identifier
+from tee import QUEUE_CHUNKS
+
+PLAN_MODES = ("file", "stream", "tables", "archive", "dedup", "parquet")
+
+# InnoDB default page size
+PAGE_SIZE = 16 * 1024
+
+# Pages worth of rows sampled per table
+SAMPLE_PAGES = 8
+
+# Largest tables sampled; smaller ones use the averages of these
+SAMPLE_TABLES = 10
+
+SAMPLE_MAX_ROWS = 10_000
+
+# Catalog runs per mode whose throughput is averaged
+HISTORY_RUNS = 5
+
+# Compressed/raw ratio assumed when nothing could be sampled
+DEFAULT_RATIO = 0.25
+
+
+def stream_parts(size: int, part_size: int = None) -> tuple:
+    """
+    Count the parts of a streamed upload.
+
+    Args:
+        size: Object size in bytes
+        part_size: Fixed part size (growing stream parts when None)
+
+    Returns:
+        Tuple of (parts, largest part size)
+    """
+    if part_size:
+        return max(1, math.ceil(size / part_size)), part_size
+    parts = 0
+    uploaded = 0
+    largest = stream_part_size(1)
+    while uploaded < size and parts < MAX_PARTS:
+        parts += 1
+        largest = stream_part_size(parts)
+        uploaded += largest
+    return max(1, parts), largest
+
+
+def format_bytes(size: float) -> str:
+    """
+    Format a byte count with a binary unit.
+
+    Args:
+        size: Bytes
+
+    Returns:
+        String such as "12.3 GiB"
+    """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:,.0f} {unit}" if unit == "B" else f"{size:,.1f} {unit}"
+        size /= 1024
+    return f"{size:,.1f} TiB"
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Format a duration as hours, minutes and seconds.
+
+    Args:
+        seconds: Duration
+
+    Returns:
+        String such as "1h 05m" or "42s"
+    """
+    seconds = round(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class BackupPlanner:
+    def __init__(self, backup, sample_tables: int = SAMPLE_TABLES):
+        """
+        Initialize the planner.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing connection, codec,
+                upload settings and catalog
+            sample_tables: Largest tables whose rows are sampled
+        """
+        self.backup = backup
+        self.sample_tables = sample_tables
+
+    def sample_table(self, connection, name: str, columns: list, rows: int) -> dict:
+        """
+        Dump and compress the first rows of a table in memory.
+
+        Args:
+            connection: MySQL connection
+            name: Table name
+            columns: Columns from NativeDump.table_columns()
+            rows: Rows to fetch
+
+        Returns:
+            Dict with rows, raw_bytes, bytes and seconds (compression time)
+        """
+        stored = [
+            (column, data_type) for column, data_type, generated in columns if not generated
+        ]
+        formatters = [value_formatter(data_type) for _, data_type in stored]
+        column_list = ", ".join(quote_identifier(column) for column, _ in stored)
+
+        cursor = connection.cursor(raw=True)
+        try:
+            cursor.execute(f"SELECT {column_list} FROM {quote_identifier(name)} LIMIT {rows}")
+            fetched = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        values = [
+            b"(" + b",".join([fmt(value) for fmt, value in zip(formatters, row)]) + b")"
+            for row in fetched
+        ]
+        sql = f"INSERT INTO {quote_identifier(name)} VALUES ".encode() + b",".join(values)
+
+        started = time.monotonic()
+        obj = self.backup.compressor.compressobj()
+        compressed = len(obj.compress(sql)) + len(obj.flush())
+        return {
+            "rows": len(fetched),
+            "raw_bytes": len(sql),
+            "bytes": compressed,
+            "seconds": time.monotonic() - started,
+        }
+
+    def estimate_tables(self) -> tuple:
+        """
+        Estimate the dump and compressed size of every table.
+
+        Returns:
+            Tuple of (tables, sample) where tables is a list of dicts with
+            name, rows, data_length, index_length, raw_bytes, bytes and
+            sampled, and sample sums rows, raw_bytes, bytes, seconds and
+            data_length over the sampled tables
+        """
+        backup = self.backup
+        connection = backup.connect()
+        try:
+            tables = [
+                table
+                for table in list_tables(connection, backup.db_name)
+                if table["type"] == "BASE TABLE"
+            ]
+            largest = sorted(tables, key=lambda t: t["data_length"], reverse=True)
+            to_sample = [t for t in largest[: self.sample_tables] if t["rows_estimate"]]
+            columns = backup.native_dump().table_columns(connection) if to_sample else {}
+
+            samples = {}
+            for table in to_sample:
+                avg_row = max(1, table["data_length"] / table["rows_estimate"])
+                rows = min(SAMPLE_MAX_ROWS, max(1, int(SAMPLE_PAGES * PAGE_SIZE / avg_row)))
+                try:
+                    samples[table["name"]] = self.sample_table(
+                        connection, table["name"], columns[table["name"]], rows
+                    )
+                except mysql.connector.Error as e:
+                    print(f"Warning: cannot sample {table['name']}: {e}", file=sys.stderr)
+        finally:
+            connection.close()
+
+        sample = {"rows": 0, "raw_bytes": 0, "bytes": 0, "seconds": 0.0, "data_length": 0}
+        for name, result in samples.items():
+            if not result["rows"]:
+                continue
+            table = next(t for t in tables if t["name"] == name)
+            for field in ("rows", "raw_bytes", "bytes", "seconds"):
+                sample[field] += result[field]
+            # On-disk bytes of the sampled rows
+            avg_row = table["data_length"] / table["rows_estimate"]
+            sample["data_length"] += avg_row * result["rows"]
+
+        # Dump bytes per on-disk byte and compressed per dump byte
+        expansion = 1.0
+        ratio = DEFAULT_RATIO
+        if sample["data_length"]:
+            expansion = sample["raw_bytes"] / sample["data_length"]
+        if sample["raw_bytes"]:
+            ratio = sample["bytes"] / sample["raw_bytes"]
+
+        estimates = []
+        for table in tables:
+            result = samples.get(table["name"])
+            if result and result["rows"]:
+                raw_bytes = result["raw_bytes"] / result["rows"] * table["rows_estimate"]
+                table_ratio = result["bytes"] / result["raw_bytes"]
+            else:
+                raw_bytes = table["data_length"] * expansion
+                table_ratio = ratio
+            estimates.append(
+                {
+                    "name": table["name"],
+                    "rows": table["rows_estimate"],
+                    "data_length": table["data_length"],
+                    "index_length": table["index_length"],
+                    "raw_bytes": int(raw_bytes),
+                    "bytes": int(raw_bytes * table_ratio),
+                    "sampled": bool(result and result["rows"]),
+                }
+            )
+        return estimates, sample
+
+    def history_throughput(self, mode: str) -> tuple:
+        """
+        Dump throughput of the last catalog runs of a mode.
+
+        Args:
+            mode: Pipeline mode
+
+        Returns:
+            Tuple of (median bytes of dump per second, runs used), or
+            (None, 0) without usable runs or catalog
+        """
+        if not self.backup.catalog:
+            return None, 0
+        try:
+            backups = self.backup.catalog.backups(mode=mode)
+        except (ClientError, sqlite3.Error) as e:
+            print(f"Warning: catalog not read: {e}", file=sys.stderr)
+            return None, 0
+        rates = [
+            b["raw_bytes"] / b["seconds"]
+            for b in backups
+            if b["kind"] == "full" and b["raw_bytes"] and b["seconds"]
+        ][:HISTORY_RUNS]
+        if not rates:
+            return None, 0
+        return statistics.median(rates), len(rates)
+
+    def sample_throughput(self, sample: dict, mode: str, ratio: float) -> float:
+        """
+        Dump throughput expected from the compression speed of the samples.
+
+        Args:
+            sample: Sample totals returned by estimate_tables()
+            mode: Pipeline mode
+            ratio: Compressed/raw ratio
+
+        Returns:
+            Bytes of dump per second, or None if nothing was sampled
+        """
+        backup = self.backup
+        if not sample["seconds"]:
+            return None
+        rate = sample["raw_bytes"] / sample["seconds"]
+        if mode in ("tables", "parquet"):
+            # One compressor per table in flight
+            rate *= backup.dump_concurrency
+        if backup.dump_limiter and backup.dump_limiter.rate:
+            rate = min(rate, backup.dump_limiter.rate)
+        if backup.upload_limiter:
+            rate = min(rate, backup.upload_limiter.rate / ratio)
+        return rate
+
+    def plan_mode(self, mode: str, tables: list) -> dict:
+        """
+        Estimate parts, disk and memory of one pipeline mode.
+
+        Args:
+            mode: Pipeline mode
+            tables: Table estimates returned by estimate_tables()
+
+        Returns:
+            Dict with objects, parts, disk and memory (bytes)
+        """
+        backup = self.backup
+        raw_bytes = sum(t["raw_bytes"] for t in tables)
+        size = sum(t["bytes"] for t in tables)
+        workers = backup.upload_concurrency if backup.upload_use_threads else 1
+        part_size = backup.upload_part_size
+        # Chunks sealed ahead of the writer, per encrypted stream
+        encryption = backup.encryption.threads * 2 * CHUNK_SIZE if backup.encryption else 0
+
+        if mode == "file":
+            part_size = part_size or auto_part_size(size)
+            return {
+                "objects": 1,
+                "parts": max(1, math.ceil(size / part_size)),
+                # The dump is removed once it is compressed
+                "disk": raw_bytes + size,
+                "memory": workers * part_size,
+            }
+
+        if mode in ("stream", "archive"):
+            parts, largest = stream_parts(size, part_size)
+            memory = (workers + 1) * largest + encryption
+            for destination in backup.mirror_destinations:
+                memory += QUEUE_CHUNKS * MiB
+                if destination["kind"] == "s3":
+                    memory += (workers + 1) * largest
+            return {"objects": 1, "parts": parts, "disk": 0, "memory": memory}
+
+        if mode == "dedup":
+            # First run; later runs only upload changed chunks
+            chunks = max(1, math.ceil(raw_bytes / AVG_CHUNK_SIZE))
+            return {
+                "objects": chunks + 1,
+                "parts": chunks + 1,
+                "disk": 0,
+                "memory": backup.upload_concurrency * 2 * MAX_CHUNK_SIZE,
+            }
+
+        # tables and parquet: one or more objects per table, dump_concurrency at once
+        objects = 0
+        parts = 0
+        buffers = []
+        for table in tables:
+            count = 1
+            if mode == "tables" and backup.dump_chunk_rows and table["rows"]:
+                count = max(1, math.ceil(table["rows"] / backup.dump_chunk_rows))
+            object_size = table["bytes"] / count
+            object_parts, largest = stream_parts(object_size, part_size)
+            objects += count
+            parts += count * object_parts
+            buffer = min(object_size, (workers + 1) * largest) + encryption
+            if mode == "parquet" and table["rows"]:
+                # One row group of fetched rows before it is written
+                rows = min(table["rows"], backup.parquet_row_group_rows)
+                buffer += rows * table["raw_bytes"] / table["rows"]
+            buffers.append(buffer)
+        buffers.sort(reverse=True)
+        return {
+            "objects": objects,
+            "parts": parts,
+            "disk": 0,
+            "memory": int(sum(buffers[: backup.dump_concurrency])),
+        }
+
+    def run(self) -> dict:
+        """
+        Estimate and print the backup of every pipeline mode.
+
+        Returns:
+            Dict with database, tables, sample, ratio and modes (mode ->
+            dict with raw_bytes, bytes, seconds, throughput, source,
+            objects, parts, disk and memory)
+        """
+        backup = self.backup
+        tables, sample = self.estimate_tables()
+        raw_bytes = sum(t["raw_bytes"] for t in tables)
+        size = sum(t["bytes"] for t in tables)
+        ratio = size / raw_bytes if raw_bytes else DEFAULT_RATIO
+
+        modes = {}
+        for mode in PLAN_MODES:
+            throughput, runs = self.history_throughput(mode)
+            source = f"{runs} run(s)" if runs else "sample"
+            if throughput is None:
+                throughput = self.sample_throughput(sample, mode, ratio)
+            plan = self.plan_mode(mode, tables)
+            plan.update(
+                raw_bytes=raw_bytes,
+                bytes=size,
+                throughput=throughput,
+                seconds=raw_bytes / throughput if throughput else None,
+                source=source if throughput else "-",
+            )
+            modes[mode] = plan
+
+        result = {
+            "database": backup.db_name,
+            "tables": tables,
+            "sample": sample,
+            "ratio": ratio,
+            "modes": modes,
+        }
+        self.print_plan(result)
+        return result
+
+    def print_plan(self, plan: dict):
+        """
+        Print the estimates of run().
+
+        Args:
+            plan: Dict returned by run()
+        """
+        backup = self.backup
+        tables = plan["tables"]
+        sample = plan["sample"]
+        data = sum(t["data_length"] for t in tables)
+        indexes = sum(t["index_length"] for t in tables)
+        rows = sum(t["rows"] for t in tables)
+        print(
+            f"Plan for {plan['database']}: {len(tables)} table(s), ~{rows:,} rows, "
+            f"{format_bytes(data)} data, {format_bytes(indexes)} indexes"
+        )
+        sampled = sum(1 for t in tables if t["sampled"])
+        if sampled and sample["data_length"]:
+            print(
+                f"Sampled {sample['rows']:,} rows of {sampled} table(s): dump "
+                f"{sample['raw_bytes'] / sample['data_length']:.2f}x data size, "
+                f"{backup.compressor.name} level {backup.compressor.level} ratio "
+                f"{plan['ratio']:.3f}"
+            )
+        else:
+            print(f"Nothing sampled; assuming a compression ratio of {DEFAULT_RATIO}")
+
+        print(
+            f"{'MODE':<8} {'DUMP TIME':>10} {'DUMP':>11} {'COMPRESSED':>11} "
+            f"{'OBJECTS':>8} {'PARTS':>8} {'PEAK DISK':>11} {'PEAK MEMORY':>11}  SPEED FROM"
+        )
+        for mode, estimate in plan["modes"].items():
+            seconds = estimate["seconds"]
+            duration = format_duration(seconds) if seconds is not None else "-"
+            print(
+                f"{mode:<8} {duration:>10} {format_bytes(estimate['raw_bytes']):>11} "
+                f"{format_bytes(estimate['bytes']):>11} {estimate['objects']:>8,} "
+                f"{estimate['parts']:>8,} {format_bytes(estimate['disk']):>11} "
+                f"{format_bytes(estimate['memory']):>11}  {estimate['source']}"
+            )
+        print(f"Peak disk is scratch space in {backup.backup_dir}")
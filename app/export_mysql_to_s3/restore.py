@@ -0,0 +1,657 @@
+"""
+Restore MySQL backups from S3
+
+Streams backup objects from S3 through the matching decompressor into
+the mysql client without writing them to disk. Per-table backups are
+restored in parallel, single tables are extracted from seekable archives
+with ranged GETs, deduplicated backups are reassembled from chunks
+fetched in parallel, and binlogs of an incremental chain can be replayed up
+to a target time.
+"""
+
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+from archive import archive_key, extract_sections, read_archive_index, select_sections
+from compressors import ZstdCompressor, codec_for_key, get_compressor
+from dedup import read_recipe, reassemble, recipe_key
+from encryption import DecryptingDecompressor, object_encryption
+from incremental import base_prefix, find_latest_chain
+from manifest import list_run_ids, read_manifest, run_prefix, run_time
+from parquet_export import list_parquet_run_ids, parquet_run_prefix
+from table_dump import quote_identifier
+from zstd_dictionary import load_dictionary
+
+MiB = 1024 * 1024
+
+
+class RestoreFromS3:
+    def __init__(self, backup, target_db: str = None, concurrency: int = 4):
+        """
+        Initialize restore.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing S3 location, client
+                options and S3 client
+            target_db: Database to restore into (source db_name when None)
+            concurrency: Tables restored at once from per-table backups
+        """
+        self.backup = backup
+        self.target_db = target_db or backup.db_name
+        self.concurrency = concurrency
+        self.dictionaries = {}
+        self._dictionary_lock = threading.Lock()
+
+    def mysql_command(self) -> list:
+        """
+        Build the mysql client command reading SQL from stdin.
+
+        Returns:
+            Command as a list of arguments
+        """
+        return ["mysql", *self.backup.client_options(), self.target_db]
+
+    def ensure_database(self):
+        """
+        Create the target database if it does not exist.
+        """
+        subprocess.run(
+            [
+                "mysql",
+                *self.backup.client_options(),
+                "-e",
+                f"CREATE DATABASE IF NOT EXISTS {quote_identifier(self.target_db)}",
+            ],
+            check=True,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+
+    def dictionary_compressor(self, key: str) -> ZstdCompressor:
+        """
+        Get a compressor for a trained zstd dictionary, downloading it once.
+
+        Args:
+            key: S3 key of the dictionary
+
+        Returns:
+            ZstdCompressor using the dictionary
+        """
+        with self._dictionary_lock:
+            if key not in self.dictionaries:
+                data = load_dictionary(self.backup.s3_client, self.backup.s3_bucket, key)
+                self.dictionaries[key] = ZstdCompressor(dictionary=data)
+            return self.dictionaries[key]
+
+    def stream_object(self, key: str, writer, dictionary: str = None) -> int:
+        """
+        Download an object and write its decompressed content.
+
+        Args:
+            key: S3 key of a compressed backup object
+            writer: Binary file object receiving the decompressed bytes
+            dictionary: S3 key of the zstd dictionary the object was
+                compressed with, if any
+
+        Returns:
+            Number of decompressed bytes written
+        """
+        if dictionary:
+            decompressor = self.dictionary_compressor(dictionary).decompressobj()
+        else:
+            decompressor = get_compressor(codec_for_key(key)).decompressobj()
+        response = self.backup.s3_client.get_object(Bucket=self.backup.s3_bucket, Key=key)
+        encryption = object_encryption(key, self.backup.encryption)
+        if encryption:
+            decompressor = DecryptingDecompressor(
+                encryption.decryptobj(response["ContentLength"]), decompressor
+            )
+
+        written = 0
+        for chunk in response["Body"].iter_chunks(MiB):
+            data = decompressor.decompress(chunk)
+            writer.write(data)
+            written += len(data)
+        return written
+
+    def restore_object(self, key: str, dictionary: str = None) -> int:
+        """
+        Stream one SQL backup object into the target database.
+
+        Args:
+            key: S3 key of the compressed SQL object or of a dedup recipe
+            dictionary: S3 key of the object's zstd dictionary, if any
+
+        Returns:
+            Number of SQL bytes restored
+        """
+        print(f"Restoring s3://{self.backup.s3_bucket}/{key}")
+        if key.endswith(".json"):
+            return self.write_into_mysql(key, lambda writer: self.reassemble(key, writer))
+        return self.write_into_mysql(
+            key, lambda writer: self.stream_object(key, writer, dictionary)
+        )
+
+    def reassemble(self, key: str, writer) -> int:
+        """
+        Write the dump described by a dedup recipe.
+
+        Args:
+            key: S3 key of the recipe
+            writer: Binary file object receiving the dump
+
+        Returns:
+            Number of bytes written
+        """
+        backup = self.backup
+        recipe = read_recipe(backup.s3_client, backup.s3_bucket, key)
+        return reassemble(
+            backup.s3_client,
+            backup.s3_bucket,
+            backup.s3_prefix,
+            recipe,
+            writer,
+            concurrency=max(self.concurrency, backup.upload_concurrency),
+            encryption=backup.encryption,
+        )
+
+    def write_into_mysql(self, label: str, produce) -> int:
+        """
+        Run the mysql client and feed it SQL.
+
+        Args:
+            label: Name used in error messages
+            produce: Callable writing SQL to the binary file object it is
+                given and returning the number of bytes written
+
+        Returns:
+            Number of SQL bytes written
+        """
+        process = subprocess.Popen(
+            self.mysql_command(), stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stderr_chunks = []
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+        )
+        stderr_thread.start()
+
+        try:
+            written = produce(process.stdin)
+        except BrokenPipeError:
+            written = 0
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+            stderr_thread.join()
+
+        if returncode != 0:
+            stderr = b"".join(stderr_chunks).decode(errors="replace")
+            print(f"Error restoring {label}: {stderr}", file=sys.stderr)
+            raise subprocess.CalledProcessError(returncode, "mysql", stderr=stderr)
+        return written
+
+    def restore_manifest(self, manifest: dict) -> int:
+        """
+        Restore a per-table backup.
+
+        Tables are restored concurrently; chunks of one table are restored
+        in order by the same worker. Schema objects follow the tables.
+
+        Args:
+            manifest: Manifest of a tables mode backup
+
+        Returns:
+            Number of SQL bytes restored
+        """
+        tables = {}
+        others = []
+        for obj in manifest["objects"]:
+            if obj["kind"] == "table":
+                tables.setdefault(obj["name"], []).append(obj)
+            else:
+                others.append(obj)
+
+        def restore_table(objects: list) -> int:
+            objects = sorted(objects, key=lambda obj: obj.get("chunk", 0))
+            return sum(
+                self.restore_object(obj["key"], obj.get("dictionary")) for obj in objects
+            )
+
+        print(f"Restoring {len(tables)} table(s) with concurrency {self.concurrency}")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Largest tables first to shorten the total runtime
+            groups = sorted(
+                tables.values(),
+                key=lambda objects: sum(obj["bytes"] for obj in objects),
+                reverse=True,
+            )
+            restored = sum(executor.map(restore_table, groups))
+
+        for obj in others:
+            restored += self.restore_object(obj["key"], obj.get("dictionary"))
+        return restored
+
+    def archive_sections(self, key: str, tables: list) -> list:
+        """
+        Read an archive index and pick the sections of some tables.
+
+        Args:
+            key: S3 key of a seekable archive
+            tables: Table or view names
+
+        Returns:
+            Index sections in restore order
+        """
+        index = read_archive_index(
+            self.backup.s3_client, self.backup.s3_bucket, key, self.backup.encryption
+        )
+        return select_sections(index, tables)
+
+    def restore_archive_tables(self, key: str, tables: list) -> int:
+        """
+        Restore some tables from a seekable archive with ranged GETs.
+
+        Args:
+            key: S3 key of the archive
+            tables: Table or view names
+
+        Returns:
+            Number of SQL bytes restored
+        """
+        backup = self.backup
+        index = read_archive_index(backup.s3_client, backup.s3_bucket, key, backup.encryption)
+
+        def restore_table(name: str) -> int:
+            sections = select_sections(index, [name])
+            size = sum(section["bytes"] for section in sections)
+            print(f"Restoring {name} from s3://{backup.s3_bucket}/{key} ({size:,} bytes)")
+            return self.write_into_mysql(
+                name,
+                lambda writer: extract_sections(
+                    backup.s3_client,
+                    backup.s3_bucket,
+                    key,
+                    sections,
+                    writer,
+                    encryption=backup.encryption,
+                ),
+            )
+
+        # Fail on unknown names before anything is restored
+        select_sections(index, tables)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return sum(executor.map(restore_table, tables))
+
+    def list_archive(self, key: str = None):
+        """
+        Print the sections of a seekable archive.
+
+        Args:
+            key: S3 key of the archive (latest archive when None)
+        """
+        backup = self.backup
+        key = key or self.latest_key("archive")
+        index = read_archive_index(backup.s3_client, backup.s3_bucket, key, backup.encryption)
+        print(
+            f"s3://{backup.s3_bucket}/{key} "
+            f"({index['codec']}, {index['raw_bytes']:,} bytes of SQL)"
+        )
+        for section in index["sections"]:
+            print(
+                f"  {section['kind']:<8} {section['name']:<40} "
+                f"{section['raw_bytes']:>15,} -> {section['bytes']:>15,} bytes "
+                f"in {len(section['frames'])} frame(s)"
+            )
+
+    def extract(self, tables: list, writer, key: str = None) -> int:
+        """
+        Write the SQL of some tables of a seekable archive.
+
+        Args:
+            tables: Table or view names
+            writer: Binary file object receiving the SQL
+            key: S3 key of the archive (latest archive when None)
+
+        Returns:
+            Number of SQL bytes written
+        """
+        backup = self.backup
+        key = key or self.latest_key("archive")
+        sections = self.archive_sections(key, tables)
+        written = extract_sections(
+            backup.s3_client,
+            backup.s3_bucket,
+            key,
+            sections,
+            writer,
+            encryption=backup.encryption,
+        )
+        fetched = sum(section["bytes"] for section in sections)
+        print(
+            f"Extracted {written:,} bytes of SQL from s3://{backup.s3_bucket}/{key} "
+            f"({fetched:,} bytes fetched)",
+            file=sys.stderr,
+        )
+        return written
+
+    def latest_recipe(self) -> str:
+        """
+        Find the recipe of the most recent dedup backup.
+
+        Returns:
+            S3 key of the recipe
+        """
+        backup = self.backup
+        latest = backup.catalog.latest("dedup") if backup.catalog else None
+        if latest:
+            return latest["uri"].split("/", 3)[3]
+
+        prefix = recipe_key(backup.s3_prefix, backup.db_name, "").removesuffix(".json")
+        keys = []
+        paginator = backup.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=backup.s3_bucket, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        if not keys:
+            raise RuntimeError("No dedup backups found")
+        # Run IDs are timestamps, so the lexically last key is the newest
+        return max(keys)
+
+    def latest_run_id(self, mode: str = "tables") -> str:
+        """
+        Find the most recent per-table backup run.
+
+        Args:
+            mode: Manifest mode ("tables" or "parquet")
+
+        Returns:
+            Run identifier
+        """
+        backup = self.backup
+        latest = backup.catalog.latest(mode) if backup.catalog else None
+        if latest:
+            return latest["run_id"]
+
+        if mode == "parquet":
+            run_ids = list_parquet_run_ids(
+                backup.s3_client, backup.s3_bucket, backup.s3_prefix, backup.db_name
+            )
+        else:
+            run_ids = list_run_ids(
+                backup.s3_client,
+                backup.s3_bucket,
+                backup.s3_prefix,
+                backup.db_name,
+                complete=True,
+            )
+        if not run_ids:
+            raise RuntimeError(f"No {mode} backups found")
+        return run_ids[-1]
+
+    def manifest_prefix(self, run_id: str, mode: str = "tables") -> str:
+        """
+        Build the S3 prefix holding the manifest of a run.
+
+        Args:
+            run_id: Backup run identifier
+            mode: Manifest mode ("tables" or "parquet")
+
+        Returns:
+            Key prefix without trailing slash
+        """
+        backup = self.backup
+        if mode == "parquet":
+            return parquet_run_prefix(backup.s3_prefix, backup.db_name, run_id)
+        return run_prefix(backup.s3_prefix, backup.db_name, run_id)
+
+    def latest_key(self, mode: str = None) -> str:
+        """
+        Key of the newest single-object backup of a mode.
+
+        With binlog tracking, backups have per-run keys and the newest one
+        is taken from the catalog or a listing; the key every untracked
+        run overwrites is the fallback.
+
+        Args:
+            mode: Pipeline mode (the configured one when None)
+
+        Returns:
+            S3 key of the archive in archive mode, otherwise of the
+            single-file backup
+        """
+        backup = self.backup
+        mode = mode or backup.backup_mode
+        if mode == "archive":
+            key = archive_key(backup.s3_prefix, backup.db_name, backup.extension)
+        else:
+            key = f"{backup.s3_prefix}/{backup.db_name}.sql{backup.extension}"
+        if not backup.track_binlog:
+            return key
+
+        latest = backup.catalog.latest(mode) if backup.catalog else None
+        if latest:
+            return latest["uri"].split("/", 3)[3]
+        name = "/" + key.rsplit("/", 1)[-1]
+        paginator = backup.s3_client.get_paginator("list_objects_v2")
+        keys = [
+            obj["Key"]
+            for page in paginator.paginate(
+                Bucket=backup.s3_bucket,
+                Prefix=base_prefix(backup.s3_prefix, backup.db_name) + "/",
+            )
+            for obj in page.get("Contents", [])
+            if obj["Key"].endswith(name)
+        ]
+        # Run IDs are timestamps, so the lexically last key is the newest
+        return max(keys) if keys else key
+
+    def check_base(self, base: dict):
+        """
+        Make sure the full backup of a chain is still the one it started from.
+
+        Args:
+            base: Base entry of a chain manifest
+
+        Raises:
+            RuntimeError: If the base object is gone or was overwritten
+        """
+        if base.get("superseded_by"):
+            raise RuntimeError(
+                f"Base backup {base['uri']} of chain {base['run_id']} was superseded by "
+                f"backup {base['superseded_by']}; refusing to replay its binlogs onto it"
+            )
+        if not base.get("etag"):
+            return
+        backup = self.backup
+        key = base["uri"].split("/", 3)[3]
+        try:
+            head = backup.s3_client.head_object(Bucket=backup.s3_bucket, Key=key)
+        except ClientError as e:
+            raise RuntimeError(
+                f"Base backup {base['uri']} of chain {base['run_id']} is not readable: {e}"
+            ) from e
+        if head["ETag"] != base["etag"]:
+            raise RuntimeError(
+                f"Base backup {base['uri']} of chain {base['run_id']} was overwritten "
+                "by a later backup; refusing to replay its binlogs onto another dump"
+            )
+
+    def restore_base(self, base: dict) -> int:
+        """
+        Restore the full backup a chain is based on.
+
+        Args:
+            base: Base entry of a chain manifest
+
+        Returns:
+            Number of SQL bytes restored
+        """
+        self.check_base(base)
+        if base["mode"] == "tables":
+            manifest = read_manifest(
+                self.backup.s3_client,
+                self.backup.s3_bucket,
+                run_prefix(self.backup.s3_prefix, self.backup.db_name, base["run_id"]),
+            )
+            return self.restore_manifest(manifest)
+
+        key = base["uri"].split("/", 3)[3]
+        return self.restore_object(key)
+
+    def replay_binlogs(self, chain: dict, until: datetime = None) -> int:
+        """
+        Replay the binlogs of a chain, optionally stopping at a time.
+
+        Each binlog is decompressed to backup_dir one at a time, decoded
+        with mysqlbinlog and piped into mysql. GTIDs are stripped
+        (--skip-gtids), so replayed events get new GTIDs on the target;
+        otherwise a server that already executed them would skip every
+        transaction without an error.
+
+        Args:
+            chain: Chain manifest
+            until: Stop replaying events after this local time
+
+        Returns:
+            Number of binlog files replayed
+        """
+        backup = self.backup
+        work_dir = backup.backup_dir / f"restore-binlogs-{self.target_db}"
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        replayed = 0
+        window_start = run_time(chain["base"]["run_id"])
+        try:
+            for incremental in chain["incrementals"]:
+                # Binlogs of this link were written after the previous run
+                if until and window_start > until:
+                    break
+                window_start = run_time(incremental["run_id"])
+
+                for obj in incremental["objects"]:
+                    path = work_dir / obj["binlog"]
+                    with open(path, "wb") as f:
+                        self.stream_object(obj["key"], f)
+
+                    # mysqlbinlog filters on --database after applying --rewrite-db
+                    cmd = [
+                        "mysqlbinlog",
+                        f"--start-position={obj['start_position']}",
+                        f"--database={self.target_db}",
+                        "--skip-gtids",
+                    ]
+                    if self.target_db != backup.db_name:
+                        cmd.append(f"--rewrite-db={backup.db_name}->{self.target_db}")
+                    if until:
+                        cmd.append(f"--stop-datetime={until:%Y-%m-%d %H:%M:%S}")
+                    cmd.append(str(path))
+
+                    print(f"Replaying binlog {obj['binlog']}")
+                    self.pipe_into_mysql(cmd)
+                    path.unlink()
+                    replayed += 1
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return replayed
+
+    def pipe_into_mysql(self, cmd: list):
+        """
+        Run a command and pipe its stdout into the mysql client.
+
+        Args:
+            cmd: Command producing SQL on stdout
+        """
+        producer = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        consumer = subprocess.Popen(
+            self.mysql_command(), stdin=producer.stdout, stderr=subprocess.PIPE
+        )
+        # Let the producer see SIGPIPE if mysql exits early
+        producer.stdout.close()
+
+        _, consumer_err = consumer.communicate()
+        _, producer_err = producer.communicate()
+        if producer.returncode != 0:
+            raise subprocess.CalledProcessError(
+                producer.returncode, cmd[0], stderr=producer_err.decode(errors="replace")
+            )
+        if consumer.returncode != 0:
+            raise subprocess.CalledProcessError(
+                consumer.returncode, "mysql", stderr=consumer_err.decode(errors="replace")
+            )
+
+    def run(
+        self, key: str = None, run_id: str = None, until: datetime = None, tables: list = None
+    ) -> str:
+        """
+        Restore a backup into the target database.
+
+        Source selection, in order:
+          key    - a single compressed SQL object
+          run_id - a per-table backup run
+          until  - the latest chain based before `until`, replayed to it;
+                   refused if its base was overwritten since
+          otherwise the latest per-table run in tables mode, the archive
+          in archive mode, the latest recipe in dedup mode, or the
+          single-file backup
+          `{s3_prefix}/{db_name}.sql{ext}` (see latest_key())
+
+        With tables, only those tables are restored from the archive
+        given by key (or the latest archive).
+
+        Args:
+            key: S3 key of a single backup object
+            run_id: Run identifier of a per-table backup
+            until: Point-in-time target for binlog replay
+            tables: Table names to restore from a seekable archive
+
+        Returns:
+            Description of what was restored
+        """
+        backup = self.backup
+        chain = None
+        if tables:
+            key = key or self.latest_key("archive")
+        elif until and not (key or run_id):
+            chain = find_latest_chain(backup, before=until)
+            if chain is None:
+                raise RuntimeError(f"No incremental chain based before {until}")
+        elif not (key or run_id or until):
+            if backup.backup_mode == "tables":
+                run_id = self.latest_run_id()
+            elif backup.backup_mode == "dedup":
+                key = self.latest_recipe()
+            elif backup.backup_mode == "parquet":
+                raise RuntimeError("Parquet exports cannot be restored; query them in place")
+            else:
+                key = self.latest_key()
+
+        self.ensure_database()
+
+        if tables:
+            restored = self.restore_archive_tables(key, tables)
+            source = f"{', '.join(tables)} from s3://{backup.s3_bucket}/{key}"
+        elif key:
+            restored = self.restore_object(key)
+            source = f"s3://{backup.s3_bucket}/{key}"
+        elif run_id:
+            prefix = run_prefix(backup.s3_prefix, backup.db_name, run_id)
+            restored = self.restore_manifest(
+                read_manifest(backup.s3_client, backup.s3_bucket, prefix)
+            )
+            source = f"s3://{backup.s3_bucket}/{prefix}/"
+        elif chain:
+            restored = self.restore_base(chain["base"])
+            replayed = self.replay_binlogs(chain, until)
+            source = f"chain {chain['base']['run_id']} + {replayed} binlog(s) until {until}"
+
+        print(f"Restored {restored:,} bytes of SQL into {self.target_db} from {source}")
+        return source
@@ -0,0 +1,463 @@
+"""
+GFS retention
+
+Keeps the newest backup of each of the last N days, ISO weeks and months
+(grandfather-father-son) per pipeline mode and deletes the rest. The
+backups come from the catalog, or from an S3 listing without one.
+
+A full backup and the incremental runs chained to it are kept or pruned
+together, so binlogs are never left without their base and a base is
+never pruned while a kept incremental needs it. The newest chain, which
+incremental runs still append to, is always kept. A single-object backup
+at the key its mode overwrites is always kept too; chain bases written to
+per-run keys are kept or pruned like any other backup.
+
+Objects that kept backups still reference are never deleted: tables
+reused from earlier runs by skip-unchanged, and dedup chunks. A chunk
+that no recipe references any more is only marked; a later prune deletes
+it if it is still unreferenced after a grace period, so a dedup backup
+running meanwhile can pick it up again. Right before deleting, recipes
+are listed again and chunks modified within the grace period are spared:
+a dedup backup copies a marked chunk in place when it reuses it, before
+its recipe exists.
+
+Deletes go through delete_objects in batches of 1000 keys sent
+concurrently. Index objects (manifests, recipes, chains) are deleted
+before the data they point to.
+"""
+
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from catalog import SINGLE_OBJECT_MODES, list_keys, scan_backups
+from dedup import candidates_key, chunk_key, read_recipe, recipe_key
+from incremental import base_prefix, chain_prefix
+from manifest import run_time
+
+# delete_objects limit
+DELETE_BATCH_SIZE = 1000
+
+PERIODS = (("daily", "%Y-%m-%d"), ("weekly", "%G-W%V"), ("monthly", "%Y-%m"))
+
+
+def gfs_keep(times: list, keep_daily: int, keep_weekly: int, keep_monthly: int) -> set:
+    """
+    Pick the restore points a GFS policy keeps.
+
+    For each period, the newest point of each of the most recent N
+    periods that have points is kept. The newest point is always kept.
+
+    Args:
+        times: Datetimes of the restore points
+        keep_daily: Days to keep
+        keep_weekly: ISO weeks to keep
+        keep_monthly: Months to keep
+
+    Returns:
+        Set of indexes into times
+    """
+    order = sorted(range(len(times)), key=lambda index: times[index], reverse=True)
+    kept = set(order[:1])
+    for (_, pattern), count in zip(PERIODS, (keep_daily, keep_weekly, keep_monthly)):
+        seen = set()
+        for index in order:
+            period = times[index].strftime(pattern)
+            if period in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.add(period)
+            kept.add(index)
+    return kept
+
+
+def delete_keys(s3_client, bucket: str, keys: list, concurrency: int = 8) -> int:
+    """
+    Delete objects in concurrent batches of DELETE_BATCH_SIZE keys.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        keys: Keys to delete
+        concurrency: Batches in flight at once
+
+    Returns:
+        Number of keys deleted
+    """
+    batches = [
+        keys[start : start + DELETE_BATCH_SIZE]
+        for start in range(0, len(keys), DELETE_BATCH_SIZE)
+    ]
+
+    def delete(batch: list) -> list:
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        return response.get("Errors", [])
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_errors in executor.map(delete, batches):
+            errors.extend(batch_errors)
+    if errors:
+        for error in errors[:10]:
+            print(f"Error deleting {error['Key']}: {error['Message']}", file=sys.stderr)
+        raise RuntimeError(f"{len(errors)} of {len(keys)} object(s) could not be deleted")
+    return len(keys)
+
+
+class Prune:
+    def __init__(
+        self,
+        backup,
+        keep_daily: int = 7,
+        keep_weekly: int = 4,
+        keep_monthly: int = 12,
+        chunk_grace_hours: int = 24,
+        dry_run: bool = False,
+    ):
+        """
+        Initialize retention run.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing S3 location, client,
+                catalog and upload concurrency
+            keep_daily: Days to keep per mode
+            keep_weekly: ISO weeks to keep per mode
+            keep_monthly: Months to keep per mode
+            chunk_grace_hours: Hours an unreferenced dedup chunk stays
+                marked before it is deleted
+            dry_run: Only print what would be deleted
+        """
+        self.backup = backup
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+        self.chunk_grace = timedelta(hours=chunk_grace_hours)
+        self.dry_run = dry_run
+        self.candidates_key = candidates_key(backup.s3_prefix, backup.db_name)
+
+    def load_entries(self) -> list:
+        """
+        Read all backups from the catalog, or list S3 without one.
+
+        Returns:
+            Catalog entries
+        """
+        if self.backup.catalog:
+            return self.backup.catalog.entries()
+        print("No catalog; listing S3 to find backups")
+        return scan_backups(self.backup)
+
+    def groups(self, entries: list) -> list:
+        """
+        Group backups into units that are kept or pruned together.
+
+        Args:
+            entries: Catalog entries
+
+        Returns:
+            List of dicts with mode, time, chain (base run_id or None),
+            entries and times (restore points of the group)
+        """
+        by_run_id = {}
+        groups = []
+        for entry in entries:
+            if entry["kind"] == "full":
+                group = {
+                    "mode": entry["mode"],
+                    "chain": entry["run_id"] if entry.get("binlog") else None,
+                    "entries": [entry],
+                    "times": [run_time(entry["run_id"])],
+                }
+                by_run_id[entry["run_id"]] = group
+                groups.append(group)
+
+        for entry in entries:
+            if entry["kind"] != "incremental":
+                continue
+            parent = entry["parent_run_id"]
+            group = by_run_id.get(parent)
+            if group is None:
+                # The base was overwritten; its binlogs form a chain of their own
+                group = {"mode": "incremental", "entries": [], "times": []}
+                by_run_id[parent] = group
+                groups.append(group)
+            group["chain"] = parent
+            group["entries"].append(entry)
+            group["times"].append(run_time(entry["run_id"]))
+        return groups
+
+    def plan(self, groups: list) -> tuple:
+        """
+        Split groups into kept and pruned ones.
+
+        Args:
+            groups: Groups from groups()
+
+        Returns:
+            Tuple of (kept groups, pruned groups)
+        """
+        backup = self.backup
+        per_run = f"s3://{backup.s3_bucket}/{base_prefix(backup.s3_prefix, backup.db_name)}/"
+        kept = set()
+        by_mode = {}
+        for index, group in enumerate(groups):
+            by_mode.setdefault(group["mode"], []).append(index)
+            if group["mode"] in SINGLE_OBJECT_MODES and not any(
+                entry["uri"].startswith(per_run) or entry.get("superseded_by")
+                for entry in group["entries"]
+            ):
+                # Its key holds the newest backup of the mode
+                kept.add(index)
+
+        for indexes in by_mode.values():
+            points = [(index, time) for index in indexes for time in groups[index]["times"]]
+            chosen = gfs_keep(
+                [time for _, time in points],
+                self.keep_daily,
+                self.keep_weekly,
+                self.keep_monthly,
+            )
+            kept.update(points[point][0] for point in chosen)
+
+        # Incremental runs append to the newest chain
+        chains = [index for index, group in enumerate(groups) if group.get("chain")]
+        if chains:
+            kept.add(max(chains, key=lambda index: groups[index]["chain"]))
+
+        return (
+            [group for index, group in enumerate(groups) if index in kept],
+            [group for index, group in enumerate(groups) if index not in kept],
+        )
+
+    def keys_to_delete(self, kept: list, pruned: list) -> tuple:
+        """
+        Collect the keys of pruned backups that kept backups do not use.
+
+        Args:
+            kept: Kept groups
+            pruned: Pruned groups
+
+        Returns:
+            Tuple of (index keys, data keys)
+        """
+        backup = self.backup
+        referenced = {
+            obj["key"]
+            for group in kept
+            for entry in group["entries"]
+            for obj in entry["objects"]
+        }
+        index_keys = []
+        data_keys = []
+        for group in pruned:
+            if group.get("chain"):
+                index_keys.append(
+                    f"{chain_prefix(backup.s3_prefix, backup.db_name)}/{group['chain']}.json"
+                )
+            for entry in group["entries"]:
+                if entry.get("superseded_by"):
+                    # Its object belongs to the backup that overwrote it
+                    continue
+                index_key = None
+                if entry["mode"] in ("tables", "parquet", "dedup"):
+                    index_key = entry["uri"].split("/", 3)[3]
+                    index_keys.append(index_key)
+                for obj in entry["objects"]:
+                    # Single-object backups are their own object
+                    if obj["key"] not in referenced and obj["key"] != index_key:
+                        data_keys.append(obj["key"])
+        return sorted(set(index_keys)), sorted(set(data_keys) - set(index_keys))
+
+    def chunk_references(self, recipe_keys: list) -> set:
+        """
+        Read the chunk keys dedup recipes reference.
+
+        Args:
+            recipe_keys: S3 keys of the recipes
+
+        Returns:
+            Set of chunk keys
+        """
+        backup = self.backup
+        keys = set()
+        for key in recipe_keys:
+            recipe = read_recipe(backup.s3_client, backup.s3_bucket, key)
+            for digest, _, _ in recipe["chunks"]:
+                keys.add(
+                    chunk_key(backup.s3_prefix, backup.db_name, digest, recipe["extension"])
+                )
+        return keys
+
+    def load_candidates(self) -> dict:
+        try:
+            response = self.backup.s3_client.get_object(
+                Bucket=self.backup.s3_bucket, Key=self.candidates_key
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            return {}
+        return json.loads(response["Body"].read())
+
+    def save_candidates(self, candidates: dict):
+        self.backup.s3_client.put_object(
+            Bucket=self.backup.s3_bucket,
+            Key=self.candidates_key,
+            Body=json.dumps(candidates, indent=2).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def live_recipes(self, pruned_recipes: set = frozenset()) -> list:
+        """
+        List the recipes in S3.
+
+        Every recipe, not just the catalog's, so a backup the catalog
+        missed keeps its chunks.
+
+        Args:
+            pruned_recipes: Recipe keys being pruned
+
+        Returns:
+            Recipe keys
+        """
+        backup = self.backup
+        recipes_prefix = recipe_key(backup.s3_prefix, backup.db_name, "").removesuffix(".json")
+        return [
+            key
+            for key in list_keys(backup.s3_client, backup.s3_bucket, recipes_prefix)
+            if key not in pruned_recipes
+        ]
+
+    def recheck_chunks(self, chunk_keys: list, candidates: dict) -> list:
+        """
+        Drop chunks that came back into use since sweep_chunks().
+
+        Runs right before the delete. Chunks a recipe written meanwhile
+        references are kept; chunks modified within the grace period,
+        which a running dedup backup refreshes when it reuses them, are
+        marked again.
+
+        Args:
+            chunk_keys: Chunk keys picked by sweep_chunks()
+            candidates: Marked chunks, updated in place
+
+        Returns:
+            Chunk keys still safe to delete
+        """
+        if not chunk_keys:
+            return []
+        backup = self.backup
+        referenced = self.chunk_references(self.live_recipes())
+        now = datetime.now(timezone.utc)
+
+        def recent(key: str) -> bool:
+            try:
+                head = backup.s3_client.head_object(Bucket=backup.s3_bucket, Key=key)
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                    return False
+                raise
+            return now - head["LastModified"] < self.chunk_grace
+
+        unreferenced = [key for key in chunk_keys if key not in referenced]
+        with ThreadPoolExecutor(max_workers=backup.upload_concurrency) as executor:
+            refreshed = list(executor.map(recent, unreferenced))
+        marked_at = datetime.now().isoformat(timespec="seconds")
+        for key, in_use in zip(unreferenced, refreshed):
+            if in_use:
+                candidates[key] = marked_at
+        deletable = [key for key, in_use in zip(unreferenced, refreshed) if not in_use]
+        if len(deletable) < len(chunk_keys):
+            print(f"{len(chunk_keys) - len(deletable)} chunk(s) back in use; not deleted")
+        return deletable
+
+    def sweep_chunks(self, pruned: list) -> tuple:
+        """
+        Mark chunks freed by pruned recipes and pick expired marks.
+
+        Args:
+            pruned: Pruned groups
+
+        Returns:
+            Tuple of (chunk keys to delete now, updated candidates dict
+            mapping chunk key to the time it was marked)
+        """
+        pruned_recipes = {
+            entry["uri"].split("/", 3)[3]
+            for group in pruned
+            for entry in group["entries"]
+            if entry["mode"] == "dedup"
+        }
+        candidates = self.load_candidates()
+        if not candidates and not pruned_recipes:
+            return [], candidates
+
+        referenced = self.chunk_references(self.live_recipes(pruned_recipes))
+        now = datetime.now()
+        for key in self.chunk_references(sorted(pruned_recipes)) - referenced:
+            candidates.setdefault(key, now.isoformat(timespec="seconds"))
+
+        expired = []
+        for key, marked_at in list(candidates.items()):
+            if key in referenced:
+                # Picked up again by a newer backup
+                del candidates[key]
+            elif now - datetime.fromisoformat(marked_at) >= self.chunk_grace:
+                expired.append(key)
+                del candidates[key]
+        return sorted(expired), candidates
+
+    def run(self) -> dict:
+        """
+        Apply the retention policy.
+
+        Returns:
+            Dict with kept, pruned (backup counts) and deleted (object count)
+        """
+        backup = self.backup
+        entries = self.load_entries()
+        kept, pruned = self.plan(self.groups(entries))
+        index_keys, data_keys = self.keys_to_delete(kept, pruned)
+        chunk_keys, candidates = self.sweep_chunks(pruned)
+
+        pruned_entries = [entry for group in pruned for entry in group["entries"]]
+        print(
+            f"Retention (daily {self.keep_daily}, weekly {self.keep_weekly}, "
+            f"monthly {self.keep_monthly}): keeping {sum(len(g['entries']) for g in kept)} "
+            f"backup(s), pruning {len(pruned_entries)}"
+        )
+        for entry in pruned_entries:
+            print(f"  prune {entry['run_id']} {entry['mode']:<12} {entry['uri']}")
+        print(
+            f"Objects to delete: {len(index_keys)} index, {len(data_keys)} data, "
+            f"{len(chunk_keys)} chunk(s); {len(candidates)} chunk(s) marked for later"
+        )
+
+        deleted = 0
+        if not self.dry_run:
+            concurrency = backup.upload_concurrency
+            # Indexes first, so nothing ever points at deleted data
+            deleted += delete_keys(backup.s3_client, backup.s3_bucket, index_keys, concurrency)
+            chunk_keys = self.recheck_chunks(chunk_keys, candidates)
+            deleted += delete_keys(
+                backup.s3_client, backup.s3_bucket, data_keys + chunk_keys, concurrency
+            )
+            self.save_candidates(candidates)
+            if backup.catalog and pruned_entries:
+                backup.catalog.remove(pruned_entries)
+            print(f"Deleted {deleted:,} object(s)")
+        else:
+            print("Dry run: nothing deleted")
+
+        return {
+            "kept": sum(len(group["entries"]) for group in kept),
+            "pruned": len(pruned_entries),
+            "deleted": deleted,
+        }
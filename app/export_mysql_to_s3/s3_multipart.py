@@ -0,0 +1,754 @@
+"""
+S3 multipart uploads
+
+Provides a file-like writer that buffers incoming bytes into fixed-size
+parts and uploads them concurrently while the producer keeps writing,
+and a resumable uploader for local files that records the upload ID and
+completed part ETags in a state file so an interrupted upload can be
+continued by a later run.
+
+Both take the knobs of boto3's TransferConfig (part size, max
+concurrency, use_threads), record per-part latency in TransferStats and
+can pace parts through an optional rate limiter. With a checksum
+algorithm, every part and object is sent with an S3 additional checksum
+computed on the fly (see checksums).
+A part size of None selects auto sizing so large objects stay below the
+10,000-part limit.
+"""
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+from checksums import (
+    S3_ALGORITHMS,
+    S3_CHECKSUM_TYPES,
+    checksum_of,
+    new_checksum,
+    s3_argument,
+)
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# S3 multipart limits
+MIN_PART_SIZE = 5 * MiB
+MAX_PART_SIZE = 5 * GiB
+MAX_PARTS = 10000
+
+# Auto sizing: smallest part used, and how often a stream of unknown
+# length doubles its part size (8 MiB * 1000 * (2**10 - 1) ~ 8 TiB, more
+# than the 5 TiB object limit, so 10,000 parts are never exceeded)
+AUTO_PART_SIZE = 8 * MiB
+AUTO_GROWTH_PARTS = 1000
+
+
+def auto_part_size(file_size: int) -> int:
+    """
+    Pick a part size for an object of known size.
+
+    Args:
+        file_size: Object size in bytes
+
+    Returns:
+        Smallest whole-MiB part size of at least AUTO_PART_SIZE that keeps
+        the upload under MAX_PARTS
+    """
+    needed = math.ceil(file_size / MAX_PARTS)
+    return min(MAX_PART_SIZE, max(AUTO_PART_SIZE, math.ceil(needed / MiB) * MiB))
+
+
+def stream_part_size(part_number: int, base: int = AUTO_PART_SIZE) -> int:
+    """
+    Part size for a stream of unknown length.
+
+    Args:
+        part_number: 1-based part number
+        base: Size of the first AUTO_GROWTH_PARTS parts
+
+    Returns:
+        base doubled once per AUTO_GROWTH_PARTS parts already sent
+    """
+    return min(MAX_PART_SIZE, base * 2 ** ((part_number - 1) // AUTO_GROWTH_PARTS))
+
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest-rank percentile.
+
+    Args:
+        values: Samples
+        pct: Percentile in the range 0-100
+
+    Returns:
+        Percentile value (0.0 for no samples)
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class TransferStats:
+    def __init__(self):
+        """
+        Initialize upload statistics.
+
+        Parts may be recorded from several threads.
+        """
+        self.started = time.monotonic()
+        self.finished = None
+        self.bytes = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record(self, size: int, seconds: float):
+        """
+        Record one uploaded part.
+
+        Args:
+            size: Part size in bytes
+            seconds: Time spent in upload_part
+        """
+        with self._lock:
+            self.bytes += size
+            self.latencies.append(seconds)
+
+    def finish(self):
+        """
+        Mark the transfer as complete.
+        """
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def part_bytes_per_second(self) -> float:
+        """
+        Throughput of a single connection while it is sending a part.
+        """
+        with self._lock:
+            busy = sum(self.latencies)
+            return self.bytes / busy if busy > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        """
+        Statistics as a plain dictionary.
+
+        Returns:
+            Dict with bytes, seconds, bytes_per_second, parts and latency
+            percentiles in seconds
+        """
+        return {
+            "bytes": self.bytes,
+            "seconds": round(self.elapsed, 3),
+            "bytes_per_second": round(self.bytes_per_second),
+            "parts": len(self.latencies),
+            "part_latency_p50": round(percentile(self.latencies, 50), 3),
+            "part_latency_p90": round(percentile(self.latencies, 90), 3),
+            "part_latency_p99": round(percentile(self.latencies, 99), 3),
+        }
+
+    def summary(self) -> str:
+        """
+        One-line human readable summary.
+
+        Returns:
+            Summary string
+        """
+        stats = self.as_dict()
+        return (
+            f"{stats['bytes'] / MiB:,.1f} MiB in {stats['seconds']:.1f}s "
+            f"({stats['bytes_per_second'] / MiB:,.1f} MiB/s), {stats['parts']} part(s), "
+            f"latency p50 {stats['part_latency_p50']:.2f}s "
+            f"p90 {stats['part_latency_p90']:.2f}s p99 {stats['part_latency_p99']:.2f}s"
+        )
+
+
+class S3MultipartWriter:
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        key: str,
+        part_size: int = None,
+        max_workers: int = 4,
+        use_threads: bool = True,
+        extra_args: dict = None,
+        stats: TransferStats = None,
+        limiter=None,
+        checksum_algorithm: str = None,
+    ):
+        """
+        Initialize streaming multipart upload.
+
+        Memory use is bounded by roughly (max_workers + 1) * part_size:
+        write() blocks once max_workers parts are in flight.
+
+        Args:
+            s3_client: boto3 S3 client
+            bucket: S3 bucket name
+            key: S3 object key
+            part_size: Size of each uploaded part in bytes; None grows the
+                part size with the stream (see stream_part_size())
+            max_workers: Number of parts uploaded concurrently
+            use_threads: Upload parts from worker threads; when False
+                write() uploads each part inline
+            extra_args: Extra arguments for create_multipart_upload/put_object
+            stats: TransferStats to record parts into
+            limiter: RateLimiter charged for every part before it is sent
+            checksum_algorithm: "sha256" or "crc32c" to send S3 additional
+                checksums, None for none
+        """
+        if part_size is not None and part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers if use_threads else 1
+        self.use_threads = use_threads
+        self.extra_args = extra_args or {}
+        self.stats = stats or TransferStats()
+        self.limiter = limiter
+        self.checksum_algorithm = checksum_algorithm
+        # Whole-object checksum, fed in write order
+        self.checksum = new_checksum(checksum_algorithm) if checksum_algorithm else None
+
+        self.upload_id = None
+        self.bytes_written = 0
+        self.etag = None
+        self.s3_checksum = None
+        self._buffer = bytearray()
+        self._part_number = 0
+        self._futures = []
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, data: bytes) -> int:
+        """
+        Buffer data and upload every full part.
+
+        Args:
+            data: Bytes to append to the object
+
+        Returns:
+            Number of bytes accepted
+        """
+        if self._closed:
+            raise ValueError("write to closed S3MultipartWriter")
+
+        self._buffer += data
+        self.bytes_written += len(data)
+        if self.checksum:
+            self.checksum.update(data)
+
+        while len(self._buffer) >= (size := self._next_part_size()):
+            part = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._submit_part(part)
+
+        return len(data)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """
+        Current position, i.e. the number of bytes written so far.
+        """
+        return self.bytes_written
+
+    def flush(self):
+        """
+        No-op; full parts are uploaded as they are written.
+        """
+
+    def _next_part_size(self) -> int:
+        if self.part_size is not None:
+            return self.part_size
+        return stream_part_size(self._part_number + 1)
+
+    def close(self) -> dict:
+        """
+        Upload the remaining buffer and complete the upload.
+
+        Objects that never filled a single part are sent with put_object.
+
+        Returns:
+            Response of complete_multipart_upload or put_object
+        """
+        if self._closed:
+            return {}
+        self._closed = True
+
+        if self.upload_id is None:
+            if self.limiter:
+                self.limiter.consume(len(self._buffer))
+            checksum_args = {}
+            if self.checksum:
+                checksum_args[s3_argument(self.checksum_algorithm)] = self.checksum.value()
+            started = time.monotonic()
+            response = self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self._buffer),
+                **self.extra_args,
+                **checksum_args,
+            )
+            self.stats.record(len(self._buffer), time.monotonic() - started)
+            self.stats.finish()
+            self.etag = response.get("ETag")
+            self._record_checksum(response)
+            return response
+
+        if self._buffer:
+            self._submit_part(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        try:
+            parts = [future.result() for future in self._futures]
+        except Exception:
+            self._abort_upload()
+            raise
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+
+        checksum_args = {}
+        if self.checksum and S3_CHECKSUM_TYPES[self.checksum_algorithm] == "FULL_OBJECT":
+            # S3 recomputes the checksum of the assembled object and compares
+            checksum_args = {
+                "ChecksumType": "FULL_OBJECT",
+                s3_argument(self.checksum_algorithm): self.checksum.value(),
+            }
+        response = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": parts},
+            **checksum_args,
+        )
+        self.stats.finish()
+        self.etag = response.get("ETag")
+        self._record_checksum(response)
+        return response
+
+    def checksums(self) -> dict:
+        """
+        Checksums of the uploaded object.
+
+        Returns:
+            Dict with algorithm, stored (computed while writing), s3 (as
+            reported by S3) and type (how S3 checksums the object), or None
+            without a checksum algorithm
+        """
+        if not self.checksum:
+            return None
+        single = self.upload_id is None
+        return {
+            "algorithm": self.checksum_algorithm,
+            "stored": self.checksum.value(),
+            "s3": self.s3_checksum,
+            "type": "FULL_OBJECT" if single else S3_CHECKSUM_TYPES[self.checksum_algorithm],
+        }
+
+    def _record_checksum(self, response: dict):
+        if self.checksum:
+            self.s3_checksum = response.get(s3_argument(self.checksum_algorithm))
+
+    def abort(self):
+        """
+        Abort the upload and discard any parts already sent.
+        """
+        self._closed = True
+        self._buffer = bytearray()
+        if self._executor:
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+        self._abort_upload()
+
+    def _abort_upload(self):
+        if self.upload_id is None:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        except Exception as e:
+            print(f"Error aborting multipart upload: {e}", file=sys.stderr)
+        self.upload_id = None
+
+    def _submit_part(self, data: bytes):
+        if self.upload_id is None:
+            checksum_args = {}
+            if self.checksum:
+                checksum_args = {
+                    "ChecksumAlgorithm": S3_ALGORITHMS[self.checksum_algorithm],
+                    "ChecksumType": S3_CHECKSUM_TYPES[self.checksum_algorithm],
+                }
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args, **checksum_args
+            )
+            self.upload_id = response["UploadId"]
+            if self.use_threads:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        self._part_number += 1
+        if not self.use_threads:
+            future = Future()
+            future.set_result(self._upload_part(self._part_number, data))
+            self._futures.append(future)
+            return
+
+        # Surface failures of earlier parts before queueing more work
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+
+        self._slots.acquire()
+        future = self._executor.submit(self._upload_part, self._part_number, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _upload_part(self, part_number: int, data: bytes) -> dict:
+        checksum_args = {}
+        if self.checksum_algorithm:
+            # Computed in the worker thread, so parts are hashed in parallel
+            checksum_args[s3_argument(self.checksum_algorithm)] = checksum_of(
+                self.checksum_algorithm, data
+            )
+        if self.limiter:
+            self.limiter.consume(len(data))
+        started = time.monotonic()
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data,
+            **checksum_args,
+        )
+        self.stats.record(len(data), time.monotonic() - started)
+        return {"PartNumber": part_number, "ETag": response["ETag"], **checksum_args}
+
+
+class ResumableFileUpload:
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        key: str,
+        file_path: Path,
+        part_size: int = None,
+        max_workers: int = 4,
+        use_threads: bool = True,
+        extra_args: dict = None,
+        stats: TransferStats = None,
+        limiter=None,
+        checksum_algorithm: str = None,
+        metadata: dict = None,
+    ):
+        """
+        Initialize resumable multipart upload of a local file.
+
+        Progress is kept in `{file_path}.upload.json`. The file is removed
+        once the upload completes; after a failure it stays so that the
+        next upload() of the same file continues from the last good part.
+
+        Args:
+            s3_client: boto3 S3 client
+            bucket: S3 bucket name
+            key: S3 object key
+            file_path: Local file to upload
+            part_size: Size of each uploaded part in bytes; None picks it
+                from the file size (see auto_part_size())
+            max_workers: Number of parts uploaded concurrently
+            use_threads: Upload parts from worker threads; when False
+                parts are uploaded one by one in the calling thread
+            extra_args: Extra arguments for create_multipart_upload
+            stats: TransferStats to record parts into
+            limiter: RateLimiter charged for every part before it is sent
+            checksum_algorithm: "sha256" or "crc32c" to send S3 additional
+                checksums of every part, None for none; parts upload out of
+                order, so S3 checks a checksum of the part checksums
+            metadata: Details of the run that produced the file, kept in
+                the state file so a resuming run can take them over
+        """
+        if part_size is not None and part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.file_path = Path(file_path)
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.use_threads = use_threads
+        self.extra_args = extra_args or {}
+        self.stats = stats or TransferStats()
+        self.limiter = limiter
+        self.checksum_algorithm = checksum_algorithm
+        self.metadata = metadata or {}
+        self.state_path = self.state_path_for(self.file_path)
+        self.state = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def state_path_for(file_path: Path) -> Path:
+        """
+        Path of the state file kept for an upload of file_path.
+
+        Args:
+            file_path: Local file being uploaded
+
+        Returns:
+            Path of the state file
+        """
+        return Path(f"{file_path}.upload.json")
+
+    @classmethod
+    def saved_state(cls, file_path: Path) -> dict:
+        """
+        State of an interrupted upload of file_path.
+
+        Args:
+            file_path: Local file being uploaded
+
+        Returns:
+            State dict with bucket, key, upload_id, metadata and parts, or
+            None without a readable state file
+        """
+        try:
+            return json.loads(cls.state_path_for(file_path).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def discard(self):
+        """
+        Abort an interrupted upload of the file and forget its state.
+        """
+        state = self.saved_state(self.file_path)
+        if state:
+            self._abort(state)
+        self.state_path.unlink(missing_ok=True)
+
+    def upload(self) -> dict:
+        """
+        Upload the file, resuming a previous attempt when possible.
+
+        Returns:
+            Response of complete_multipart_upload
+        """
+        stat = self.file_path.stat()
+        self.state = self._resume_state(stat)
+
+        if self.state is None:
+            part_size = self.part_size or auto_part_size(stat.st_size)
+            if math.ceil(stat.st_size / part_size) > MAX_PARTS:
+                part_size = auto_part_size(stat.st_size)
+                print(
+                    f"Part size too small for {MAX_PARTS} parts; using "
+                    f"{part_size // MiB} MiB"
+                )
+
+            checksum_args = {}
+            if self.checksum_algorithm:
+                checksum_args = {
+                    "ChecksumAlgorithm": S3_ALGORITHMS[self.checksum_algorithm],
+                    "ChecksumType": "COMPOSITE",
+                }
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args, **checksum_args
+            )
+            self.state = {
+                "bucket": self.bucket,
+                "key": self.key,
+                "upload_id": response["UploadId"],
+                "part_size": part_size,
+                "file_size": stat.st_size,
+                "file_mtime": stat.st_mtime,
+                "checksum_algorithm": self.checksum_algorithm,
+                "metadata": self.metadata,
+                "parts": {},
+                "checksums": {},
+            }
+            self._save_state()
+        else:
+            print(
+                f"Resuming multipart upload: {len(self.state['parts'])} part(s) "
+                f"already uploaded"
+            )
+
+        part_size = self.state["part_size"]
+        part_count = max(1, math.ceil(stat.st_size / part_size))
+        missing = [
+            number
+            for number in range(1, part_count + 1)
+            if str(number) not in self.state["parts"]
+        ]
+
+        if self.use_threads:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    executor.submit(self._upload_part, number, part_size)
+                    for number in missing
+                ]
+                for future in as_completed(futures):
+                    future.result()
+        else:
+            for number in missing:
+                self._upload_part(number, part_size)
+
+        checksums = self.state.get("checksums", {})
+        parts = [
+            {"PartNumber": int(number), "ETag": etag}
+            for number, etag in sorted(
+                self.state["parts"].items(), key=lambda item: int(item[0])
+            )
+        ]
+        if self.checksum_algorithm:
+            argument = s3_argument(self.checksum_algorithm)
+            for part in parts:
+                part[argument] = checksums[str(part["PartNumber"])]
+        response = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.state["upload_id"],
+            MultipartUpload={"Parts": parts},
+        )
+        self.state_path.unlink(missing_ok=True)
+        self.stats.finish()
+        return response
+
+    def _resume_state(self, stat) -> dict:
+        if not self.state_path.exists():
+            return None
+
+        try:
+            state = json.loads(self.state_path.read_text())
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable upload state: {e}", file=sys.stderr)
+            return None
+
+        if (
+            state.get("bucket") != self.bucket
+            or state.get("key") != self.key
+            or state.get("file_size") != stat.st_size
+            or state.get("file_mtime") != stat.st_mtime
+            or state.get("checksum_algorithm") != self.checksum_algorithm
+        ):
+            print("Upload state does not match local file; starting a new upload")
+            self._abort(state)
+            return None
+
+        # S3 is authoritative: parts recorded locally may have expired
+        try:
+            uploaded = {}
+            checksums = {}
+            paginator = self.s3_client.get_paginator("list_parts")
+            for page in paginator.paginate(
+                Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"]
+            ):
+                for part in page.get("Parts", []):
+                    uploaded[str(part["PartNumber"])] = part["ETag"]
+                    if self.checksum_algorithm:
+                        checksums[str(part["PartNumber"])] = part.get(
+                            s3_argument(self.checksum_algorithm)
+                        )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+                print("Previous multipart upload no longer exists; starting over")
+                return None
+            raise
+
+        state["parts"] = {
+            number: etag
+            for number, etag in state.get("parts", {}).items()
+            if uploaded.get(number) == etag
+        }
+        if self.checksum_algorithm:
+            # Keep the checksums S3 accepted, needed to complete the upload
+            state["checksums"] = {
+                number: checksums.get(number) or state.get("checksums", {}).get(number)
+                for number in state["parts"]
+            }
+            state["parts"] = {
+                number: etag
+                for number, etag in state["parts"].items()
+                if state["checksums"][number]
+            }
+        return state
+
+    def _abort(self, state: dict):
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=state["bucket"], Key=state["key"], UploadId=state["upload_id"]
+            )
+        except (ClientError, KeyError) as e:
+            print(f"Error aborting stale multipart upload: {e}", file=sys.stderr)
+
+    def _upload_part(self, part_number: int, part_size: int):
+        with open(self.file_path, "rb") as f:
+            f.seek((part_number - 1) * part_size)
+            data = f.read(part_size)
+
+        checksum_args = {}
+        if self.checksum_algorithm:
+            checksum_args[s3_argument(self.checksum_algorithm)] = checksum_of(
+                self.checksum_algorithm, data
+            )
+        if self.limiter:
+            self.limiter.consume(len(data))
+        started = time.monotonic()
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.state["upload_id"],
+            PartNumber=part_number,
+            Body=data,
+            **checksum_args,
+        )
+        self.stats.record(len(data), time.monotonic() - started)
+        with self._lock:
+            self.state["parts"][str(part_number)] = response["ETag"]
+            if checksum_args:
+                self.state["checksums"][str(part_number)] = next(iter(checksum_args.values()))
+            self._save_state()
+
+    def _save_state(self):
+        # Write-then-rename so a crash never leaves a truncated state file
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.state))
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,250 @@
+"""
+Multi-database backup scheduler
+
+Backs up several databases, possibly on several hosts, from one process.
+Jobs are started largest first (by information_schema data size) so the
+longest backups do not end up trailing at the end, and never more than
+jobs_per_host run against one MySQL host or jobs in total.
+
+All jobs share one boto3 S3 client and one worker pool, which also runs
+the size estimates. They also share the rate limits: one upload limiter
+for all jobs and one dump limiter per MySQL host, so --jobs does not
+multiply the configured caps.
+"""
+
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+from botocore.config import Config
+
+from s3_multipart import MiB
+from table_dump import list_tables
+from throttle import RateLimiter
+
+
+def parse_targets(value: str, default_host: str) -> list:
+    """
+    Parse a backup target list.
+
+    Args:
+        value: Comma-separated "database" or "database@host" entries
+        default_host: Host of entries without "@host"
+
+    Returns:
+        List of (host, database) tuples in the given order
+    """
+    targets = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        db_name, _, host = item.partition("@")
+        target = (host or default_host, db_name)
+        if target not in targets:
+            targets.append(target)
+
+    names = Counter(db_name for _, db_name in targets)
+    duplicates = sorted(name for name, count in names.items() if count > 1)
+    if duplicates:
+        # Backups are stored by database name only
+        raise ValueError(
+            f"Database name(s) on more than one host: {', '.join(duplicates)}; "
+            "run them with different S3_PREFIX values"
+        )
+    return targets
+
+
+class BackupScheduler:
+    def __init__(
+        self,
+        backup_class,
+        config: dict,
+        targets: list,
+        jobs: int = 4,
+        jobs_per_host: int = 1,
+        s3_client=None,
+    ):
+        """
+        Initialize scheduler.
+
+        Args:
+            backup_class: MySQLBackupToS3
+            config: MySQLBackupToS3 keyword arguments shared by all jobs
+                (db_host and db_name are taken from targets)
+            targets: List of (host, database) tuples
+            jobs: Backups running at once in total
+            jobs_per_host: Backups running at once against one host
+            s3_client: boto3 S3 client shared by the jobs (a new one with a
+                pool sized for them when None)
+        """
+        if jobs < 1 or jobs_per_host < 1:
+            raise ValueError("jobs and jobs_per_host must be at least 1")
+        self.backup_class = backup_class
+        self.config = config
+        self.targets = targets
+        self.jobs = jobs
+        self.jobs_per_host = jobs_per_host
+        # Every running job uploads up to upload_concurrency parts at once
+        self.s3_client = s3_client or boto3.client(
+            "s3",
+            config=Config(
+                max_pool_connections=jobs * config.get("upload_concurrency", 10) + 10
+            ),
+        )
+        self.upload_limiter = None
+        if config.get("upload_rate_limit_mb"):
+            self.upload_limiter = RateLimiter(config["upload_rate_limit_mb"] * MiB)
+        # Per host, as the dump limit protects the MySQL server
+        self.dump_limiters = {}
+
+    def dump_limiter(self, host: str) -> RateLimiter:
+        """
+        Look up the dump rate limiter shared by the jobs of one host.
+
+        Args:
+            host: MySQL host
+
+        Returns:
+            RateLimiter, or None when dumps are neither limited nor
+            adaptively throttled
+        """
+        rate_limit_mb = self.config.get("dump_rate_limit_mb")
+        if not rate_limit_mb and not self.config.get("throttle_adaptive"):
+            return None
+        if host not in self.dump_limiters:
+            self.dump_limiters[host] = RateLimiter(
+                rate_limit_mb * MiB if rate_limit_mb else None
+            )
+        return self.dump_limiters[host]
+
+    def new_backup(self, host: str, db_name: str):
+        """
+        Create the backup job of one target.
+
+        Args:
+            host: MySQL host
+            db_name: Database name
+
+        Returns:
+            MySQLBackupToS3 instance using the shared S3 client and rate
+            limiters
+        """
+        return self.backup_class(
+            **dict(
+                self.config,
+                db_host=host,
+                db_name=db_name,
+                s3_client=self.s3_client,
+                dump_limiter=self.dump_limiter(host),
+                upload_limiter=self.upload_limiter,
+            )
+        )
+
+    def estimate_size(self, backup) -> int:
+        """
+        Estimate the data size of a database.
+
+        Args:
+            backup: MySQLBackupToS3 job
+
+        Returns:
+            Sum of information_schema DATA_LENGTH, or 0 if unavailable
+        """
+        try:
+            connection = backup.connect()
+        except Exception as e:
+            print(
+                f"Warning: cannot estimate size of {backup.db_name}@{backup.db_host}: {e}",
+                file=sys.stderr,
+            )
+            return 0
+        try:
+            tables = list_tables(connection, backup.db_name)
+            return sum(table["data_length"] for table in tables)
+        finally:
+            connection.close()
+
+    def run_job(self, job: dict) -> dict:
+        """
+        Run one backup, capturing its failure.
+
+        Args:
+            job: Job dict with backup
+
+        Returns:
+            The job dict with uri, raw_bytes and bytes or error, and seconds
+        """
+        started = time.monotonic()
+        try:
+            job["uri"] = job["backup"].run()
+            job["raw_bytes"] = job["backup"].last_run["raw_bytes"]
+            job["bytes"] = job["backup"].last_run["bytes"]
+        except Exception as e:
+            job["error"] = str(e)
+        job["seconds"] = time.monotonic() - started
+        return job
+
+    def run(self) -> list:
+        """
+        Back up all targets.
+
+        Returns:
+            List of job dicts with host, db_name, size, seconds and uri,
+            raw_bytes and bytes or error, in completion order
+        """
+        jobs = [
+            {"host": host, "db_name": db_name, "backup": self.new_backup(host, db_name)}
+            for host, db_name in self.targets
+        ]
+        finished = []
+        running = {}
+        per_host = Counter()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            sizes = executor.map(lambda job: self.estimate_size(job["backup"]), jobs)
+            for job, size in zip(jobs, sizes):
+                job["size"] = size
+            # Largest first keeps the makespan short
+            pending = sorted(jobs, key=lambda job: job["size"], reverse=True)
+            print(
+                f"Scheduling {len(pending)} backup(s), {self.jobs} at once, "
+                f"{self.jobs_per_host} per host"
+            )
+
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    if per_host[job["host"]] >= self.jobs_per_host:
+                        continue
+                    pending.remove(job)
+                    per_host[job["host"]] += 1
+                    print(f"Starting {job['db_name']}@{job['host']} (~{job['size']:,} bytes)")
+                    running[executor.submit(self.run_job, job)] = job
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    per_host[job["host"]] -= 1
+                    finished.append(future.result())
+
+        self.print_summary(finished)
+        return finished
+
+    def print_summary(self, finished: list):
+        """
+        Print one line per finished job.
+
+        Args:
+            finished: Job dicts returned by run()
+        """
+        print("=" * 60)
+        for job in finished:
+            result = job.get("uri") or f"FAILED: {job['error']}"
+            print(f"{job['db_name']}@{job['host']}: {job['seconds']:.1f}s {result}")
+        failed = sum(1 for job in finished if "error" in job)
+        print(f"{len(finished) - failed} succeeded, {failed} failed")
+        print("=" * 60)
@@ -0,0 +1,855 @@
+"""
+Parallel per-table dump engine
+
+Lists tables from information_schema and dumps them concurrently, one
+mysqldump process (or native engine thread) per table, streaming each
+into its own compressed S3 object. Tables whose row estimate exceeds
+chunk_rows are split into primary-key ranges dumped as separate objects.
+A manifest records the objects in restore order.
+
+With skip_unchanged, a fingerprint of every table is stored in the
+manifest. Tables whose fingerprint matches the previous run are not
+dumped again; the new manifest points at the objects already on S3.
+
+With a zstd dictionary, small tables are compressed with the newest
+trained dictionary, and the start of every dumped object is kept as a
+training sample for the next one (see zstd_dictionary).
+"""
+
+import functools
+import math
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from mysql.connector import Error
+
+from incremental import binlog_status
+from manifest import (
+    list_run_ids,
+    new_manifest,
+    new_run_id,
+    read_manifest,
+    run_prefix,
+    write_manifest,
+)
+from zstd_dictionary import (
+    DICTIONARY_MODES,
+    SMALL_OBJECT_SIZE,
+    dictionary_age_days,
+    dictionary_id,
+    latest_dictionary,
+    load_dictionary,
+    train_dictionary,
+)
+
+# lock: a coordinator session holds LOCK TABLES ... READ only while a fixed pool
+#       of worker connections starts consistent snapshots, so all workers see
+#       the same data (writes wait for a moment)
+# none: every table is dumped in its own --single-transaction snapshot
+CONSISTENCY_MODES = ("lock", "none")
+
+# none:        dump every table on every run
+# update_time: information_schema UPDATE_TIME/CREATE_TIME; cheap, but unknown
+#              (always dumped) after a server restart on InnoDB
+# checksum:    CHECKSUM TABLE; reads every row but catches any change
+SKIP_MODES = ("none", "update_time", "checksum")
+
+INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quote a MySQL identifier with backticks.
+
+    Args:
+        name: Table or column name
+
+    Returns:
+        Quoted identifier
+    """
+    return "`" + name.replace("`", "``") + "`"
+
+
+def list_tables(connection, db_name: str) -> list:
+    """
+    List tables and views of a database with size estimates.
+
+    Args:
+        connection: MySQL connection
+        db_name: Database name
+
+    Returns:
+        List of dicts with name, type, engine, rows_estimate,
+        data_length, index_length, create_time and update_time
+    """
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(
+            """
+            SELECT TABLE_NAME AS name, TABLE_TYPE AS type, ENGINE AS engine,
+                   COALESCE(TABLE_ROWS, 0) AS rows_estimate,
+                   COALESCE(DATA_LENGTH, 0) AS data_length,
+                   COALESCE(INDEX_LENGTH, 0) AS index_length,
+                   CREATE_TIME AS create_time, UPDATE_TIME AS update_time
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = %s
+            ORDER BY TABLE_NAME
+            """,
+            (db_name,),
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def lock_tables(connection, tables: list):
+    """
+    Take LOCK TABLES ... READ on tables of the connection's database.
+
+    Args:
+        connection: MySQL connection
+        tables: Table names
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "LOCK TABLES " + ", ".join(f"{quote_identifier(name)} READ" for name in tables)
+        )
+    finally:
+        cursor.close()
+
+
+def unlock_tables(connection):
+    """
+    Release the table locks of a connection.
+
+    Args:
+        connection: MySQL connection
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("UNLOCK TABLES")
+    finally:
+        cursor.close()
+
+
+def start_consistent_snapshot(connection):
+    """
+    Start a REPEATABLE READ snapshot in UTC session time.
+
+    Args:
+        connection: MySQL connection
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SET SESSION time_zone = '+00:00'")
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+    finally:
+        cursor.close()
+
+
+def open_snapshots(backup, count: int) -> list:
+    """
+    Open connections that each start a consistent snapshot.
+
+    Opened while another session holds LOCK TABLES ... READ on every
+    table, the snapshots all see the same data and the lock can be
+    released as soon as this returns.
+
+    Args:
+        backup: MySQLBackupToS3 instance providing connect()
+        count: Number of connections
+
+    Returns:
+        List of connections inside their snapshot
+    """
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(backup.connect())
+            start_consistent_snapshot(connections[-1])
+    except Exception:
+        close_snapshots(connections)
+        raise
+    return connections
+
+
+def close_snapshots(connections: list):
+    """
+    End the snapshots of open_snapshots() and close their connections.
+
+    Args:
+        connections: Connections returned by open_snapshots()
+    """
+    for connection in connections:
+        try:
+            connection.rollback()
+        except Error:
+            # The connection may have died with a failed dump
+            pass
+        finally:
+            connection.close()
+
+
+def primary_keys(connection, db_name: str) -> dict:
+    """
+    Look up primary key columns of every table in a database.
+
+    Args:
+        connection: MySQL connection
+        db_name: Database name
+
+    Returns:
+        Dict mapping table name to a list of (column, data_type) tuples
+        in key order
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            SELECT k.TABLE_NAME, k.COLUMN_NAME, c.DATA_TYPE
+            FROM information_schema.KEY_COLUMN_USAGE k
+            JOIN information_schema.COLUMNS c
+              ON c.TABLE_SCHEMA = k.TABLE_SCHEMA
+             AND c.TABLE_NAME = k.TABLE_NAME
+             AND c.COLUMN_NAME = k.COLUMN_NAME
+            WHERE k.TABLE_SCHEMA = %s AND k.CONSTRAINT_NAME = 'PRIMARY'
+            ORDER BY k.TABLE_NAME, k.ORDINAL_POSITION
+            """,
+            (db_name,),
+        )
+        keys = {}
+        for table, column, data_type in cursor.fetchall():
+            keys.setdefault(table, []).append((column, data_type.lower()))
+        return keys
+    finally:
+        cursor.close()
+
+
+def table_fingerprints(connection, db_name: str, tables: list, mode: str) -> dict:
+    """
+    Fingerprint base tables to detect changes between runs.
+
+    Args:
+        connection: MySQL connection
+        db_name: Database name
+        tables: Rows returned by list_tables()
+        mode: One of SKIP_MODES other than "none"
+
+    Returns:
+        Dict mapping table name to a fingerprint string; tables whose
+        state cannot be determined are left out
+    """
+    base_tables = [t for t in tables if t["type"] == "BASE TABLE"]
+    fingerprints = {}
+
+    if mode == "update_time":
+        for table in base_tables:
+            if table["update_time"] is None or table["create_time"] is None:
+                continue
+            fingerprints[table["name"]] = (
+                f"update_time:{table['create_time'].isoformat()}/"
+                f"{table['update_time'].isoformat()}"
+            )
+        return fingerprints
+
+    if mode == "checksum" and base_tables:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "CHECKSUM TABLE "
+                + ", ".join(
+                    f"{quote_identifier(db_name)}.{quote_identifier(t['name'])}"
+                    for t in base_tables
+                )
+            )
+            for qualified_name, checksum in cursor.fetchall():
+                if checksum is not None:
+                    name = qualified_name.removeprefix(f"{db_name}.")
+                    fingerprints[name] = f"checksum:{checksum}"
+        finally:
+            cursor.close()
+    return fingerprints
+
+
+def chunk_ranges(min_value: int, max_value: int, rows_estimate: int, chunk_rows: int) -> list:
+    """
+    Split a primary key range into roughly chunk_rows-sized pieces.
+
+    The first range has no lower bound and the last no upper bound, so
+    rows outside [min_value, max_value] are still covered.
+
+    Args:
+        min_value: Smallest primary key value
+        max_value: Largest primary key value
+        rows_estimate: Estimated row count of the table
+        chunk_rows: Target rows per chunk
+
+    Returns:
+        List of (lower, upper) tuples; lower is inclusive, upper exclusive,
+        None means unbounded
+    """
+    count = max(1, math.ceil(rows_estimate / chunk_rows))
+    step = max(1, math.ceil((max_value - min_value + 1) / count))
+
+    bounds = list(range(min_value + step, max_value + 1, step))
+    lowers = [None] + bounds
+    uppers = bounds + [None]
+    return list(zip(lowers, uppers))
+
+
+def range_condition(column: str, lower, upper) -> str:
+    """
+    Build a --where condition for a primary key range.
+
+    Args:
+        column: Primary key column name
+        lower: Inclusive lower bound or None
+        upper: Exclusive upper bound or None
+
+    Returns:
+        SQL condition
+    """
+    column = quote_identifier(column)
+    conditions = []
+    if lower is not None:
+        conditions.append(f"{column} >= {int(lower)}")
+    if upper is not None:
+        conditions.append(f"{column} < {int(upper)}")
+    return " AND ".join(conditions) or "1=1"
+
+
+class ParallelTableDump:
+    def __init__(
+        self,
+        backup,
+        concurrency: int = 4,
+        consistency: str = "lock",
+        chunk_rows: int = 5_000_000,
+        track_binlog: bool = False,
+        skip_unchanged: str = "none",
+        zstd_dictionary: str = "off",
+        dictionary_max_age_days: float = 7,
+    ):
+        """
+        Initialize parallel per-table dump.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing connection, mysqldump
+                command and streaming upload
+            concurrency: Maximum number of dump jobs run at once
+            consistency: Snapshot strategy (see CONSISTENCY_MODES)
+            chunk_rows: Tables with more estimated rows are split into
+                primary-key ranges of about this many rows (0 disables)
+            track_binlog: Record binlog coordinates of the snapshot
+            skip_unchanged: Fingerprint strategy for reusing tables of the
+                previous run (see SKIP_MODES)
+            zstd_dictionary: "auto" compresses small tables with a trained
+                dictionary (zstd codec only), "off" disables it
+            dictionary_max_age_days: Train a new dictionary once the newest
+                is older than this
+        """
+        if consistency not in CONSISTENCY_MODES:
+            raise ValueError(f"Unknown consistency mode: {consistency}")
+        if skip_unchanged not in SKIP_MODES:
+            raise ValueError(f"Unknown skip mode: {skip_unchanged}")
+        if track_binlog and consistency != "lock":
+            raise ValueError("Binlog tracking in tables mode requires consistency 'lock'")
+        if zstd_dictionary not in DICTIONARY_MODES:
+            raise ValueError(f"Unknown zstd dictionary mode: {zstd_dictionary}")
+        if zstd_dictionary != "off" and backup.compressor.name != "zstd":
+            raise ValueError("zstd dictionaries require the zstd codec")
+
+        self.backup = backup
+        self.concurrency = concurrency
+        self.consistency = consistency
+        self.chunk_rows = chunk_rows
+        self.track_binlog = track_binlog
+        self.skip_unchanged = skip_unchanged
+        self.zstd_dictionary = zstd_dictionary
+        self.dictionary_max_age_days = dictionary_max_age_days
+        self.dictionary = None
+        self.dictionary_data = None
+        self.samples = []
+        self.binlog = None
+        self.fingerprints = {}
+        self.manifest = None
+        self.run_id = new_run_id()
+        self.prefix = run_prefix(backup.s3_prefix, backup.db_name, self.run_id)
+
+    def build_jobs(self, connection, tables: list) -> list:
+        """
+        Build dump jobs, largest first to shorten the total runtime.
+
+        Views, routines and events go into one trailing "objects" job that
+        is restored after all tables.
+
+        Args:
+            connection: MySQL connection used to inspect primary keys
+            tables: Rows returned by list_tables()
+
+        Returns:
+            List of job dicts with name, kind, chunk, key, options and tables
+        """
+        base_tables = [t for t in tables if t["type"] == "BASE TABLE"]
+        views = [t["name"] for t in tables if t["type"] == "VIEW"]
+
+        keys = {}
+        if self.chunk_rows and any(t["rows_estimate"] > self.chunk_rows for t in base_tables):
+            keys = primary_keys(connection, self.backup.db_name)
+
+        jobs = []
+        for table in base_tables:
+            jobs.extend(self.table_jobs(connection, table, keys.get(table["name"])))
+        jobs.sort(key=lambda job: job["size_estimate"], reverse=True)
+
+        extension = self.backup.extension
+        objects_options = ["--no-data", "--routines", "--events", "--skip-triggers"]
+        if not views:
+            # Without table arguments mysqldump would recreate every table empty
+            objects_options.append("--no-create-info")
+        jobs.append(
+            {
+                "name": "_objects",
+                "kind": "objects",
+                "key": f"{self.prefix}/schema/objects.sql{extension}",
+                "options": objects_options,
+                "tables": views,
+                "chunk": None,
+                "rows_estimate": 0,
+                "size_estimate": 0,
+            }
+        )
+        return jobs
+
+    def table_jobs(self, connection, table: dict, primary_key: list = None) -> list:
+        """
+        Build the dump jobs of one table, chunked by primary key if large.
+
+        Only tables with a single integer primary key column are chunked.
+        The first chunk carries the table definition and triggers; later
+        chunks only add rows, so chunks must be restored in order.
+
+        Args:
+            connection: MySQL connection
+            table: Row returned by list_tables()
+            primary_key: (column, data_type) tuples from primary_keys()
+
+        Returns:
+            List of job dicts
+        """
+        name = table["name"]
+        size = table["data_length"] + table["index_length"]
+        whole_table = {
+            "name": name,
+            "kind": "table",
+            "key": f"{self.prefix}/tables/{name}.sql{self.backup.extension}",
+            "options": [],
+            "tables": [name],
+            "chunk": None,
+            "rows_estimate": table["rows_estimate"],
+            "size_estimate": size,
+        }
+
+        if not self.chunk_rows or table["rows_estimate"] <= self.chunk_rows:
+            return [whole_table]
+
+        if not primary_key or len(primary_key) != 1 or primary_key[0][1] not in INTEGER_TYPES:
+            print(f"Table {name} has no single integer primary key; dumping unchunked")
+            return [whole_table]
+
+        column = primary_key[0][0]
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                f"SELECT MIN({quote_identifier(column)}), MAX({quote_identifier(column)}) "
+                f"FROM {quote_identifier(name)}"
+            )
+            min_value, max_value = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if min_value is None:
+            return [whole_table]
+
+        ranges = chunk_ranges(min_value, max_value, table["rows_estimate"], self.chunk_rows)
+        print(f"Table {name}: splitting into {len(ranges)} chunk(s) on {column}")
+
+        jobs = []
+        for index, (lower, upper) in enumerate(ranges):
+            condition = range_condition(column, lower, upper)
+            options = [f"--where={condition}"]
+            if index > 0:
+                options += ["--no-create-info", "--skip-triggers"]
+            jobs.append(
+                {
+                    "name": name,
+                    "kind": "table",
+                    "key": (
+                        f"{self.prefix}/tables/{name}.{index:05d}"
+                        f".sql{self.backup.extension}"
+                    ),
+                    "options": options,
+                    "tables": [name],
+                    "chunk": index,
+                    "where": condition,
+                    "rows_estimate": table["rows_estimate"] // len(ranges),
+                    "size_estimate": size // len(ranges),
+                }
+            )
+        return jobs
+
+    def disable_stats_cache(self, connection):
+        """
+        Make information_schema.TABLES report current UPDATE_TIME values.
+
+        MySQL 8.0 caches table statistics for a day by default.
+
+        Args:
+            connection: MySQL connection
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+        except Error:
+            # MySQL 5.7 and MariaDB read statistics directly
+            pass
+        finally:
+            cursor.close()
+
+    def previous_manifest(self) -> dict:
+        """
+        Download the manifest of the most recent earlier run.
+
+        The catalog is consulted first; the run prefixes are only listed
+        when it has no earlier tables run.
+
+        Returns:
+            Manifest dictionary, or None if there is no earlier run
+        """
+        backup = self.backup
+        run_ids = []
+        if backup.catalog:
+            run_ids = [
+                entry["run_id"]
+                for entry in reversed(backup.catalog.backups(mode="tables"))
+                if entry["run_id"] < self.run_id
+            ]
+        if not run_ids:
+            run_ids = [
+                run_id
+                for run_id in list_run_ids(
+                    backup.s3_client,
+                    backup.s3_bucket,
+                    backup.s3_prefix,
+                    backup.db_name,
+                    complete=True,
+                )
+                if run_id < self.run_id
+            ]
+        if not run_ids:
+            return None
+        return read_manifest(
+            backup.s3_client,
+            backup.s3_bucket,
+            run_prefix(backup.s3_prefix, backup.db_name, run_ids[-1]),
+        )
+
+    def reuse_unchanged(self, jobs: list, previous: dict) -> tuple:
+        """
+        Drop jobs of tables whose fingerprint matches the previous run.
+
+        Args:
+            jobs: Job dicts from build_jobs()
+            previous: Manifest of the previous run, or None
+
+        Returns:
+            Tuple of (remaining jobs, manifest entries reused from previous)
+        """
+        if not previous:
+            return jobs, []
+
+        previous_fingerprints = previous.get("fingerprints", {})
+        unchanged = {
+            name
+            for name, fingerprint in self.fingerprints.items()
+            if previous_fingerprints.get(name) == fingerprint
+        }
+
+        reused = []
+        for entry in previous["objects"]:
+            # Objects of another codec or encryption setting are dumped again
+            if not entry["key"].endswith(self.backup.extension):
+                continue
+            if entry["kind"] == "table" and entry["name"] in unchanged:
+                # Keep pointing at the run that actually uploaded the object
+                run_id = entry.get("reused_from", previous["run_id"])
+                reused.append(dict(entry, reused_from=run_id))
+
+        # A table is only skipped if the previous run has its objects
+        unchanged &= {entry["name"] for entry in reused}
+        jobs = [job for job in jobs if job["kind"] != "table" or job["name"] not in unchanged]
+        return jobs, reused
+
+    def load_latest_dictionary(self):
+        """
+        Download the newest trained dictionary, if any.
+        """
+        backup = self.backup
+        self.dictionary = latest_dictionary(
+            backup.s3_client, backup.s3_bucket, backup.s3_prefix, backup.db_name
+        )
+        if not self.dictionary:
+            print("No zstd dictionary yet; one is trained from this run")
+            return
+        self.dictionary_data = load_dictionary(
+            backup.s3_client, backup.s3_bucket, self.dictionary["key"]
+        )
+        self.dictionary["id"] = dictionary_id(self.dictionary_data)
+        print(
+            f"Compressing tables under {SMALL_OBJECT_SIZE:,} bytes with zstd dictionary "
+            f"{self.dictionary['id']} (trained {self.dictionary['run_id']})"
+        )
+
+    def job_compressor(self, job: dict):
+        """
+        Pick the compressor of a job.
+
+        Args:
+            job: Job dict from build_jobs()
+
+        Returns:
+            Dictionary compressor for small objects, or None for the
+            configured compressor
+        """
+        if not self.dictionary_data or job["size_estimate"] >= SMALL_OBJECT_SIZE:
+            return None
+        # Created per job so a tuned compression level is picked up
+        return self.backup.compressor.with_dictionary(self.dictionary_data)
+
+    def train_next_dictionary(self) -> dict:
+        """
+        Train a new dictionary from this run's samples when the newest is stale.
+
+        Returns:
+            Dict returned by train_dictionary(), or None if not trained
+        """
+        if self.dictionary:
+            age = dictionary_age_days(self.dictionary, self.run_id)
+            if age < self.dictionary_max_age_days:
+                return None
+        backup = self.backup
+        return train_dictionary(
+            backup.s3_client,
+            backup.s3_bucket,
+            backup.s3_prefix,
+            backup.db_name,
+            self.run_id,
+            self.samples,
+            level=backup.compressor.level,
+        )
+
+    def dump_job(self, job: dict, snapshots: queue.Queue = None) -> dict:
+        """
+        Dump one job and stream it to S3.
+
+        Args:
+            job: Job dict from build_jobs()
+            snapshots: Idle connections from open_snapshots(); the job
+                borrows one and dumps inside its snapshot
+
+        Returns:
+            Manifest object entry
+        """
+        started = time.monotonic()
+        compressor = self.job_compressor(job)
+        upload = None
+        if compressor:
+            upload = functools.partial(self.backup.upload_stream, compressor=compressor)
+        connection = snapshots.get() if snapshots else None
+        try:
+            result = self.backup.stream_dump_to_s3(
+                job["key"],
+                tables=job["tables"],
+                options=job["options"],
+                upload=upload,
+                connection=connection,
+            )
+        finally:
+            if connection:
+                snapshots.put(connection)
+        if self.zstd_dictionary != "off":
+            self.samples.append(result["head"])
+        entry = {
+            "name": job["name"],
+            "kind": job["kind"],
+            "key": job["key"],
+            "rows_estimate": job["rows_estimate"],
+            "raw_bytes": result["raw_bytes"],
+            "bytes": result["bytes"],
+            "etag": result["etag"],
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        if job["chunk"] is not None:
+            entry["chunk"] = job["chunk"]
+            entry["where"] = job["where"]
+        if compressor:
+            entry["dictionary"] = self.dictionary["key"]
+        if result.get("checksums"):
+            entry["checksums"] = result["checksums"]
+        return entry
+
+    def run(self) -> str:
+        """
+        Dump all tables concurrently and write the manifest.
+
+        Returns:
+            S3 URI of the manifest
+        """
+        previous = self.previous_manifest() if self.skip_unchanged != "none" else None
+        if self.zstd_dictionary != "off":
+            self.load_latest_dictionary()
+
+        connection = self.backup.connect()
+        snapshots = []
+        try:
+            if self.skip_unchanged == "update_time":
+                self.disable_stats_cache(connection)
+            tables = list_tables(connection, self.backup.db_name)
+            jobs = self.build_jobs(connection, tables)
+            table_names = sorted({job["name"] for job in jobs if job["kind"] == "table"})
+            locked = self.consistency == "lock" and bool(table_names)
+
+            if locked:
+                lock_tables(connection, table_names)
+            try:
+                # No writes reach these tables until UNLOCK, so this position
+                # matches what every worker sees
+                if locked and self.track_binlog:
+                    self.binlog = binlog_status(connection)
+
+                if self.skip_unchanged != "none":
+                    # Taken under the lock, fingerprints describe exactly what is dumped
+                    self.fingerprints = table_fingerprints(
+                        connection,
+                        self.backup.db_name,
+                        list_tables(connection, self.backup.db_name),
+                        self.skip_unchanged,
+                    )
+                jobs, reused = self.reuse_unchanged(jobs, previous)
+
+                if locked:
+                    snapshots = open_snapshots(self.backup, min(self.concurrency, len(jobs)))
+            finally:
+                if locked:
+                    unlock_tables(connection)
+
+            # The dump limiter only paces the jobs below, so throttling
+            # never stretches the time writes wait on the lock
+            print(
+                f"Dumping {len(table_names)} table(s) in {len(jobs)} job(s) with concurrency "
+                f"{self.concurrency} (consistency: {self.consistency})"
+            )
+            if snapshots and self.backup.dump_engine != "native":
+                # mysqldump opens its own connection and cannot join a snapshot
+                print(
+                    f"Dumping with the native engine on {len(snapshots)} connection(s) "
+                    f"sharing one snapshot"
+                )
+            if reused:
+                self.report_reused(reused)
+
+            entries = self.dump_jobs(jobs, snapshots) + reused
+        finally:
+            close_snapshots(snapshots)
+            connection.close()
+
+        # Tables restore in name and chunk order, schema objects last
+        entries.sort(key=lambda e: (e["kind"] != "table", e["name"], e.get("chunk", 0)))
+
+        manifest = new_manifest(
+            self.backup.db_name,
+            self.run_id,
+            "tables",
+            codec=self.backup.compressor.name,
+            compress_level=self.backup.compressor.level,
+            consistency=self.consistency,
+            chunk_rows=self.chunk_rows,
+            skip_unchanged=self.skip_unchanged,
+        )
+        if self.binlog:
+            manifest["binlog"] = self.binlog
+        if self.skip_unchanged != "none":
+            manifest["fingerprints"] = self.fingerprints
+        tuner = self.backup.level_tuner
+        if tuner and tuner.samples:
+            manifest["compress_tuning"] = tuner.as_dict()
+        if self.zstd_dictionary != "off":
+            manifest["zstd_dictionary"] = {
+                "used": self.dictionary,
+                "trained": self.train_next_dictionary(),
+            }
+        manifest["objects"] = entries
+        manifest_key = write_manifest(
+            self.backup.s3_client, self.backup.s3_bucket, self.prefix, manifest
+        )
+        self.manifest = manifest
+
+        dumped = [e for e in entries if "reused_from" not in e]
+        total_raw = sum(e["raw_bytes"] for e in dumped)
+        total = sum(e["bytes"] for e in dumped)
+        print(f"Dumped {len(dumped)} object(s): {total_raw:,} bytes -> {total:,} bytes")
+        return f"s3://{self.backup.s3_bucket}/{manifest_key}"
+
+    def report_reused(self, reused: list):
+        """
+        Print what skipping unchanged tables saved.
+
+        Args:
+            reused: Manifest entries taken over from earlier runs
+        """
+        tables = {entry["name"] for entry in reused}
+        raw_bytes = sum(entry["raw_bytes"] for entry in reused)
+        uploaded = sum(entry["bytes"] for entry in reused)
+        # Dump time of the run that uploaded the objects; 0 for older manifests
+        seconds = sum(entry.get("seconds", 0) for entry in reused)
+        print(
+            f"Skipping {len(tables)} unchanged table(s) ({len(reused)} object(s)): "
+            f"saved {raw_bytes:,} bytes of dump, {uploaded:,} bytes of upload, "
+            f"~{seconds:.1f}s of dump time"
+        )
+
+    def dump_jobs(self, jobs: list, snapshots: list = ()) -> list:
+        """
+        Run dump jobs through the worker pool.
+
+        Args:
+            jobs: Job dicts from build_jobs()
+            snapshots: Connections from open_snapshots() shared by the
+                workers; empty to give every job its own snapshot
+
+        Returns:
+            Manifest object entries in completion order
+        """
+        idle = None
+        if snapshots:
+            idle = queue.Queue()
+            for connection in snapshots:
+                idle.put(connection)
+
+        entries = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.dump_job, job, idle): job for job in jobs}
+            try:
+                for future in as_completed(futures):
+                    entries.append(future.result())
+            except Exception as e:
+                print(
+                    f"Error dumping {futures[future]['name']}: {e}", file=sys.stderr
+                )
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        return entries
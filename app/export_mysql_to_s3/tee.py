@@ -0,0 +1,442 @@
+"""
+Fan-out of one backup stream to several destinations
+
+Keeping copies of a backup in a second bucket, another region or on a
+local NAS should not mean dumping the database once per copy. TeeWriter
+sits where the compressed stream is written to S3: the primary upload is
+written inline and every mirror gets the same bytes through its own
+bounded queue, drained by its own thread.
+
+  backpressure - a mirror that falls behind fills its queue and then
+                 blocks the writer, so memory stays bounded and the dump
+                 slows to the pace of the slowest destination
+  retries      - S3 mirrors use a client with adaptive retries; local
+                 mirrors rewrite a failed write from its offset after a
+                 back-off
+  failures     - a mirror that still fails is aborted and skipped for the
+                 rest of the stream; the primary and the other mirrors
+                 finish, and the failure is reported at the end
+
+Destinations are given as URIs:
+
+  s3://bucket/prefix              same region as the primary
+  s3://bucket/prefix?region=eu-west-1
+  /mnt/nas/backups or file:///mnt/nas/backups
+
+Mirrors store every object under the same key relative to S3_PREFIX, so
+a mirror can be restored by pointing S3_BUCKET/S3_PREFIX at it, and
+local copies are plain .sql.gz/.sql.zst files.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import boto3
+from botocore.config import Config
+
+from s3_multipart import S3MultipartWriter
+
+# Writes queued per mirror before the writer blocks (one compressed
+# chunk per MiB of dump, so roughly 64 MiB per mirror)
+QUEUE_CHUNKS = 64
+
+# Attempts per S3 request or local write, including the first
+MAX_ATTEMPTS = 5
+
+# Local mirrors are written under this suffix and renamed when complete
+PARTIAL_SUFFIX = ".partial"
+
+_CLOSE = object()
+
+# Mirror clients by (region, max_attempts); boto3 clients are thread-safe
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def parse_destinations(value: str) -> list:
+    """
+    Parse a comma-separated list of mirror destinations.
+
+    Args:
+        value: Destination URIs (see module docstring)
+
+    Returns:
+        List of dicts with kind ("s3" or "file") and bucket, prefix and
+        region or path
+    """
+    destinations = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = urlsplit(item)
+        if parts.scheme == "s3":
+            if not parts.netloc:
+                raise ValueError(f"Mirror destination without a bucket: {item}")
+            region = parse_qs(parts.query).get("region", [None])[0]
+            destinations.append(
+                {
+                    "kind": "s3",
+                    "bucket": parts.netloc,
+                    "prefix": parts.path.strip("/"),
+                    "region": region,
+                }
+            )
+        elif parts.scheme in ("", "file"):
+            if not parts.path.startswith("/"):
+                raise ValueError(f"Local mirror destination must be absolute: {item}")
+            destinations.append({"kind": "file", "path": parts.path})
+        else:
+            raise ValueError(f"Unsupported mirror destination: {item}")
+    return destinations
+
+
+def destination_uri(destination: dict) -> str:
+    """
+    Format a destination for messages.
+
+    Args:
+        destination: Dict returned by parse_destinations()
+
+    Returns:
+        s3:// URI or local path
+    """
+    if destination["kind"] == "file":
+        return destination["path"]
+    uri = f"s3://{destination['bucket']}/{destination['prefix']}".rstrip("/")
+    if destination["region"]:
+        uri += f" ({destination['region']})"
+    return uri
+
+
+def relative_key(s3_key: str, s3_prefix: str) -> str:
+    """
+    Key of an object relative to the backup prefix.
+
+    Args:
+        s3_key: Key of the primary object
+        s3_prefix: S3 prefix/folder for backups
+
+    Returns:
+        Key with the prefix removed
+    """
+    prefix = s3_prefix.strip("/")
+    if prefix and s3_key.startswith(prefix + "/"):
+        return s3_key[len(prefix) + 1 :]
+    return s3_key
+
+
+def mirror_client(destination: dict, max_attempts: int = MAX_ATTEMPTS):
+    """
+    Get the S3 client of an S3 mirror.
+
+    Clients are created once per region and reused by later backups in
+    the same process (see daemon), keeping their connections and
+    credentials.
+
+    Args:
+        destination: S3 destination returned by parse_destinations()
+        max_attempts: Attempts per request
+
+    Returns:
+        boto3 S3 client with adaptive retries
+    """
+    key = (destination["region"], max_attempts)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = boto3.client(
+                "s3",
+                region_name=destination["region"],
+                config=Config(retries={"max_attempts": max_attempts, "mode": "adaptive"}),
+            )
+        return _clients[key]
+
+
+class S3Sink:
+    def __init__(self, destination: dict, s3_client, relative: str, **writer_args):
+        """
+        Initialize a mirror upload to S3.
+
+        Args:
+            destination: S3 destination returned by parse_destinations()
+            s3_client: Client of the destination (see mirror_client())
+            relative: Object key relative to the backup prefix
+            **writer_args: S3MultipartWriter arguments (part size,
+                concurrency, extra_args, limiter, checksum_algorithm)
+        """
+        prefix = destination["prefix"]
+        self.key = f"{prefix}/{relative}" if prefix else relative
+        self.uri = f"s3://{destination['bucket']}/{self.key}"
+        self.writer = S3MultipartWriter(
+            s3_client, destination["bucket"], self.key, **writer_args
+        )
+
+    def write(self, data: bytes):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+    def checksums(self) -> dict:
+        return self.writer.checksums()
+
+
+class LocalSink:
+    def __init__(self, destination: dict, relative: str, max_attempts: int = MAX_ATTEMPTS):
+        """
+        Initialize a mirror copy on a local or mounted file system.
+
+        Args:
+            destination: File destination returned by parse_destinations()
+            relative: Object key relative to the backup prefix
+            max_attempts: Attempts per write
+        """
+        self.path = Path(destination["path"]) / relative
+        self.uri = str(self.path)
+        self.partial = Path(f"{self.path}{PARTIAL_SUFFIX}")
+        self.max_attempts = max_attempts
+        self.offset = 0
+        self.file = None
+
+    def write(self, data: bytes):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if self.file is None:
+                    self._open()
+                written = 0
+                while written < len(data):
+                    written += self.file.write(data[written:])
+                self.offset += len(data)
+                return
+            except OSError as e:
+                if attempt == self.max_attempts:
+                    raise
+                print(
+                    f"Warning: write to {self.uri} failed, retrying "
+                    f"({attempt}/{self.max_attempts}): {e}",
+                    file=sys.stderr,
+                )
+                self._discard_file()
+                time.sleep(2 ** (attempt - 1))
+
+    def close(self):
+        if self.file is None:
+            self._open()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        os.replace(self.partial, self.path)
+
+    def abort(self):
+        self._discard_file()
+        self.partial.unlink(missing_ok=True)
+
+    def checksums(self) -> dict:
+        return None
+
+    def _open(self):
+        # Reopened after a failure: drop whatever the failed write left.
+        # Unbuffered, so errors surface in the write that caused them
+        self.partial.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.partial, "r+b" if self.offset else "wb", buffering=0)
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+
+    def _discard_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+
+class _Mirror:
+    """
+    Thread feeding one sink from a bounded queue.
+    """
+
+    def __init__(self, sink, destination: dict):
+        self.sink = sink
+        self.destination = destination
+        self.queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.bytes = 0
+        self.error = None
+        self.aborted = False
+        self.completed = False
+        self.started = time.monotonic()
+        self.seconds = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is _CLOSE:
+                break
+            if self.error or self.aborted:
+                # Keep draining so the writer never blocks on a dead mirror
+                continue
+            try:
+                self.sink.write(data)
+                self.bytes += len(data)
+            except Exception as e:
+                self._fail(e)
+
+        if not (self.error or self.aborted):
+            try:
+                self.sink.close()
+                self.completed = True
+            except Exception as e:
+                self._fail(e)
+        self.seconds = time.monotonic() - self.started
+
+    def _fail(self, error: Exception):
+        self.error = error
+        print(f"Error writing mirror {self.sink.uri}: {error}", file=sys.stderr)
+        try:
+            self.sink.abort()
+        except Exception as e:
+            print(f"Error aborting mirror {self.sink.uri}: {e}", file=sys.stderr)
+
+    def result(self) -> dict:
+        return {
+            "destination": destination_uri(self.destination),
+            "uri": self.sink.uri,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+            "checksums": None if self.error else self.sink.checksums(),
+            "error": str(self.error) if self.error else None,
+        }
+
+
+class TeeWriter:
+    def __init__(self, primary: S3MultipartWriter, sinks: list):
+        """
+        Initialize fan-out of a stream to a primary upload and mirrors.
+
+        Args:
+            primary: Upload to the backup bucket; its failures abort the
+                whole stream
+            sinks: List of (sink, destination) pairs, sinks being
+                S3Sink or LocalSink instances
+        """
+        self.primary = primary
+        self.mirrors = [_Mirror(sink, destination) for sink, destination in sinks]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    @property
+    def bytes_written(self) -> int:
+        return self.primary.bytes_written
+
+    @property
+    def stats(self):
+        return self.primary.stats
+
+    @property
+    def etag(self) -> str:
+        return self.primary.etag
+
+    def checksums(self) -> dict:
+        return self.primary.checksums()
+
+    def write(self, data: bytes) -> int:
+        """
+        Write data to the primary upload and queue it for every mirror.
+
+        Blocks while a mirror's queue is full.
+
+        Args:
+            data: Bytes to append
+
+        Returns:
+            Number of bytes accepted
+        """
+        self.primary.write(data)
+        if data:
+            for mirror in self.mirrors:
+                if not mirror.error:
+                    mirror.queue.put(bytes(data))
+        return len(data)
+
+    def close(self) -> dict:
+        """
+        Complete the primary upload and wait for the mirrors to finish.
+
+        Returns:
+            Response of the primary upload
+        """
+        for mirror in self.mirrors:
+            mirror.queue.put(_CLOSE)
+        try:
+            response = self.primary.close()
+        except Exception:
+            self._stop_mirrors()
+            raise
+        for mirror in self.mirrors:
+            mirror.thread.join()
+        return response
+
+    def abort(self):
+        """
+        Abort the primary upload and every mirror.
+        """
+        self.primary.abort()
+        self._stop_mirrors()
+
+    def _stop_mirrors(self):
+        for mirror in self.mirrors:
+            mirror.aborted = True
+        for mirror in self.mirrors:
+            if mirror.thread.is_alive():
+                mirror.queue.put(_CLOSE)
+            mirror.thread.join()
+            if not (mirror.error or mirror.completed):
+                try:
+                    mirror.sink.abort()
+                except Exception as e:
+                    print(f"Error aborting mirror {mirror.sink.uri}: {e}", file=sys.stderr)
+
+    def results(self) -> list:
+        """
+        Outcome of every mirror, after close().
+
+        Returns:
+            List of dicts with destination, uri, bytes, seconds, checksums
+            and error (None on success)
+        """
+        return [mirror.result() for mirror in self.mirrors]
+
+
+def print_mirror_results(results: list):
+    """
+    Print one line per mirror.
+
+    Args:
+        results: List returned by TeeWriter.results()
+    """
+    for result in results:
+        if result["error"]:
+            print(f"Mirror FAILED {result['uri']}: {result['error']}", file=sys.stderr)
+        else:
+            print(
+                f"Mirror completed: {result['uri']} ({result['bytes']:,} bytes "
+                f"in {result['seconds']:.1f}s)"
+            )
@@ -0,0 +1,267 @@
+"""
+I/O throttling
+
+A RateLimiter caps bytes per second across all threads of a backup. The
+dump limiter sits between MySQL and the pipeline (mysqldump/native
+output, Parquet row groups) and the upload limiter in front of every
+part or object sent to S3.
+
+AdaptiveThrottle runs a probe query on the source server every few
+seconds. When its latency or Threads_running crosses a threshold, the
+dump rate is halved; while the server is healthy it grows back by a
+quarter per probe up to the configured cap.
+"""
+
+import io
+import sys
+import threading
+import time
+
+from mysql.connector import Error
+
+from s3_multipart import MiB
+
+# Lowest dump rate adaptive throttling backs off to
+MIN_ADAPTIVE_RATE = 1 * MiB
+
+
+class RateLimiter:
+    def __init__(self, rate: float = None):
+        """
+        Initialize token bucket.
+
+        Args:
+            rate: Bytes per second, None for unlimited
+        """
+        self.rate = rate
+        # Configured rate, restored by adaptive throttling
+        self.cap = rate
+        self.consumed = 0
+        self._tokens = rate or 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int):
+        """
+        Account for size bytes, sleeping as long as the rate requires.
+
+        Bursts of up to one second of transfer pass without waiting.
+
+        Args:
+            size: Number of bytes transferred
+        """
+        with self._lock:
+            self.consumed += size
+            now = time.monotonic()
+            rate = self.rate
+            if not rate:
+                self._updated = now
+                return
+            self._tokens = min(rate, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= size
+            delay = -self._tokens / rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class ThrottledReader(io.RawIOBase):
+    def __init__(self, raw, limiter: RateLimiter):
+        """
+        Initialize rate-limited reader.
+
+        Args:
+            raw: Binary file object with readinto()
+            limiter: RateLimiter charged for every byte read
+        """
+        self.raw = raw
+        self.limiter = limiter
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self.raw.readinto(buffer)
+        if size:
+            self.limiter.consume(size)
+        return size
+
+
+def throttled_reader(reader, limiter: RateLimiter):
+    """
+    Wrap a binary reader so reads are charged to a rate limiter.
+
+    Args:
+        reader: Binary file object
+        limiter: RateLimiter, or None to return reader unchanged
+
+    Returns:
+        Buffered binary file object supporting read() and line iteration
+    """
+    if limiter is None:
+        return reader
+    return io.BufferedReader(ThrottledReader(reader, limiter), buffer_size=MiB)
+
+
+class ThrottledWriter:
+    def __init__(self, raw, limiter: RateLimiter):
+        """
+        Initialize rate-limited writer.
+
+        Args:
+            raw: Binary file object
+            limiter: RateLimiter charged for every byte written
+        """
+        self.raw = raw
+        self.limiter = limiter
+
+    def write(self, data: bytes) -> int:
+        self.limiter.consume(len(data))
+        return self.raw.write(data)
+
+
+def probe_server(connection, query: str) -> tuple:
+    """
+    Measure how busy the MySQL server is.
+
+    Args:
+        connection: MySQL connection
+        query: Probe query, timed end to end
+
+    Returns:
+        Tuple of (probe latency in seconds, Threads_running)
+    """
+    cursor = connection.cursor()
+    try:
+        started = time.monotonic()
+        cursor.execute(query)
+        cursor.fetchall()
+        latency = time.monotonic() - started
+        cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+        row = cursor.fetchone()
+        return latency, int(row[1]) if row else 0
+    finally:
+        cursor.close()
+
+
+class AdaptiveThrottle:
+    def __init__(
+        self,
+        backup,
+        limiter: RateLimiter,
+        probe_query: str = "SELECT 1",
+        max_latency_ms: float = 100,
+        max_threads_running: int = None,
+        interval: float = 2.0,
+    ):
+        """
+        Initialize adaptive dump throttling.
+
+        Args:
+            backup: MySQLBackupToS3 instance (connection to probe)
+            limiter: Dump RateLimiter whose rate is adjusted up to its
+                cap (None for unlimited); may be shared by several backups
+            probe_query: Query timed on every probe
+            max_latency_ms: Back off when the probe takes longer
+            max_threads_running: Back off when Threads_running is higher
+                (None disables the check)
+            interval: Seconds between probes
+        """
+        self.backup = backup
+        self.limiter = limiter
+        self.probe_query = probe_query
+        self.max_latency = max_latency_ms / 1000
+        self.max_threads_running = max_threads_running
+        self.interval = interval
+        # Not limiter.rate, which another backup's throttle may have lowered
+        self.cap = limiter.cap
+        self.peak = 0
+        self.backoffs = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.limiter.rate = self.cap
+        if self.backoffs:
+            print(f"Adaptive throttle backed off {self.backoffs} time(s)")
+
+    def overloaded(self, latency: float, threads_running: int) -> bool:
+        """
+        Decide whether a probe result calls for backing off.
+
+        Args:
+            latency: Probe latency in seconds
+            threads_running: Threads_running status variable
+
+        Returns:
+            True if the server is over a threshold
+        """
+        if latency > self.max_latency:
+            return True
+        return bool(self.max_threads_running) and threads_running > self.max_threads_running
+
+    def adjust(self, overloaded: bool, observed_rate: float):
+        """
+        Halve the dump rate when overloaded, otherwise let it grow back.
+
+        Args:
+            overloaded: Result of overloaded()
+            observed_rate: Bytes per second dumped since the last probe
+        """
+        limiter = self.limiter
+        if limiter.rate is None:
+            self.peak = max(self.peak, observed_rate)
+        if overloaded:
+            current = limiter.rate or observed_rate
+            rate = max(MIN_ADAPTIVE_RATE, current / 2)
+            if rate == limiter.rate:
+                return
+            limiter.rate = rate
+            self.backoffs += 1
+            print(
+                f"Source server busy; dump rate lowered to {rate / MiB:,.1f} MiB/s",
+                file=sys.stderr,
+            )
+        elif limiter.rate is not None and limiter.rate != self.cap:
+            rate = limiter.rate * 1.25
+            # Without a cap, the limit is lifted once back at the unthrottled rate
+            if rate >= (self.cap or self.peak):
+                rate = self.cap
+            limiter.rate = rate
+
+    def _run(self):
+        try:
+            connection = self.backup.connect()
+        except Error as e:
+            print(f"Warning: adaptive throttle disabled: {e}", file=sys.stderr)
+            return
+        try:
+            consumed = self.limiter.consumed
+            last = time.monotonic()
+            while not self._stop.wait(self.interval):
+                try:
+                    latency, threads_running = probe_server(connection, self.probe_query)
+                except Error as e:
+                    print(f"Warning: throttle probe failed: {e}", file=sys.stderr)
+                    continue
+                now = time.monotonic()
+                observed = (self.limiter.consumed - consumed) / max(now - last, 1e-3)
+                consumed, last = self.limiter.consumed, now
+                self.adjust(self.overloaded(latency, threads_running), observed)
+        finally:
+            connection.close()
@@ -0,0 +1,343 @@
+"""
+Backup verification
+
+Streams backup objects back from S3 with parallel ranged GETs and checks
+them in memory, without writing anything to disk or to MySQL:
+
+  size    - object size matches the recorded size
+  stored  - checksum of the object matches the one computed during the
+            upload (manifest or catalog) and, for full-object checksums,
+            the one S3 reports
+  parts   - for composite checksums of file mode uploads, the checksum
+            of the part checksums matches the one S3 recorded
+  decode  - the object decrypts and decompresses completely (GCM tags,
+            gzip CRCs, zstd frames)
+  raw     - size and checksum of the decompressed dump match the ones
+            computed while dumping
+
+Deduplicated backups are verified by reassembling them into nothing:
+every chunk is checked against the SHA-256 it is stored under.
+"""
+
+import io
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from checksums import S3_ALGORITHMS, checksum_of, new_checksum, s3_argument
+from compressors import codec_for_key, get_compressor
+from encryption import DecryptingDecompressor, object_encryption
+from manifest import read_manifest
+from restore import RestoreFromS3
+from s3_multipart import MiB
+
+# Bytes per ranged GET when the upload's part size is unknown
+RANGE_SIZE = 8 * MiB
+
+
+class _NullWriter(io.RawIOBase):
+    """
+    Binary sink that only counts bytes.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.bytes += len(data)
+        return len(data)
+
+
+class BackupVerifier:
+    def __init__(self, backup, concurrency: int = 8):
+        """
+        Initialize verification.
+
+        Args:
+            backup: MySQLBackupToS3 instance providing S3 location and client
+            concurrency: Ranged GETs in flight (and objects verified at once)
+        """
+        self.backup = backup
+        self.concurrency = concurrency
+        # Leaf tasks only, so object workers can share it without deadlock
+        self.range_executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.restore = RestoreFromS3(backup, concurrency=concurrency)
+
+    def fetch_ranges(self, key: str, size: int, range_size: int = RANGE_SIZE):
+        """
+        Download an object with parallel ranged GETs, in order.
+
+        At most `concurrency` ranges are held in memory.
+
+        Args:
+            key: S3 key
+            size: Object size in bytes
+            range_size: Bytes per request
+
+        Yields:
+            Consecutive byte ranges of the object
+        """
+        backup = self.backup
+
+        def fetch(start: int) -> bytes:
+            end = min(start + range_size, size) - 1
+            response = backup.s3_client.get_object(
+                Bucket=backup.s3_bucket, Key=key, Range=f"bytes={start}-{end}"
+            )
+            return response["Body"].read()
+
+        pending = deque()
+        for start in range(0, size, range_size):
+            pending.append(self.range_executor.submit(fetch, start))
+            if len(pending) >= self.concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def decompressor_for(self, key: str, size: int, dictionary: str = None):
+        """
+        Pick the streaming decompressor of an object.
+
+        Args:
+            key: S3 key
+            size: Object size in bytes
+            dictionary: S3 key of the object's zstd dictionary, if any
+
+        Returns:
+            Decompression object, decrypting encrypted objects first, or
+            None for objects that are not compressed dumps (Parquet files)
+        """
+        if dictionary:
+            decompressor = self.restore.dictionary_compressor(dictionary).decompressobj()
+        else:
+            try:
+                decompressor = get_compressor(codec_for_key(key)).decompressobj()
+            except ValueError:
+                return None
+        encryption = object_encryption(key, self.backup.encryption)
+        if encryption:
+            return DecryptingDecompressor(encryption.decryptobj(size), decompressor)
+        return decompressor
+
+    def verify_object(self, key: str, expected: dict = None) -> dict:
+        """
+        Verify one object.
+
+        Args:
+            key: S3 key
+            expected: Manifest or catalog entry of the object (bytes,
+                raw_bytes, checksums, dictionary), if known
+
+        Returns:
+            Dict with key, bytes, raw_bytes, checks (passed) and errors
+        """
+        backup = self.backup
+        expected = expected or {}
+        recorded = expected.get("checksums") or {}
+        result = {"key": key, "bytes": 0, "raw_bytes": None, "checks": [], "errors": []}
+
+        def check(name: str, ok: bool, message: str):
+            if ok:
+                result["checks"].append(name)
+            else:
+                result["errors"].append(message)
+
+        head = backup.s3_client.head_object(
+            Bucket=backup.s3_bucket, Key=key, ChecksumMode="ENABLED"
+        )
+        size = head["ContentLength"]
+        if expected.get("bytes") is not None:
+            check("size", size == expected["bytes"], f"size {size:,} != {expected['bytes']:,}")
+
+        algorithm = recorded.get("algorithm")
+        s3_value = None
+        for name in S3_ALGORITHMS:
+            if head.get(s3_argument(name)):
+                algorithm = algorithm or name
+                if name == algorithm:
+                    s3_value = head[s3_argument(name)]
+        s3_value = s3_value or recorded.get("s3")
+        s3_type = recorded.get("type") or head.get("ChecksumType")
+
+        part_size = recorded.get("part_size")
+        stored = new_checksum(algorithm) if algorithm else None
+        raw = new_checksum(algorithm) if algorithm and recorded.get("raw") else None
+        part_digests = []
+        raw_bytes = 0
+
+        try:
+            decompressor = self.decompressor_for(key, size, expected.get("dictionary"))
+            for data in self.fetch_ranges(key, size, part_size or RANGE_SIZE):
+                result["bytes"] += len(data)
+                if stored:
+                    stored.update(data)
+                if part_size:
+                    part = new_checksum(algorithm)
+                    part.update(data)
+                    part_digests.append(part.digest())
+                if decompressor:
+                    output = decompressor.decompress(data)
+                    raw_bytes += len(output)
+                    if raw:
+                        raw.update(output)
+        except Exception as e:
+            result["errors"].append(f"read failed: {e}")
+            return result
+
+        if decompressor:
+            # A truncated stream leaves the last member or frame unfinished
+            check("decode", decompressor.eof, "compressed stream is truncated")
+            result["raw_bytes"] = raw_bytes
+            # Archives decompress to the dump plus their index line
+            expected_raw = recorded.get("raw_bytes", expected.get("raw_bytes"))
+            if expected_raw is not None:
+                check(
+                    "raw size",
+                    raw_bytes == expected_raw,
+                    f"raw size {raw_bytes:,} != {expected_raw:,}",
+                )
+            if raw:
+                check(
+                    f"raw {algorithm}",
+                    raw.value() == recorded["raw"],
+                    f"raw {algorithm} {raw.value()} != {recorded['raw']}",
+                )
+
+        if stored and recorded.get("stored"):
+            check(
+                f"stored {algorithm}",
+                stored.value() == recorded["stored"],
+                f"stored {algorithm} {stored.value()} != {recorded['stored']}",
+            )
+        if s3_value and part_size:
+            # Composite: checksum of the part checksums, "-{parts}" appended by S3
+            composite = checksum_of(algorithm, b"".join(part_digests))
+            check(
+                f"parts {algorithm}",
+                composite == s3_value.split("-")[0],
+                f"composite {algorithm} {composite} != S3 {s3_value}",
+            )
+        elif stored and s3_value and s3_type == "FULL_OBJECT":
+            check(
+                f"S3 {algorithm}",
+                stored.value() == s3_value,
+                f"{algorithm} {stored.value()} != S3 {s3_value}",
+            )
+        return result
+
+    def verify_objects(self, objects: list) -> list:
+        """
+        Verify manifest or catalog objects concurrently.
+
+        Args:
+            objects: Entries with key and optionally bytes, raw_bytes,
+                checksums and dictionary
+
+        Returns:
+            Results of verify_object() in input order
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(lambda obj: self.verify_object(obj["key"], obj), objects))
+
+    def verify_recipe(self, key: str) -> dict:
+        """
+        Verify a deduplicated backup by reassembling it into nothing.
+
+        Args:
+            key: S3 key of the recipe
+
+        Returns:
+            Dict with key, bytes, raw_bytes, checks and errors
+        """
+        result = {"key": key, "bytes": 0, "raw_bytes": None, "checks": [], "errors": []}
+        sink = _NullWriter()
+        try:
+            self.restore.reassemble(key, sink)
+        except Exception as e:
+            result["errors"].append(f"reassembly failed: {e}")
+            return result
+        result["raw_bytes"] = sink.bytes
+        result["checks"].append("chunk sha256")
+        return result
+
+    def catalog_object(self, key: str) -> dict:
+        """
+        Look up the catalog entry of a single-object backup.
+
+        Args:
+            key: S3 key
+
+        Returns:
+            Newest catalog object entry with that key, or None
+        """
+        if not self.backup.catalog:
+            return None
+        for entry in reversed(self.backup.catalog.entries()):
+            for obj in entry["objects"]:
+                if obj["key"] == key:
+                    return obj
+        return None
+
+    def run(self, key: str = None, run_id: str = None) -> list:
+        """
+        Verify a backup.
+
+        Source selection follows RestoreFromS3.run(): key, then run_id,
+        then the latest backup of the configured mode.
+
+        Args:
+            key: S3 key of a single backup object or dedup recipe
+            run_id: Run identifier of a per-table or Parquet backup
+
+        Returns:
+            List of result dicts, one per object
+        """
+        backup = self.backup
+        restore = self.restore
+        try:
+            if not (key or run_id):
+                if backup.backup_mode in ("tables", "parquet"):
+                    run_id = restore.latest_run_id(backup.backup_mode)
+                elif backup.backup_mode == "dedup":
+                    key = restore.latest_recipe()
+                else:
+                    key = restore.latest_key()
+
+            if run_id:
+                mode = "parquet" if backup.backup_mode == "parquet" else "tables"
+                manifest = read_manifest(
+                    backup.s3_client,
+                    backup.s3_bucket,
+                    restore.manifest_prefix(run_id, mode),
+                )
+                print(f"Verifying {len(manifest['objects'])} object(s) of run {run_id}")
+                results = self.verify_objects(manifest["objects"])
+            elif key.endswith(".json"):
+                results = [self.verify_recipe(key)]
+            else:
+                results = [self.verify_object(key, self.catalog_object(key))]
+        finally:
+            self.range_executor.shutdown(wait=True)
+
+        for result in results:
+            self.print_result(result)
+        failed = sum(1 for result in results if result["errors"])
+        print(f"{len(results) - failed} object(s) verified, {failed} failed")
+        return results
+
+    def print_result(self, result: dict):
+        """
+        Print one line per verified object.
+
+        Args:
+            result: Dict returned by verify_object() or verify_recipe()
+        """
+        if result["errors"]:
+            print(f"FAILED {result['key']}: {'; '.join(result['errors'])}", file=sys.stderr)
+            return
+        raw = f", {result['raw_bytes']:,} raw" if result["raw_bytes"] is not None else ""
+        checks = ", ".join(result["checks"]) or "readable"
+        print(f"OK {result['key']} ({result['bytes']:,} bytes{raw}; {checks})")
@@ -0,0 +1,198 @@
+"""
+Trained Zstandard dictionaries
+
+Per-table backups produce many small objects, each compressed on its
+own. Every one of them starts with an empty window, so the structure
+all dumps share (the mysqldump header, CREATE TABLE, INSERT INTO ...
+VALUES) is learned again per object and small tables compress poorly.
+A dictionary trained on the start of earlier dumps primes the
+compressor with that structure.
+
+Dictionaries are stored under `{s3_prefix}/{db_name}/dictionaries/`,
+named after the run that trained them, and never change once written.
+Manifests record which dictionary each object was compressed with;
+restoring such an object requires that dictionary.
+"""
+
+import sys
+
+from botocore.exceptions import ClientError
+
+from manifest import run_time
+from s3_multipart import MiB
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+KiB = 1024
+
+DICTIONARY_EXTENSION = ".zdict"
+
+# zstd's default dictionary size; larger ones help little on SQL text
+DICTIONARY_SIZE = 112 * KiB
+
+# Tables estimated below this size are compressed with the dictionary;
+# on larger objects the window soon holds better history than it
+SMALL_OBJECT_SIZE = 4 * MiB
+
+# Training needs enough distinct samples to find shared content
+MIN_SAMPLES = 16
+
+DICTIONARY_MODES = ("off", "auto")
+
+
+def dictionary_prefix(s3_prefix: str, db_name: str) -> str:
+    """
+    Build the S3 key prefix of the dictionaries of a database.
+
+    Args:
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Key prefix without trailing slash
+    """
+    return f"{s3_prefix}/{db_name}/dictionaries"
+
+
+def latest_dictionary(s3_client, bucket: str, s3_prefix: str, db_name: str) -> dict:
+    """
+    Find the most recently trained dictionary.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+
+    Returns:
+        Dict with key and run_id, or None if no dictionary exists
+    """
+    keys = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=dictionary_prefix(s3_prefix, db_name) + "/"
+    ):
+        keys.extend(
+            obj["Key"]
+            for obj in page.get("Contents", [])
+            if obj["Key"].endswith(DICTIONARY_EXTENSION)
+        )
+    if not keys:
+        return None
+
+    # Named after run IDs, so the lexically last key is the newest
+    key = max(keys)
+    return {"key": key, "run_id": key.rsplit("/", 1)[-1].removesuffix(DICTIONARY_EXTENSION)}
+
+
+def load_dictionary(s3_client, bucket: str, key: str) -> bytes:
+    """
+    Download a dictionary.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        key: S3 key of the dictionary
+
+    Returns:
+        Dictionary bytes
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return response["Body"].read()
+
+
+def dictionary_id(data: bytes) -> int:
+    """
+    Read the ID zstd stores in a dictionary and in frames using it.
+
+    Args:
+        data: Dictionary bytes
+
+    Returns:
+        Dictionary ID
+    """
+    return zstandard.ZstdCompressionDict(data).dict_id()
+
+
+def dictionary_age_days(dictionary: dict, run_id: str) -> float:
+    """
+    Age of a dictionary at the time of a run.
+
+    Args:
+        dictionary: Dict returned by latest_dictionary()
+        run_id: Identifier of the current run
+
+    Returns:
+        Days between the training run and run_id
+    """
+    delta = run_time(run_id) - run_time(dictionary["run_id"])
+    return delta.total_seconds() / 86400
+
+
+def train_dictionary(
+    s3_client,
+    bucket: str,
+    s3_prefix: str,
+    db_name: str,
+    run_id: str,
+    samples: list,
+    level: int = 3,
+) -> dict:
+    """
+    Train a dictionary from dump samples and store it on S3.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: S3 bucket name
+        s3_prefix: S3 prefix/folder for backups
+        db_name: Database name
+        run_id: Identifier of the run the samples come from
+        samples: Uncompressed byte strings, one per dumped object
+        level: Compression level the dictionary is tuned for
+
+    Returns:
+        Dict with key, run_id, id, size and samples, or None if there
+        were too few samples or training failed
+    """
+    samples = [sample for sample in samples if sample]
+    if len(samples) < MIN_SAMPLES:
+        print(
+            f"Not training a zstd dictionary: {len(samples)} sample(s), "
+            f"at least {MIN_SAMPLES} needed"
+        )
+        return None
+
+    try:
+        trained = zstandard.train_dictionary(DICTIONARY_SIZE, samples, level=level)
+    except zstandard.ZstdError as e:
+        print(f"Warning: zstd dictionary training failed: {e}", file=sys.stderr)
+        return None
+
+    data = trained.as_bytes()
+    key = f"{dictionary_prefix(s3_prefix, db_name)}/{run_id}{DICTIONARY_EXTENSION}"
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=data,
+            ContentType="application/octet-stream",
+            Metadata={"dictionary-id": str(trained.dict_id())},
+        )
+    except ClientError as e:
+        print(f"Error uploading zstd dictionary: {e}", file=sys.stderr)
+        raise
+
+    print(
+        f"Trained zstd dictionary {trained.dict_id()} from {len(samples)} sample(s) "
+        f"({len(data):,} bytes): s3://{bucket}/{key}"
+    )
+    return {
+        "key": key,
+        "run_id": run_id,
+        "id": trained.dict_id(),
+        "size": len(data),
+        "samples": len(samples),
+    }